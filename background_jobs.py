@@ -0,0 +1,159 @@
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import cv2
+
+# バックグラウンド処理のプロセス数の既定値の上限（ワーカーごとにOpenCV・NumPyを読み込むためメモリも使う）
+DEFAULT_MAX_WORKERS = 2
+
+
+# --- プロセス数 ---
+def _cgroup_cpu_limit():
+    """コンテナ（cgroup）のCPU制限を返します。制限が無い場合はNoneです。"""
+    try:
+        # cgroup v2: "クォータ 期間"（制限が無い場合は "max 期間"）
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: 制限が無い場合はクォータが-1
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """このプロセスが使えるCPU数を返します。
+
+    `os.cpu_count()` はホストのCPU数を返すため、CPUアフィニティとコンテナのCPU制限も考慮します。
+    """
+    count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, math.ceil(limit))
+    return max(1, count)
+
+
+def default_workers():
+    """バックグラウンド処理のプロセス数の既定値（使えるCPU数の半分、最大 `DEFAULT_MAX_WORKERS`）を返します。"""
+    return max(1, min(DEFAULT_MAX_WORKERS, available_cpus() // 2))
+
+
+# --- ワーカープロセスの初期化 ---
+def init_worker():
+    """バックグラウンド処理のワーカープロセスを初期化します。
+
+    ワーカー同士・アプリ本体とCPUを奪い合わないよう、OpenCVのスレッドを使わず優先度を下げます。
+    """
+    cv2.setNumThreads(1)
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+# --- キーごとのバックグラウンド処理 ---
+class BackgroundJobs:
+    """プロセスプールを使う処理を、キー（データセットなど）ごとのジョブとしてバックグラウンドで実行します。
+
+    ジョブは `start()` に渡したタスクを1つずつワーカーへ送り、結果が届くたびにコールバックを呼び出します。
+    ジョブごとにスレッドを1つ使い、ワーカープロセスはすべてのジョブで共有します
+    （最初のタスクの送信時に起動し、実行中のジョブが無くなると終了します）。
+    同じキーのジョブを開始すると実行中のものを中断しますが、他のキーのジョブはそのまま続けます。
+    """
+
+    def __init__(self, workers, name="background-job"):
+        self.workers = workers
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pool = None
+
+    def start(self, key, tasks, on_result, on_error):
+        """キーのジョブを開始します（同じキーのジョブが実行中であれば中断してから開始します）。
+
+        `tasks` は中断を知らせる `threading.Event` を受け取り、(関数, 引数のタプル, 付加情報) を順に返す
+        関数です。ジョブのスレッドで呼び出すため、保存済みの結果の読み込みなどの準備を含めても構いません。
+        関数の結果は `on_result(付加情報, 結果)` に、ワーカーで例外が発生した場合は `on_error(付加情報)` に渡します。
+        """
+        cancel = threading.Event()
+        thread = threading.Thread(
+            target=self._run, args=(key, tasks, on_result, on_error, cancel), name=self.name, daemon=True
+        )
+        with self._lock:
+            previous = self._jobs.get(key)
+            if previous is not None:
+                previous[1].set()
+            self._jobs[key] = (thread, cancel)
+        thread.start()
+
+    def cancel(self, key):
+        """キーのジョブを中断します（ワーカーで処理中の分は完了を待たずに戻ります）。"""
+        with self._lock:
+            job = self._jobs.pop(key, None)
+        if job is not None:
+            job[1].set()
+
+    def cancel_all(self):
+        """すべてのジョブを中断します。"""
+        with self._lock:
+            jobs, self._jobs = self._jobs, {}
+        for _, cancel in jobs.values():
+            cancel.set()
+
+    def running(self, key):
+        """キーのジョブが実行中かを返します。"""
+        with self._lock:
+            job = self._jobs.get(key)
+        return job is not None and job[0].is_alive()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Streamlitのスレッドを含むプロセスをforkしないよう、ワーカーはspawnで起動する
+                context = multiprocessing.get_context("spawn")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker)
+            return self._pool
+
+    def _run(self, key, tasks, on_result, on_error, cancel):
+        pending = {}
+        try:
+            for func, args, context in tasks(cancel):
+                if cancel.is_set():
+                    break
+                try:
+                    pending[self._executor().submit(func, *args)] = context
+                except RuntimeError: # インタプリタの終了時
+                    break
+                # 予約を少数に抑え、中断やデータセットの切り替えにすぐ応じられるようにする
+                while len(pending) >= self.workers * 2:
+                    self._collect(pending, on_result, on_error)
+            while pending and not cancel.is_set():
+                self._collect(pending, on_result, on_error)
+        finally:
+            for future in pending:
+                future.cancel()
+            with self._lock:
+                job = self._jobs.get(key)
+                if job is not None and job[1] is cancel:
+                    del self._jobs[key]
+                if not self._jobs and self._pool is not None:
+                    self._pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = None
+
+    def _collect(self, pending, on_result, on_error):
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            context = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                on_error(context)
+                continue
+            on_result(context, result)
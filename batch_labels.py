@@ -0,0 +1,609 @@
+"""ラベリング結果をコマンドラインから一括で出力・検証・統合するツールです。
+
+Streamlitの画面を開かずに、アプリの状態ファイル（`.session_state.db`）に保存されたラベルを
+データセット（フォルダ）ごとに処理します。データセットはワーカープロセスで並列に処理し、
+フレーム一覧とラベルはチャンク単位で読み書きするため、フレーム数が多くてもメモリ使用量は
+チャンクの大きさとラベルの区間の数で決まります。
+
+サブコマンド:
+    export    データセットごとにフレーム単位のCSV（アプリの「CSV」形式と同じ列）を出力します。
+              複数の作業者を指定すると作業者ごとに出力し、`--merge` を指定すると投票で統合して出力します。
+    validate  ラジオボタンのグループで複数の選択肢が付与されているフレームと、設定に無いラベルを検出します。
+    merge     複数の作業者が出力したCSVを、フレームごとの投票で1つのCSVに統合します。
+
+使い方（アプリを起動するディレクトリで実行します）:
+    python batch_labels.py export --all --output-dir exports
+    python batch_labels.py export seq1 seq2 --annotators alice bob --merge majority --output-dir exports
+    python batch_labels.py validate --all --all-annotators
+    python batch_labels.py merge merged.csv alice.csv bob.csv carol.csv --labels labels.txt
+
+ラベル設定（`##` の行以降はラジオボタンのグループ）は `--labels` で指定します。省略した場合は
+アプリでデータセットごとに保存された設定を使います。処理結果はデータセットごとにJSONの1行として
+標準出力に書き込みます。エラーのあったデータセット、フレームが無い（明示的に指定した）フォルダ、
+validateで違反のあったデータセット（exportでは `--strict` 指定時）があるか、`--all` でデータセットが
+見つからない場合は終了コード1で、`--state-db` の状態ファイルが存在しない場合は終了コード2で終了します。
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from itertools import repeat
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from label_io import FRAME_COLUMN
+from label_model import LabelRuns, overlapping_runs, parse_label_lines
+from scan_index import IMAGE_EXTENSIONS, ScanIndex
+from state_store import DEFAULT_ANNOTATOR, StateStore
+from video_source import VIDEO_EXTENSIONS, VideoLibrary, split_frame_key
+
+# アプリと同じ既定の保存先・データフォルダ
+STATE_DB_FILE = ".session_state.db"
+SCAN_INDEX_FILE = ".scan_index.db"
+DATA_ROOT_PATH = os.environ.get("DATA_ROOT_PATH", "/data")
+# フレーム一覧・CSVを読み書きする1チャンクあたりの行数
+CHUNK_ROWS = 100_000
+# 統合の方法ごとに、ラベルを付与するのに必要な票数を作業者数から求める
+MERGE_STRATEGIES = {
+    "union": lambda voters: 1,
+    "majority": lambda voters: voters // 2 + 1,
+    "unanimous": lambda voters: voters,
+}
+# 検証結果に含める違反区間の例の数
+MAX_EXAMPLES = 5
+
+
+# --- ラベル設定 ---
+def read_label_config(path):
+    """ラベル設定ファイル（アプリの「ラベル設定ファイル」と同じ形式）の各行を返します。"""
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def label_columns(config_lines):
+    """ラベル設定から出力するラベル列を返します（アプリの出力と同じく `##` の行を除いた順）。"""
+    return [line.strip() for line in config_lines if line.strip() and not line.strip().startswith("##")]
+
+
+def dataset_label_config(store, dataset, annotators, config_lines=None):
+    """データセットのラベル設定の各行を返します。
+
+    `config_lines` が指定されていればそれを、無ければ作業者が保存した設定（指定順で最初に見つかったもの）を使います。
+    """
+    if config_lines:
+        return list(config_lines)
+    for annotator in annotators:
+        stored = store.load_meta(annotator, dataset).get("labels_config")
+        if stored:
+            return [line.strip() for line in stored if line.strip()]
+    return []
+
+
+# --- データセットの指定 ---
+def resolve_dataset(folder, data_root):
+    """フォルダ名（データフォルダからの相対パス）または絶対パスを、アプリと同じデータセット名に変換します。"""
+    return os.path.normpath(os.path.join(data_root, folder))
+
+
+def output_name(dataset, data_root):
+    """出力ファイル名に使う、データセットのデータフォルダからの相対パス（区切りは `__`）を返します。"""
+    root = os.path.normpath(data_root)
+    if os.path.isabs(dataset) and os.path.commonpath([dataset, root]) == root:
+        relative = os.path.relpath(dataset, root)
+    else:
+        relative = dataset.strip(os.sep)
+    return "root" if relative in (".", "") else relative.replace(os.sep, "__")
+
+
+def rescan_dataset(store, dataset, scan_index):
+    """フォルダを読み直してフレーム一覧を更新します（アプリでフォルダを開き直した場合と同じ）。
+
+    フレームが追加・削除された場合は、保存済みのラベルをフレームのパスで対応付けて移し替えます。
+    """
+    files = ScanIndex(scan_index).scan(dataset, IMAGE_EXTENSIONS | VIDEO_EXTENSIONS)
+    return store.replace_frames(dataset, VideoLibrary(scan_index).expand(files))
+
+
+def load_runs(store, dataset, annotator):
+    """作業者のラベル区間を {ラベル名: `LabelRuns`} で返します。"""
+    return {
+        label: LabelRuns([start for start, _ in runs], [stop for _, stop in runs])
+        for label, runs in store.load_label_runs(dataset, annotator).items()
+    }
+
+
+# --- 検証 ---
+def exclusivity_violations(runs, radio_groups, examples=MAX_EXAMPLES):
+    """ラジオボタンのグループごとに、複数の選択肢が付与されているフレーム数と区間の例を返します。
+
+    区間の例は画面の表示と同じく1始まりのフレーム番号の [開始, 終了] です。
+    """
+    violations = {}
+    for group, options in radio_groups.items():
+        overlap = overlapping_runs([runs[option] for option in options if option in runs])
+        if len(overlap):
+            violations[group] = {
+                "frames": overlap.count(),
+                "examples": [[start + 1, stop] for start, stop in list(overlap)[:examples]],
+            }
+    return violations
+
+
+def row_violations(values, columns, radio_groups):
+    """ラベル列の0/1配列のうち、ラジオボタンのグループで複数の選択肢が付与されている行数をグループごとに返します。"""
+    index = {name: j for j, name in enumerate(columns)}
+    counts = {}
+    for group, options in radio_groups.items():
+        ids = [index[option] for option in options if option in index]
+        if len(ids) > 1:
+            invalid = int(np.count_nonzero(values[:, ids].sum(axis=1) > 1))
+            if invalid:
+                counts[group] = invalid
+    return counts
+
+
+# --- 統合 ---
+def resolve_votes(votes, voters, columns, radio_groups, strategy):
+    """ラベルごとの票数（行数 x ラベル列）から、統合したラベルの0/1配列と、票が割れた行数を返します。
+
+    チェックボックスのラベルは必要数以上の票があれば付与します。ラジオボタンのグループでは、必要数以上の
+    票を集めた選択肢のうち最多のものを1つだけ付与し、最多が複数ある行はどれも付与しません
+    （グループごとにその行数を返します）。
+    """
+    needed = MERGE_STRATEGIES[strategy](voters)
+    values = (votes >= needed).astype(np.uint8)
+    ties = {}
+    index = {name: j for j, name in enumerate(columns)}
+    for group, options in radio_groups.items():
+        ids = [index[option] for option in options if option in index]
+        if len(ids) < 2:
+            continue
+        group_votes = votes[:, ids]
+        best = group_votes.max(axis=1, keepdims=True)
+        winners = (group_votes == best) & (best >= needed)
+        tied = winners.sum(axis=1) > 1
+        winners[tied] = False
+        values[:, ids] = winners
+        if tied.any():
+            ties[group] = int(np.count_nonzero(tied))
+    return values, ties
+
+
+def add_counts(total, counts):
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+
+
+# --- CSVの書き込み ---
+@contextmanager
+def atomic_output(path):
+    """一時ファイルに書き込み、完了したら置き換えます（`.gz` で終わる場合はgzip圧縮）。
+
+    途中で失敗した場合は一時ファイルを削除し、以前の出力をそのまま残します。
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with (gzip.open(tmp, "wb", compresslevel=6) if path.suffix == ".gz" else open(tmp, "wb")) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def frame_table(filenames, frame_numbers, columns, values, with_frame_column):
+    """ファイル名・動画内のフレーム番号・ラベル列の0/1配列から、アプリの出力と同じ列構成のDataFrameを作成します。"""
+    table = pd.DataFrame(values, columns=columns)
+    if with_frame_column:
+        table.insert(0, FRAME_COLUMN, pd.array(frame_numbers, dtype="Int64"))
+    table.insert(0, "filename", filenames)
+    return table
+
+
+def write_table(f, table, header):
+    f.write(table.to_csv(index=False, header=header).encode("utf-8"))
+
+
+def export_label_csv(store, dataset, path, columns, label_runs, radio_groups, strategy=None,
+                     include_unlabeled=True, chunk_rows=CHUNK_ROWS):
+    """データセットのフレーム単位のラベルCSVを、フレーム一覧のチャンクごとに書き込みます。
+
+    `label_runs` は作業者ごとの {ラベル名: `LabelRuns`} のリストです。複数の作業者を渡した場合は
+    `strategy` で統合します。書き込んだ行数と、票が割れた行数（グループごと）を返します。
+    """
+    empty = LabelRuns()
+
+    def chunk_values(start, stop):
+        votes = np.zeros((stop - start, len(columns)), dtype=np.int32)
+        labeled = np.zeros(stop - start, dtype=bool)
+        for runs in label_runs:
+            for j, name in enumerate(columns):
+                votes[:, j] += runs.get(name, empty).slice_array(start, stop)
+            if len(label_runs) == 1:
+                # アプリの出力と同じく、設定に無いラベルが付与されたフレームもラベル付きとして扱う
+                for label in runs.values():
+                    if len(label):
+                        labeled |= label.slice_array(start, stop).astype(bool)
+        if len(label_runs) == 1:
+            return votes.astype(np.uint8), labeled, {}
+        values, ties = resolve_votes(votes, len(label_runs), columns, radio_groups, strategy)
+        return values, values.any(axis=1), ties
+
+    # 出力する行に動画のフレームがある場合だけ `frame` 列を加える（アプリの出力と同じ）ため、先に確認する
+    with_frame_column = False
+    start = 0
+    for frames in store.iter_frames(dataset, chunk_rows):
+        keep = np.ones(len(frames), dtype=bool) if include_unlabeled else chunk_values(start, start + len(frames))[1]
+        if any(split_frame_key(key)[1] is not None for key, kept in zip(frames, keep) if kept):
+            with_frame_column = True
+            break
+        start += len(frames)
+
+    rows, ties = 0, {}
+    with atomic_output(path) as f:
+        start = 0
+        for frames in store.iter_frames(dataset, chunk_rows):
+            stop = start + len(frames)
+            values, labeled, chunk_ties = chunk_values(start, stop)
+            add_counts(ties, chunk_ties)
+            sources = [split_frame_key(key) for key in frames]
+            if not include_unlabeled:
+                sources = [source for source, kept in zip(sources, labeled) if kept]
+                values = values[labeled]
+            table = frame_table([os.path.basename(p) for p, _ in sources], [n for _, n in sources], columns, values, with_frame_column)
+            write_table(f, table, header=start == 0)
+            rows += len(table)
+            start = stop
+        if start == 0:
+            write_table(f, frame_table([], [], columns, np.zeros((0, len(columns)), dtype=np.uint8), False), header=True)
+    return rows, ties
+
+
+# --- データセットごとの処理（ワーカープロセスで実行） ---
+def run_dataset_job(job):
+    """1つのデータセットに `job["command"]` の処理を行い、結果を辞書で返します。
+
+    状態ストアの開閉・フォルダの読み直し・所要時間とエラーの記録はここでまとめて行います。
+    """
+    start_time = time.perf_counter()
+    result = {"dataset": job["dataset"], "status": "ok"}
+    store = StateStore(job["state_db"])
+    try:
+        if job.get("rescan"):
+            result["rescanned"] = rescan_dataset(store, job["dataset"], job["scan_index"])
+        result["frames"] = store.frame_count(job["dataset"])
+        if not result["frames"]:
+            result["status"] = "no_frames"
+        else:
+            DATASET_COMMANDS[job["command"]](store, job, result)
+    except Exception as e:
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+    finally:
+        store.close()
+    result["elapsed_s"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+def job_annotators(store, job):
+    """処理する作業者の一覧を返します（`--all-annotators` ではデータセットに状態を保存した全作業者）。"""
+    if job["all_annotators"]:
+        return store.annotators(job["dataset"]) or [DEFAULT_ANNOTATOR]
+    return job["annotators"]
+
+
+def export_dataset(store, job, result):
+    """データセットのラベルをCSVに出力し、ラジオボタンの排他の違反があれば結果に加えます。"""
+    dataset = job["dataset"]
+    annotators = job_annotators(store, job)
+    config = dataset_label_config(store, dataset, annotators, job["labels_config"])
+    _, radio_groups = parse_label_lines(config)
+    runs = {annotator: load_runs(store, dataset, annotator) for annotator in annotators}
+    columns = label_columns(config) or sorted({label for annotator_runs in runs.values() for label in annotator_runs})
+
+    name = output_name(dataset, job["data_root"])
+    suffix = ".csv.gz" if job["gzip"] else ".csv"
+    if job["merge"] or len(annotators) == 1:
+        targets = [(Path(job["output_dir"]) / (name + suffix), annotators)]
+    else:
+        targets = [(Path(job["output_dir"]) / f"{name}.{annotator}{suffix}", [annotator]) for annotator in annotators]
+
+    result["annotators"] = annotators
+    result["outputs"] = []
+    for path, voters in targets:
+        rows, ties = export_label_csv(
+            store, dataset, path, columns, [runs[annotator] for annotator in voters], radio_groups,
+            strategy=job["merge"], include_unlabeled=job["include_unlabeled"], chunk_rows=job["chunk_rows"],
+        )
+        result["outputs"].append({"path": str(path), "rows": rows, **({"ties": ties} if ties else {})})
+
+    violations = {annotator: exclusivity_violations(runs[annotator], radio_groups) for annotator in annotators}
+    violations = {annotator: groups for annotator, groups in violations.items() if groups}
+    if violations:
+        result["violations"] = violations
+
+
+def validate_dataset(store, job, result):
+    """データセットのラベルのラジオボタンの排他の違反と、設定に無いラベルを結果に加えます。"""
+    dataset = job["dataset"]
+    annotators = job_annotators(store, job)
+    config = dataset_label_config(store, dataset, annotators, job["labels_config"])
+    _, radio_groups = parse_label_lines(config)
+    columns = set(label_columns(config))
+    result["annotators"] = annotators
+    for annotator in annotators:
+        runs = load_runs(store, dataset, annotator)
+        violations = exclusivity_violations(runs, radio_groups)
+        if violations:
+            result.setdefault("violations", {})[annotator] = violations
+        unknown = sorted(label for label, label_runs in runs.items() if len(label_runs) and columns and label not in columns)
+        if unknown:
+            result.setdefault("unknown_labels", {})[annotator] = unknown
+    if "violations" in result:
+        result["status"] = "invalid"
+
+
+DATASET_COMMANDS = {"export": export_dataset, "validate": validate_dataset}
+
+
+def run_jobs(function, jobs, workers):
+    """ジョブをワーカープロセスで並列に実行し、完了した順に結果を返します。
+
+    予約するジョブはワーカー数の2倍までに抑えます。`workers` が0の場合はこのプロセスで順に実行します。
+    """
+    if workers <= 0:
+        for job in jobs:
+            yield function(job)
+        return
+    # ワーカーは状態ストアの書き込みスレッドを持つため、forkではなくspawnで起動する
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending = set()
+        for job in jobs:
+            pending.add(pool.submit(function, job))
+            while len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+# --- CSVの統合 ---
+MERGE_SCHEMA = """
+CREATE TABLE keys (key TEXT PRIMARY KEY, seq INTEGER NOT NULL, filename TEXT NOT NULL, frame INTEGER);
+CREATE TABLE votes (key TEXT NOT NULL, source INTEGER NOT NULL, bits BLOB NOT NULL, PRIMARY KEY (key, source)) WITHOUT ROWID;
+"""
+
+
+def merge_label_csvs(inputs, output, config_lines=None, strategy="majority", include_unlabeled=True,
+                     chunk_rows=CHUNK_ROWS, work_dir=None):
+    """複数の作業者が出力したラベルCSVを、フレームごとの投票で1つのCSVに統合します。
+
+    行は `filename`（と動画の `frame`）で照合し、最初に現れた順に出力します。入力にその行が無い作業者は
+    どのラベルにも投票しなかったものとして数えます（未ラベルの行を省いたCSVも統合できる）。
+    同じ入力に同じ行が複数ある場合は後の行を採用します。行の照合は作業用のSQLiteファイルで行うため、
+    メモリ使用量は入力の大きさではなくチャンクの大きさで決まります。統合結果の集計を返します。
+    """
+    _, radio_groups = parse_label_lines(config_lines or [])
+    headers = [pd.read_csv(path, nrows=0).columns for path in inputs]
+    for path, header in zip(inputs, headers):
+        if "filename" not in header:
+            raise ValueError(f"CSVファイルに 'filename' カラムが見つかりません: {path}")
+    # ラベル列は設定の順に並べ、設定に無い列は入力に現れた順に後ろに加える
+    columns = label_columns(config_lines or [])
+    for header in headers:
+        columns.extend(column for column in header if column not in ("filename", FRAME_COLUMN) and column not in columns)
+    with_frame_column = any(FRAME_COLUMN in header for header in headers)
+
+    summary = {"output": str(output), "strategy": strategy, "inputs": [], "rows": 0}
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "merge.db"), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(MERGE_SCHEMA)
+        seq = 0
+        for source, path in enumerate(inputs):
+            stats = {"path": str(path), "rows": 0}
+            invalid = {}
+            for chunk in pd.read_csv(path, chunksize=chunk_rows, dtype={"filename": str}):
+                filenames = chunk["filename"].fillna("")
+                keys = filenames
+                frame_numbers = pd.array([pd.NA] * len(chunk), dtype="Int64")
+                if FRAME_COLUMN in chunk:
+                    frame_numbers = pd.to_numeric(chunk[FRAME_COLUMN], errors="coerce").astype("Int64")
+                    keys = keys.where(frame_numbers.isna(), keys + "#" + frame_numbers.astype(str))
+                values = np.zeros((len(chunk), len(columns)), dtype=np.uint8)
+                for j, column in enumerate(columns):
+                    if column in chunk:
+                        values[:, j] = chunk[column].to_numpy() == 1
+                add_counts(invalid, row_violations(values, columns, radio_groups))
+                bits = np.packbits(values, axis=1, bitorder="little")
+                frames = [None if pd.isna(number) else int(number) for number in frame_numbers]
+
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO keys (key, seq, filename, frame) VALUES (?, ?, ?, ?)",
+                    zip(keys.tolist(), range(seq, seq + len(chunk)), filenames.tolist(), frames),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO votes (key, source, bits) VALUES (?, ?, ?)",
+                    zip(keys.tolist(), repeat(source), map(bytes, bits)),
+                )
+                conn.execute("COMMIT")
+                seq += len(chunk)
+                stats["rows"] += len(chunk)
+            if invalid:
+                stats["invalid_rows"] = invalid
+            summary["inputs"].append(stats)
+        conn.execute("CREATE INDEX keys_seq ON keys (seq)")
+
+        ties = {}
+        byte_count = (len(columns) + 7) // 8 or 1
+
+        def write_rows(f, rows, header):
+            # 同じ行（seq）の票をまとめて数える
+            seqs = np.array([row[0] for row in rows], dtype=np.int64)
+            starts = np.flatnonzero(np.r_[True, seqs[1:] != seqs[:-1]])
+            bits = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.uint8).reshape(len(rows), byte_count)
+            marks = np.unpackbits(bits, axis=1, count=len(columns), bitorder="little").astype(np.int32)
+            votes = np.add.reduceat(marks, starts, axis=0) if len(columns) else np.zeros((len(starts), 0), dtype=np.int32)
+            values, chunk_ties = resolve_votes(votes, len(inputs), columns, radio_groups, strategy)
+            add_counts(ties, chunk_ties)
+            firsts = [rows[i] for i in starts]
+            if not include_unlabeled:
+                labeled = values.any(axis=1)
+                firsts = [row for row, kept in zip(firsts, labeled) if kept]
+                values = values[labeled]
+            table = frame_table([row[1] for row in firsts], [row[2] for row in firsts], columns, values, with_frame_column)
+            write_table(f, table, header)
+            return len(table)
+
+        with atomic_output(output) as f:
+            cursor = conn.execute(
+                "SELECT k.seq, k.filename, k.frame, v.bits FROM keys k JOIN votes v ON v.key = k.key ORDER BY k.seq"
+            )
+            header = True
+            carry = []
+            while True:
+                fetched = cursor.fetchmany(chunk_rows)
+                rows, carry = carry + fetched, []
+                if not rows:
+                    break
+                if fetched:
+                    # 最後の行の票は次のチャンクに続く場合があるため持ち越す
+                    last = rows[-1][0]
+                    cut = len(rows)
+                    while cut > 0 and rows[cut - 1][0] == last:
+                        cut -= 1
+                    rows, carry = rows[:cut], rows[cut:]
+                if rows:
+                    summary["rows"] += write_rows(f, rows, header)
+                    header = False
+            if header:
+                write_table(f, frame_table([], [], columns, np.zeros((0, len(columns)), dtype=np.uint8), with_frame_column), header=True)
+        conn.close()
+    if ties:
+        summary["ties"] = ties
+    return summary
+
+
+# --- コマンドライン ---
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def emit(result):
+    """処理結果をJSONの1行として標準出力に書き込みます（パイプラインで逐次読み取れるよう、すぐに書き出す）。"""
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--labels", help="ラベル設定ファイル（省略時はデータセットごとに保存された設定）")
+    common.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="1チャンクあたりの行数（メモリ使用量の目安）")
+
+    datasets = argparse.ArgumentParser(add_help=False, parents=[common])
+    datasets.add_argument("folders", nargs="*", help="データフォルダからの相対パス、または絶対パス")
+    datasets.add_argument("--all", action="store_true", help="状態ファイルにフレーム一覧が保存されている全データセットを処理する")
+    datasets.add_argument("--annotators", nargs="+", default=[DEFAULT_ANNOTATOR], help="処理する作業者")
+    datasets.add_argument("--all-annotators", action="store_true", help="データセットに状態を保存した全作業者を処理する")
+    datasets.add_argument("--state-db", default=STATE_DB_FILE, help="アプリの状態ファイル")
+    datasets.add_argument("--scan-index", default=SCAN_INDEX_FILE, help="アプリのスキャン索引（`--rescan` で使用）")
+    datasets.add_argument("--data-root", default=DATA_ROOT_PATH, help="データフォルダ（相対パスの基準）")
+    datasets.add_argument("--rescan", action="store_true", help="フォルダを読み直してフレーム一覧を更新してから処理する")
+    datasets.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列に処理するプロセス数（0でこのプロセスで順に処理）")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", parents=[datasets], help="データセットごとにフレーム単位のCSVを出力する")
+    export.add_argument("--output-dir", required=True, help="出力先のディレクトリ")
+    export.add_argument("--merge", choices=list(MERGE_STRATEGIES), help="複数の作業者のラベルを投票で統合して1つのCSVに出力する")
+    export.add_argument("--labeled-only", action="store_true", help="ラベルが付与されていないフレームを出力しない")
+    export.add_argument("--gzip", action="store_true", help="gzip圧縮したCSV（.csv.gz）を出力する")
+    export.add_argument("--strict", action="store_true", help="ラジオボタンの排他の違反があれば終了コード1で終了する")
+    commands.add_parser("validate", parents=[datasets], help="ラジオボタンの排他の違反と設定に無いラベルを検出する")
+    merge = commands.add_parser("merge", parents=[common], help="複数の作業者のCSVを投票で1つのCSVに統合する")
+    merge.add_argument("output", help="統合したCSVの出力先（.gzで終わる場合はgzip圧縮）")
+    merge.add_argument("inputs", nargs="+", help="作業者ごとのCSV")
+    merge.add_argument("--strategy", choices=list(MERGE_STRATEGIES), default="majority", help="ラベルを付与するのに必要な票数の決め方")
+    merge.add_argument("--labeled-only", action="store_true", help="統合後にラベルが付与されていない行を出力しない")
+    merge.add_argument("--strict", action="store_true", help="入力にラジオボタンの排他の違反があれば終了コード1で終了する")
+
+    args = parser.parse_args(argv)
+    if args.command != "merge" and not args.all and not args.folders:
+        parser.error("処理するフォルダを指定するか、--all を指定してください。")
+    # 存在しない状態ファイルを開くと空の状態ファイルが作成され、何も処理せずに成功してしまう
+    if args.command != "merge" and not os.path.isfile(args.state_db):
+        parser.error(f"状態ファイルが見つかりません: {args.state_db}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config_lines = read_label_config(args.labels) if args.labels else None
+
+    if args.command == "merge":
+        summary = merge_label_csvs(
+            args.inputs, args.output, config_lines, strategy=args.strategy,
+            include_unlabeled=not args.labeled_only, chunk_rows=args.chunk_rows,
+        )
+        emit(summary)
+        invalid = any("invalid_rows" in stats for stats in summary["inputs"])
+        return 1 if args.strict and invalid else 0
+
+    if args.all:
+        store = StateStore(args.state_db)
+        datasets = store.datasets()
+        store.close()
+        if not datasets:
+            log(f"状態ファイル {args.state_db} にフレーム一覧が保存されているデータセットがありません。")
+            return 1
+    else:
+        datasets = [resolve_dataset(folder, args.data_root) for folder in args.folders]
+    jobs = [{
+        "command": args.command,
+        "dataset": dataset,
+        "state_db": args.state_db,
+        "scan_index": args.scan_index,
+        "data_root": args.data_root,
+        "rescan": args.rescan,
+        "annotators": args.annotators,
+        "all_annotators": args.all_annotators,
+        "labels_config": config_lines,
+        "chunk_rows": args.chunk_rows,
+        "output_dir": getattr(args, "output_dir", None),
+        "merge": getattr(args, "merge", None),
+        "include_unlabeled": not getattr(args, "labeled_only", False),
+        "gzip": getattr(args, "gzip", False),
+    } for dataset in datasets]
+
+    log(f"{len(jobs)}件のデータセットを処理します（{max(args.workers, 1)}プロセス）。")
+    counts = {"ok": 0, "error": 0, "no_frames": 0, "invalid": 0, "violations": 0}
+    for result in run_jobs(run_dataset_job, jobs, args.workers):
+        emit(result)
+        counts[result["status"]] += 1
+        counts["violations"] += "violations" in result
+    log(
+        f"完了: 成功 {counts['ok'] + counts['invalid']}件, エラー {counts['error']}件, "
+        f"フレーム一覧なし {counts['no_frames']}件, 排他の違反 {counts['violations']}件"
+    )
+    # 明示的に指定したフォルダにフレームが無い場合は、指定の誤りとして失敗にする
+    failed = counts["error"] > 0 or (not args.all and counts["no_frames"] > 0)
+    if args.command == "validate" or getattr(args, "strict", False):
+        failed = failed or counts["violations"] > 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import json
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+# 作成済みのデータセットを再利用するための目印（ドットで始まるためスキャン対象外）
+MARKER_FILE = ".bench_dataset.json"
+
+
+# --- ラベル設定 ---
+def make_label_config(checkbox_count=16, radio_groups=2, radio_options=4):
+    """チェックボックスのラベルと `## グループ名` のラジオボタンを含むラベル設定の行を返します。"""
+    lines = [f"label_{i:03d}" for i in range(checkbox_count)]
+    for group in range(radio_groups):
+        lines.append(f"## group_{group}")
+        lines.extend(f"group_{group}_option_{option}" for option in range(radio_options))
+    return lines
+
+
+def _is_complete(folder, params):
+    try:
+        with open(folder / MARKER_FILE, encoding="utf-8") as f:
+            return json.load(f) == params
+    except (OSError, ValueError):
+        return False
+
+
+def _mark_complete(folder, params):
+    with open(folder / MARKER_FILE, "w", encoding="utf-8") as f:
+        json.dump(params, f)
+
+
+# --- 連番画像 ---
+def make_image_folder(folder, frame_count, image_size=(1280, 720), files_per_dir=10_000, seed=0):
+    """`frame_<番号>.jpg` の連番画像を含むフォルダを作成し、フレームのパスを自然順で返します。
+
+    画像は1枚だけエンコードし、残りはハードリンク（できない場合はコピー）で作成するため、
+    100万フレームでも短時間で作成できます。ファイル名はゼロ埋めしないため、自然順ソートも計測対象になります。
+    `files_per_dir` ごとにサブフォルダへ分けます。
+    """
+    folder = Path(folder)
+    params = {"kind": "images", "frame_count": frame_count, "image_size": list(image_size), "files_per_dir": files_per_dir}
+    paths = [
+        str(folder / f"part_{i // files_per_dir}" / f"frame_{i}.jpg")
+        for i in range(frame_count)
+    ]
+    if _is_complete(folder, params):
+        return paths
+
+    folder.mkdir(parents=True, exist_ok=True)
+    width, height = image_size
+    rng = np.random.default_rng(seed)
+    # ノイズ画像はJPEGのデコード負荷が実際の映像に近い
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (0, 0), 3)
+    source = folder / "source.jpg.tmp"
+    source.write_bytes(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+
+    for path in paths:
+        path = Path(path)
+        if path.exists():
+            continue
+        path.parent.mkdir(exist_ok=True)
+        try:
+            os.link(source, path)
+        except OSError:
+            path.write_bytes(source.read_bytes())
+    source.unlink()
+    _mark_complete(folder, params)
+    return paths
+
+
+# --- 動画 ---
+def make_video(path, frame_count, image_size=(640, 360), fps=30.0, seed=0):
+    """動く図形を描いた動画（mp4）を作成します。"""
+    path = Path(path)
+    params = {"kind": "video", "frame_count": frame_count, "image_size": list(image_size), "fps": fps}
+    if path.exists() and _is_complete(path.parent, params):
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    width, height = image_size
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"動画ファイルを作成できませんでした: {path}")
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8), (0, 0), 5)
+    try:
+        for n in range(frame_count):
+            frame = background.copy()
+            x = int((n * 7) % width)
+            cv2.rectangle(frame, (x, height // 3), (min(width - 1, x + width // 8), 2 * height // 3), (0, 0, 255), -1)
+            cv2.putText(frame, str(n), (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+            writer.write(frame)
+    finally:
+        writer.release()
+    _mark_complete(path.parent, params)
+    return path
+
+
+# --- ラベルCSV ---
+def make_label_csv(path, frames, config_lines, density=0.1, seed=0, chunk_rows=100_000):
+    """アプリの出力と同じ形式（`filename` + ラベル列の0/1）のラベルCSVを作成します。
+
+    チェックボックスのラベルはそれぞれ `density` の確率で付与し、
+    ラジオボタンの各グループは `density` の確率で選択肢を1つだけ付与します。
+    """
+    from label_model import parse_label_lines
+
+    checkbox_labels, radio_groups = parse_label_lines(config_lines)
+    columns = checkbox_labels + [option for options in radio_groups.values() for option in options]
+    rng = np.random.default_rng(seed)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for start in range(0, len(frames), chunk_rows):
+            names = [os.path.basename(frame) for frame in frames[start:start + chunk_rows]]
+            values = (rng.random((len(names), len(checkbox_labels))) < density).astype(np.uint8)
+            table = pd.DataFrame(values, columns=checkbox_labels)
+            for options in radio_groups.values():
+                chosen = rng.integers(0, len(options), size=len(names))
+                selected = rng.random(len(names)) < density
+                for j, option in enumerate(options):
+                    table[option] = ((chosen == j) & selected).astype(np.uint8)
+            table.insert(0, "filename", names)
+            table[["filename", *columns]].to_csv(f, index=False, header=start == 0)
+        if not frames:
+            pd.DataFrame(columns=["filename", *columns]).to_csv(f, index=False)
+    return path
@@ -0,0 +1,617 @@
+"""ラベリングアプリの主要な処理のベンチマークです。
+
+合成データセット（連番画像・動画・ラベル設定・ラベルCSV）を作成し、
+データセットの大きさごとに別プロセスで以下を計測して結果をJSONで出力します。
+
+- フォルダのスキャン（初回・2回目・再起動後）
+- StreamlitのAppTestによるアプリの実行（初回表示・フォルダ読み込み・再実行・フレーム移動）
+- save_state / load_state、load_labels_from_csv、ラベル結果の出力、範囲ラベリング、apply_fixed_labels
+- タイムラインの集計の作成・更新と描画
+- 再生のシミュレーション（image_viewerを再生速度どおりの間隔で呼び出す）と再生停止時のラベル適用
+- 動画の索引作成とフレームの読み込み
+- シーン検出の特徴量の計算（プロセスプール）と、境界の検出
+
+使い方:
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 --output bench_results.json
+    python benchmarks/run_benchmarks.py --baseline bench_results.json --output bench_new.json
+
+`--baseline` に以前の結果ファイルを指定すると中央値を比較し、
+許容範囲（`--tolerance`）を超えて遅くなった項目があれば終了コード1で終了します。
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCH_DIR.parent
+APP_PATH = REPO_ROOT / "labeling_app.py"
+for path in (str(REPO_ROOT), str(BENCH_DIR)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from background_jobs import default_workers
+from datasets import make_image_folder, make_label_config, make_label_csv, make_video
+
+# 比較時に、これより小さい差（秒）は誤差として扱う
+MIN_DELTA_S = 0.002
+
+
+# --- 計測の補助 ---
+def summarize(samples, **extra):
+    """計測値（秒）のリストから最小・中央値・平均・最大を求めます。"""
+    return {
+        "runs": len(samples),
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.fmean(samples),
+        "max_s": max(samples),
+        **extra,
+    }
+
+
+def measure(func, repeat, setup=None):
+    """`setup` を実行してから `func` の処理時間を計測する操作を `repeat` 回繰り返します。"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Linuxではキロバイト、macOSではバイト単位
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def fresh_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+    return path
+
+
+# --- データセットの配置 ---
+def dataset_paths(args, case):
+    workdir = Path(args.workdir)
+    kind, count = case.split(":")
+    return {
+        "data_root": workdir / "data",
+        "folder": workdir / "data" / f"{kind}_{count}",
+        "csv": workdir / "csv" / f"labels_{count}.csv",
+        "run_dir": workdir / "runs" / f"{kind}_{count}",
+    }
+
+
+def prepare_datasets(args):
+    """計測に使う合成データセットを作成します（作成済みのものは再利用します）。"""
+    config = make_label_config(args.checkbox_labels, args.radio_groups, args.radio_options)
+    for size in args.sizes:
+        paths = dataset_paths(args, f"images:{size}")
+        log(f"データセットを準備しています: {size:,}フレーム")
+        frames = make_image_folder(paths["folder"], size, args.image_size)
+        if not paths["csv"].exists():
+            make_label_csv(paths["csv"], frames, config, density=args.label_density)
+    if args.video_frames:
+        paths = dataset_paths(args, f"video:{args.video_frames}")
+        log(f"動画を準備しています: {args.video_frames:,}フレーム")
+        make_video(paths["folder"] / "synthetic.mp4", args.video_frames)
+
+
+# --- 連番画像のベンチマーク（ワーカープロセス） ---
+def bench_scan(args, paths, results):
+    from scan_index import IMAGE_EXTENSIONS, ScanIndex
+    from video_source import VIDEO_EXTENSIONS
+
+    extensions = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+    folder = str(paths["folder"])
+    scan_dir = fresh_dir(paths["run_dir"] / "scan")
+
+    samples = []
+    for rep in range(args.repeat):
+        index = ScanIndex(scan_dir / f"cold_{rep}.db")
+        start = time.perf_counter()
+        files = index.scan(folder, extensions)
+        samples.append(time.perf_counter() - start)
+    if len(files) != args.size:
+        raise RuntimeError(f"スキャン結果のフレーム数が一致しません: {len(files)} != {args.size}")
+    results["scan_cold"] = summarize(samples)
+    results["scan_warm"] = measure(lambda: index.scan(folder, extensions), args.repeat)
+
+    def restart_scan():
+        ScanIndex(scan_dir / "cold_0.db").scan(folder, extensions)
+    results["scan_restart"] = measure(restart_scan, args.repeat)
+    return files
+
+
+def bench_apptest(args, paths, results):
+    """AppTestでアプリのスクリプト全体を実行した場合の処理時間を計測します。"""
+    from streamlit.testing.v1 import AppTest
+
+    os.chdir(fresh_dir(paths["run_dir"] / "apptest"))
+    at = AppTest.from_file(str(APP_PATH), default_timeout=args.apptest_timeout)
+
+    def run(action):
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(f"アプリの実行中に例外が発生しました: {at.exception[0].message}")
+        return elapsed
+
+    results["apptest_first_run"] = summarize([run(at.run)])
+
+    at.selectbox(key="folder_selector").set_value(paths["folder"].name)
+    open_button = next(b for b in at.sidebar.button if b.label == "このフォルダでラベリング開始")
+    results["apptest_open_folder"] = summarize([run(open_button.click().run)])
+    if at.session_state["image_files"] is None or len(at.session_state["image_files"]) != args.size:
+        raise RuntimeError("AppTestでフォルダを読み込めませんでした。")
+
+    results["apptest_rerun"] = summarize([run(at.run) for _ in range(args.repeat)])
+    next_button = next(b for b in at.button if b.label == "次へ ⏭️")
+    results["apptest_next_frame"] = summarize([run(next_button.click().run) for _ in range(args.repeat)])
+
+
+def bench_direct(args, paths, frames, results):
+    """アプリの関数を直接呼び出して処理時間を計測します。"""
+    import labeling_app as app
+    from label_io import EXPORT_FORMATS
+    from label_model import LabelCoverage, LabelIntervals
+
+    os.chdir(fresh_dir(paths["run_dir"] / "direct"))
+    state = app.st.session_state
+    config = make_label_config(args.checkbox_labels, args.radio_groups, args.radio_options)
+    label_names = [line for line in config if not line.startswith("##")]
+    rng = np.random.default_rng(0)
+
+    app.initialize_session_state()
+    state.labels_config = config
+    app.parse_label_config()
+    state.selected_path = str(paths["folder"])
+    state.image_files = frames
+    state.labels_data = LabelIntervals(frames)
+    store = app.get_state_store()
+
+    # --- 保存・読み込み ---
+    def reset_saved():
+        store.clear(state.annotator)
+        store.replace_frames(state.selected_path, [])
+        app.forget_saved_state()
+
+    def save():
+        app.save_state()
+        store.flush()
+
+    def save_full():
+        # フォルダ読み込み時と同じく、フレーム一覧の置き換えと状態の保存
+        store.replace_frames(state.selected_path, frames)
+        save()
+    results["state_save_full"] = measure(save_full, args.repeat, setup=reset_saved)
+
+    def import_csv():
+        with open(paths["csv"], "rb") as f:
+            app.load_labels_from_csv(f)
+        store.flush()
+    results["csv_import"] = measure(import_csv, args.repeat, setup=lambda: setattr(state, "labels_data", LabelIntervals(frames)))
+    if len(state.labels_data) == 0:
+        raise RuntimeError("ラベルCSVを読み込めませんでした。")
+
+    def edit_labels():
+        model = state.labels_data
+        for position in rng.integers(0, len(frames), size=args.edits):
+            model.toggle(int(position), model.mask([label_names[0]]))
+    results["state_save_incremental"] = measure(save, args.repeat, setup=edit_labels)
+    results["state_save_incremental"]["edits"] = args.edits
+
+    def reset_session():
+        for key in list(state.keys()):
+            del state[key]
+        app.initialize_session_state()
+    results["state_load"] = measure(app.load_state, args.repeat, setup=reset_session)
+    if len(state.image_files) != len(frames):
+        raise RuntimeError("保存した状態を復元できませんでした。")
+    app.parse_label_config()
+
+    # --- 出力 ---
+    for export_format in EXPORT_FORMATS:
+        name = "export_" + re.sub(r"\W+", "_", export_format.lower()).strip("_")
+        callback = lambda: app.make_export_callback(state.image_files, state.labels_data, label_names, True, export_format, {})()
+        try:
+            results[name] = measure(callback, args.repeat)
+            results[name]["bytes"] = len(callback())
+        except ImportError as e: # Parquetの出力にはpyarrowが必要
+            results[name] = {"error": str(e)}
+
+    # --- 範囲ラベリング ---
+    def label_ranges():
+        model = state.labels_data
+        for start in rng.integers(0, len(frames), size=args.edits):
+            stop = min(len(frames), int(start) + int(rng.integers(1, 1000)))
+            model.update_range(int(start), stop, add=model.mask([label_names[1]]), clear=model.mask([label_names[2]]))
+    results["label_range"] = measure(label_ranges, args.repeat)
+    results["label_range"]["ranges"] = args.edits
+
+    # --- タイムライン ---
+    model = state.labels_data
+    results["timeline_coverage_build"] = measure(lambda: LabelCoverage(model, app.TIMELINE_BLOCKS), args.repeat)
+    model.coverage(app.TIMELINE_BLOCKS)
+    # 集計の作成後は、ラベルの変更のたびに変更箇所のブロックだけを数え直す（以降の計測も集計の更新を含む）
+    results["timeline_coverage_update"] = measure(edit_labels, args.repeat)
+    results["timeline_coverage_update"]["edits"] = args.edits
+    results["timeline_render"] = measure(app.timeline, args.repeat)
+
+    # --- 固定ラベル ---
+    state.fixed_labels = {state.checkbox_labels[0], *[options[0] for options in list(state.radio_groups.values())[:1]]}
+    fixed_frames = min(args.fixed_label_frames, len(frames))
+
+    def apply_fixed():
+        for position in range(fixed_frames):
+            state.current_frame_index = position
+            app.apply_fixed_labels()
+    results["apply_fixed_labels"] = measure(apply_fixed, args.repeat)
+    results["apply_fixed_labels"]["frames"] = fixed_frames
+    results["apply_fixed_labels"]["per_call_us"] = results["apply_fixed_labels"]["median_s"] / fixed_frames * 1e6
+
+    # --- 再生 ---
+    bench_playback(args, app, state, results)
+
+
+def bench_playback(args, app, state, results):
+    """再生中の画像表示（image_viewer）を再生速度どおりの間隔で呼び出します。
+
+    再生位置は時刻から計算されるため、描画が間に合った場合に1フレームずつ進むよう
+    再生開始時刻を毎回置き直します。描画の間隔より処理時間が長いフレームを遅延として数えます。
+    """
+    frame_cache = app.get_frame_cache()
+    frame_cache.clear()
+    total = len(state.image_files)
+    ticks = min(args.playback_frames, total - 1)
+    interval = 1.0 / args.playback_fps
+
+    state.current_frame_index = 0
+    state.play_speed = args.playback_fps
+    app.start_playback()
+    samples = []
+    deadline = time.perf_counter()
+    for tick in range(ticks):
+        state.play_anchor_time = time.perf_counter() - (tick + 0.5) / state.play_speed
+        start = time.perf_counter()
+        app.image_viewer()
+        samples.append(time.perf_counter() - start)
+        deadline += interval
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+    stats = frame_cache.stats()
+    results["playback_tick"] = summarize(
+        samples, frames=ticks, fps=args.playback_fps,
+        p95_s=float(np.percentile(samples, 95)),
+        late_ticks=sum(1 for sample in samples if sample > interval),
+        cache_hit_rate=stats["hit_rate"],
+    )
+
+    start = time.perf_counter()
+    app.stop_playback()
+    results["playback_stop"] = summarize([time.perf_counter() - start], frames=ticks)
+
+    # データセットの最後まで再生してから停止した場合（固定ラベルを全フレームに適用）
+    def play_to_end():
+        state.is_playing = True
+        state.play_range_start = 0
+        state.current_frame_index = total - 1
+    results["playback_stop_full_range"] = measure(app.stop_playback, args.repeat, setup=play_to_end)
+
+
+def bench_proxy(args, paths, frames, results):
+    """表示用画像（プロキシ）をプロセスプールで作成する時間と、作成済みの画像を読み込む時間を計測します。"""
+    from frame_cache import load_display_frame
+    from proxy_cache import ProxyCache
+
+    count = min(args.proxy_frames, len(frames))
+    if not count:
+        return
+    targets = frames[:count]
+
+    def generate():
+        proxy_cache = ProxyCache(fresh_dir(paths["run_dir"] / "proxy_bench"), workers=args.proxy_workers)
+        proxy_cache.start("proxy_bench", targets)
+        while proxy_cache.progress()["running"]:
+            time.sleep(0.01)
+        return proxy_cache
+    results["proxy_generate"] = measure(generate, args.repeat)
+    results["proxy_generate"].update(frames=count, workers=args.proxy_workers)
+
+    proxy_cache = generate()
+    results["proxy_read"] = measure(lambda: [proxy_cache.load(frame) for frame in targets], args.repeat)
+    results["proxy_read"]["per_frame_ms"] = results["proxy_read"]["median_s"] / count * 1000
+    # 比較用: プロキシを使わずに元画像をデコード・縮小する場合
+    results["proxy_none_decode"] = measure(lambda: [load_display_frame(frame, 1280) for frame in targets], args.repeat)
+    results["proxy_none_decode"]["per_frame_ms"] = results["proxy_none_decode"]["median_s"] / count * 1000
+
+
+def wait_scene_analysis(detector, dataset, frames):
+    detector.start(dataset, frames)
+    while detector.progress(dataset)["running"]:
+        time.sleep(0.01)
+    return detector.analysis(dataset)
+
+
+def bench_scene(args, paths, frames, results, prefix="scene"):
+    """シーン検出の特徴量の計算（初回・保存済み）と、境界の検出にかかる時間を計測します。"""
+    from scene_detect import FEATURE_SIZE, SceneAnalysis, SceneDetector, find_boundaries
+
+    count = min(args.scene_frames, len(frames))
+    if count:
+        targets = frames[:count]
+        index_dir = fresh_dir(paths["run_dir"] / f"{prefix}_index")
+        samples = []
+        for rep in range(args.repeat):
+            detector = SceneDetector(index_dir / f"features_{rep}.db", workers=args.proxy_workers)
+            start = time.perf_counter()
+            wait_scene_analysis(detector, "bench", targets)
+            samples.append(time.perf_counter() - start)
+            detector.close()
+        results[f"{prefix}_features"] = summarize(samples, frames=count, workers=args.proxy_workers,
+                                                  per_frame_ms=statistics.median(samples) / count * 1000)
+
+        def cached():
+            detector = SceneDetector(index_dir / "features_0.db", workers=args.proxy_workers)
+            wait_scene_analysis(detector, "bench", targets)
+            detector.close()
+        results[f"{prefix}_features_cached"] = measure(cached, args.repeat)
+
+    if prefix != "scene":
+        return
+    # 全フレーム分の特徴量が届いた状態での、特徴量の追加（1回の計算結果分）と境界の検出
+    rng = np.random.default_rng(0)
+    analysis = SceneAnalysis(frames)
+    batch = 64
+    for offset in range(0, len(frames), 65536):
+        positions = np.arange(offset, min(offset + 65536, len(frames)))
+        analysis.fill(positions, rng.integers(1, 256, size=(len(positions), FEATURE_SIZE), dtype=np.uint8))
+    positions = np.arange(min(batch, len(frames)))
+    features = rng.integers(1, 256, size=(len(positions), FEATURE_SIZE), dtype=np.uint8)
+    results["scene_fill"] = measure(lambda: analysis.fill(positions, features), args.repeat)
+    results["scene_fill"]["frames"] = len(positions)
+    distances = analysis.distances.copy()
+    results["scene_boundaries"] = measure(lambda: find_boundaries(distances, 0.3, 10), args.repeat)
+
+
+# --- 動画のベンチマーク（ワーカープロセス） ---
+def bench_video(args, paths, results):
+    from video_source import VideoLibrary, video_frame_key
+
+    video = str(paths["folder"] / "synthetic.mp4")
+    index_dir = fresh_dir(paths["run_dir"] / "index")
+
+    samples = []
+    for rep in range(args.repeat):
+        library = VideoLibrary(index_dir / f"video_{rep}.db")
+        start = time.perf_counter()
+        library.get_index(video)
+        samples.append(time.perf_counter() - start)
+    results["video_index_build"] = summarize(samples)
+    results["video_index_cached"] = measure(lambda: VideoLibrary(index_dir / "video_0.db").get_index(video), args.repeat)
+
+    frame_count = library.get_index(video).frame_count
+    sequential = min(frame_count, args.playback_frames)
+    results["video_sequential_read"] = measure(
+        lambda: [library.load_display_frame(video_frame_key(video, n), 1280) for n in range(sequential)], args.repeat
+    )
+    results["video_sequential_read"]["per_frame_ms"] = results["video_sequential_read"]["median_s"] / sequential * 1000
+
+    rng = np.random.default_rng(0)
+    targets = rng.integers(0, frame_count, size=args.video_random_reads)
+    samples = []
+    for n in targets:
+        start = time.perf_counter()
+        library.load_display_frame(video_frame_key(video, int(n)), 1280)
+        samples.append(time.perf_counter() - start)
+    results["video_random_read"] = summarize(samples, p95_s=float(np.percentile(samples, 95)))
+
+    bench_scene(args, paths, library.expand([video]), results, prefix="video_scene")
+
+
+def run_worker(args):
+    """1つのデータセットを計測し、結果を `--result-file` に書き込みます。"""
+    paths = dataset_paths(args, args.worker)
+    kind, count = args.worker.split(":")
+    args.size = int(count)
+    fresh_dir(paths["run_dir"])
+    results = {}
+    if kind == "images":
+        frames = bench_scan(args, paths, results)
+        if not args.skip_apptest:
+            bench_apptest(args, paths, results)
+        bench_direct(args, paths, frames, results)
+        bench_proxy(args, paths, frames, results)
+        bench_scene(args, paths, frames, results)
+    else:
+        bench_video(args, paths, results)
+    results["_process"] = {"peak_rss_mb": peak_rss_mb()}
+    with open(args.result_file, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+    return 0
+
+
+# --- 結果の比較・表示 ---
+def is_timing(stats):
+    return isinstance(stats, dict) and "median_s" in stats
+
+
+def compare(results, baseline, tolerance):
+    """ベースラインと中央値を比較し、項目ごとの比率と判定を返します。"""
+    comparison = []
+    for group, cases in results.items():
+        for name, stats in cases.items():
+            base = baseline.get("results", {}).get(group, {}).get(name)
+            if not is_timing(stats) or not is_timing(base):
+                continue
+            delta = stats["median_s"] - base["median_s"]
+            ratio = stats["median_s"] / base["median_s"] if base["median_s"] > 0 else float("inf")
+            if ratio > 1 + tolerance and delta > MIN_DELTA_S:
+                status = "regression"
+            elif ratio < 1 / (1 + tolerance) and -delta > MIN_DELTA_S:
+                status = "improved"
+            else:
+                status = "ok"
+            comparison.append({
+                "group": group, "name": name, "status": status, "ratio": ratio,
+                "median_s": stats["median_s"], "baseline_median_s": base["median_s"],
+            })
+    return comparison
+
+
+def print_report(report):
+    compared = {(row["group"], row["name"]): row for row in report.get("comparison", [])}
+    for group, cases in report["results"].items():
+        print(f"\n[{group}]  peak RSS: {cases.get('_process', {}).get('peak_rss_mb') or 0:.0f} MB")
+        for name, stats in cases.items():
+            if name.startswith("_"):
+                continue
+            if not is_timing(stats):
+                print(f"  {name:<28} {stats.get('error', '')}")
+                continue
+            line = f"  {name:<28} {stats['median_s'] * 1000:>10.1f} ms"
+            row = compared.get((group, name))
+            if row is not None:
+                line += f"  x{row['ratio']:.2f} ({row['status']})"
+            print(line)
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import pandas
+    import streamlit
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "streamlit": streamlit.__version__,
+        "pandas": pandas.__version__,
+        "numpy": np.__version__,
+        "git_commit": commit,
+    }
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ラベリングアプリのベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="計測するフレーム数（例: 10000 100000 1000000）")
+    parser.add_argument("--workdir", default=os.path.join(os.environ.get("TMPDIR", "/tmp"), "labeling-bench"),
+                        help="合成データセットと作業ファイルの置き場所（データセットは再利用されます）")
+    parser.add_argument("--output", default="bench_results.json", help="結果を書き込むJSONファイル")
+    parser.add_argument("--baseline", help="比較対象とする以前の結果JSONファイル")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="中央値がこの割合を超えて遅くなったら劣化とみなす")
+    parser.add_argument("--repeat", type=int, default=3, help="各項目の計測回数")
+    parser.add_argument("--image-size", type=lambda s: tuple(int(v) for v in s.split("x")), default=(1280, 720), help="画像の大きさ（例: 1280x720）")
+    parser.add_argument("--checkbox-labels", type=int, default=16)
+    parser.add_argument("--radio-groups", type=int, default=2)
+    parser.add_argument("--radio-options", type=int, default=4)
+    parser.add_argument("--label-density", type=float, default=0.1, help="ラベルCSVで各ラベルを付与する割合")
+    parser.add_argument("--edits", type=int, default=100, help="差分保存・範囲ラベリングの計測で変更するフレーム数・範囲の数")
+    parser.add_argument("--fixed-label-frames", type=int, default=10_000, help="apply_fixed_labelsを呼び出すフレーム数")
+    parser.add_argument("--playback-frames", type=int, default=150, help="再生をシミュレートするフレーム数")
+    parser.add_argument("--playback-fps", type=float, default=30.0)
+    parser.add_argument("--proxy-frames", type=int, default=200, help="表示用画像の作成を計測するフレーム数（0で省略）")
+    parser.add_argument("--proxy-workers", type=int, default=default_workers(), help="表示用画像を作成するプロセス数")
+    parser.add_argument("--scene-frames", type=int, default=200, help="シーン検出の特徴量の計算を計測するフレーム数（0で省略）")
+    parser.add_argument("--video-frames", type=int, default=900, help="合成動画のフレーム数（0で動画の計測を省略）")
+    parser.add_argument("--video-random-reads", type=int, default=50)
+    parser.add_argument("--skip-apptest", action="store_true", help="AppTestによる計測を省略する")
+    parser.add_argument("--apptest-timeout", type=float, default=600.0)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.workdir = str(Path(args.workdir).resolve())
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        # アプリが合成データセットを読み込むようにし、計測と関係の無いログを抑える
+        os.environ["DATA_ROOT_PATH"] = str(Path(args.workdir) / "data")
+        os.environ.pop("METRICS_PORT", None)
+        os.environ.setdefault("METRICS_LOG_LEVEL", "WARNING")
+        # 表示用画像のバックグラウンド作成は他の計測に影響するため止め、bench_proxyで別に計測する
+        os.environ["PROXY_CACHE_DIR"] = str(dataset_paths(args, args.worker)["run_dir"] / "proxy_cache")
+        os.environ["PROXY_WORKERS"] = "0"
+        os.environ["SCENE_WORKERS"] = "0"
+        # 直接呼び出しではScriptRunContextが無い旨の警告がsession_stateへのアクセスごとに出るため抑える。
+        # 設定の読み込み時にログレベルが `logger.level` で上書きされるため、設定側（環境変数）でも指定する
+        os.environ["STREAMLIT_LOGGER_LEVEL"] = "error"
+        import streamlit.logger
+        streamlit.logger.set_log_level("error")
+        return run_worker(args)
+
+    prepare_datasets(args)
+    cases = [f"images:{size}" for size in args.sizes]
+    if args.video_frames:
+        cases.append(f"video:{args.video_frames}")
+
+    results = {}
+    for case in cases:
+        log(f"計測しています: {case}")
+        result_file = Path(args.workdir) / "runs" / (case.replace(":", "_") + ".json")
+        result_file.parent.mkdir(parents=True, exist_ok=True)
+        # データセットごとに別プロセスで計測する（キャッシュやメモリ使用量が互いに影響しないように）
+        subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), *(argv if argv is not None else sys.argv[1:]),
+             "--worker", case, "--result-file", str(result_file)],
+            check=True,
+        )
+        with open(result_file, encoding="utf-8") as f:
+            results[case.replace(":", "_")] = json.load(f)
+
+    report = {
+        "schema": 1,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": machine_info(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("worker", "result_file", "output", "baseline")},
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare(results, json.load(f), args.tolerance)
+        regressions = [row for row in report["comparison"] if row["status"] == "regression"]
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report)
+    print(f"\n結果を {args.output} に書き込みました。")
+    if regressions:
+        print(f"{len(regressions)}件の項目がベースラインより遅くなりました。", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
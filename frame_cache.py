@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+# --- フレームの読み込み ---
+def encode_display_frame(image, display_width, jpeg_quality=90):
+    """BGR画像を表示サイズに縮小し、JPEGのバイト列に変換します。失敗した場合はNoneを返します。"""
+    height, width = image.shape[:2]
+    if display_width and width > display_width:
+        new_height = max(1, round(height * display_width / width))
+        image = cv2.resize(image, (display_width, new_height), interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    return encoded.tobytes() if ok else None
+
+
+def load_display_frame(path, display_width, jpeg_quality=90):
+    """画像を読み込み、表示サイズに縮小したJPEGのバイト列を返します。"""
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    data = encode_display_frame(image, display_width, jpeg_quality) if image is not None else None
+    if data is None:
+        # OpenCVで読めない形式は元ファイルをそのまま返す（st.imageに任せる）
+        with open(path, "rb") as f:
+            return f.read()
+    return data
+
+
+# --- LRUフレームキャッシュ ---
+class FrameCache:
+    """表示サイズにデコード済みのフレームを保持する、メモリ上限付きのLRUキャッシュです。
+
+    バックグラウンドのスレッドプールで前後のフレームを先読みするため、
+    再生速度がストレージの読み込み速度に左右されにくくなります。
+    """
+
+    def __init__(self, max_bytes, display_width=1280, prefetch_ahead=16, prefetch_behind=4,
+                 workers=4, jpeg_quality=90, loader=None):
+        self.max_bytes = max_bytes
+        self.display_width = display_width
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self.jpeg_quality = jpeg_quality
+        self._loader = loader or load_display_frame
+
+        self._entries = OrderedDict()
+        self._current_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-prefetch")
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_waits = 0
+
+    def _load(self, key):
+        return self._loader(key, self.display_width, self.jpeg_quality)
+
+    def _store(self, key, data):
+        """ロック取得済みの状態で呼び出し、エントリを追加して上限を超えた分を追い出します。"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._current_bytes += size
+        while self._current_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= len(evicted)
+
+    def _prefetch_task(self, key):
+        try:
+            data = self._load(key)
+        except Exception:
+            data = None
+        with self._lock:
+            self._inflight.pop(key, None)
+            if data is not None:
+                self._store(key, data)
+        return data
+
+    def get(self, key):
+        """フレームを取得します。キャッシュに無い場合はその場で読み込みます。"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            future = self._inflight.get(key)
+
+        if future is not None and not future.cancel():
+            # 先読み中のフレームは完了を待つ
+            data = future.result()
+            if data is not None:
+                with self._lock:
+                    self.prefetch_waits += 1
+                return data
+
+        data = self._load(key)
+        with self._lock:
+            self.misses += 1
+            self._inflight.pop(key, None)
+            self._store(key, data)
+        return data
+
+    def prefetch(self, keys):
+        """指定したフレームをバックグラウンドで読み込みます。範囲外になった予約は取り消します。"""
+        wanted = list(dict.fromkeys(keys))
+        wanted_set = set(wanted)
+        with self._lock:
+            for key, future in list(self._inflight.items()):
+                if key not in wanted_set and future.cancel():
+                    del self._inflight[key]
+            for key in wanted:
+                if key in self._entries or key in self._inflight:
+                    continue
+                self._inflight[key] = self._executor.submit(self._prefetch_task, key)
+
+    def prefetch_around(self, frames, index, direction=1, stride=1):
+        """現在位置から再生方向へ数フレーム、逆方向へ数フレームを先読みします。
+
+        再生時にフレームを間引く場合は `stride` おきのフレームだけを先読みします。
+        """
+        if not frames:
+            return
+        step = 1 if direction >= 0 else -1
+        ahead = [index + step * stride * i for i in range(1, self.prefetch_ahead + 1)]
+        behind = [index - step * i for i in range(1, self.prefetch_behind + 1)]
+        total = len(frames)
+        self.prefetch([frames[i] for i in ahead + behind if 0 <= i < total])
+
+    def clear(self):
+        """キャッシュを空にし、未開始の先読みを取り消します。"""
+        with self._lock:
+            for future in self._inflight.values():
+                future.cancel()
+            self._inflight.clear()
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        """ヒット数・ミス数・使用量などの統計情報を返します。"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.prefetch_waits
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefetch_waits": self.prefetch_waits,
+                "hit_rate": (self.hits + self.prefetch_waits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "inflight": len(self._inflight),
+            }
@@ -0,0 +1,155 @@
+import gzip
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from video_source import split_frame_key
+
+# 出力形式ごとの (ファイル名, MIMEタイプ)
+EXPORT_FORMATS = {
+    "CSV": ("labels.csv", "text/csv"),
+    "CSV (gzip)": ("labels.csv.gz", "application/gzip"),
+    "Parquet": ("labels.parquet", "application/vnd.apache.parquet"),
+    "Segments CSV": ("label_segments.csv", "text/csv"),
+}
+# ラベルごとの区間（label, start, end）を出力する形式
+SEGMENT_FORMAT = "Segments CSV"
+# 動画のフレーム番号を出力する列（画像の行は空欄）
+FRAME_COLUMN = "frame"
+# CSVを書き出す際の1チャンクあたりの行数
+EXPORT_CHUNK_ROWS = 100_000
+
+
+# --- ラベル結果の出力 ---
+def export_label_table(frames, model, labels, include_unlabeled=True):
+    """ラベル結果を `filename` + ラベル列の0/1のDataFrameとして返します。
+
+    行はフレーム順（フォルダ読み込み時の並び順）に並べ、ラベル列はラベルごとの
+    区間から列単位でまとめて作成します。動画のフレームを含む場合は `filename` の後に
+    動画内のフレーム番号の `frame` 列を加えます。
+    """
+    frame_array = np.asarray(frames, dtype=object)
+    order = np.arange(len(frame_array))
+    if not include_unlabeled:
+        order = order[model.labeled()]
+
+    dense = model.to_dense(labels)[order]
+    sources = [split_frame_key(key) for key in frame_array[order]]
+    frame_numbers = pd.array([number for _, number in sources], dtype="Int64")
+    table = pd.DataFrame(dense, columns=labels)
+    if (~frame_numbers.isna()).any():
+        table.insert(0, FRAME_COLUMN, frame_numbers)
+    table.insert(0, "filename", [os.path.basename(path) for path, _ in sources])
+    return table
+
+
+def export_segment_table(frames, model, labels):
+    """ラベルが連続して付与されている区間を `label, start, end` のDataFrameとして返します。
+
+    `start`・`end` はフレーム順の位置（0始まり、`end` を含む）で、確認用に
+    両端のファイル名（動画の場合は `ファイル名#フレーム番号`）を加えます。
+    """
+    segments = model.segments(labels)
+    starts = np.array([start for _, start, _ in segments], dtype=np.int64)
+    ends = np.array([stop - 1 for _, _, stop in segments], dtype=np.int64)
+    return pd.DataFrame({
+        "label": [name for name, _, _ in segments],
+        "start": starts,
+        "end": ends,
+        "start_filename": [os.path.basename(frames[i]) for i in starts],
+        "end_filename": [os.path.basename(frames[i]) for i in ends],
+    })
+
+
+def iter_csv_chunks(table, chunk_rows=EXPORT_CHUNK_ROWS):
+    """DataFrameをCSVのバイト列としてチャンクごとに返します（ヘッダは最初のみ）。"""
+    if table.empty:
+        yield table.to_csv(index=False).encode("utf-8")
+        return
+    for start in range(0, len(table), chunk_rows):
+        chunk = table.iloc[start:start + chunk_rows]
+        yield chunk.to_csv(index=False, header=start == 0).encode("utf-8")
+
+
+def export_labels(table, export_format):
+    """ラベル結果のDataFrameを指定した形式のバイト列に変換します。"""
+    if export_format == "Parquet":
+        buffer = io.BytesIO()
+        table.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    buffer = io.BytesIO()
+    if export_format == "CSV (gzip)":
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as gz:
+            for chunk in iter_csv_chunks(table):
+                gz.write(chunk)
+    else:
+        for chunk in iter_csv_chunks(table):
+            buffer.write(chunk)
+    return buffer.getvalue()
+
+
+# --- ラベル結果の読み込み ---
+# CSVを読み込む際の1チャンクあたりの行数
+IMPORT_CHUNK_ROWS = 100_000
+
+
+def import_label_csv(source, frames, model, progress=None, chunk_rows=IMPORT_CHUNK_ROWS):
+    """ラベル結果のCSVをチャンク単位で読み込み、ファイル名で照合してモデルに反映します。
+
+    ファイル名の照合とラベル列の変換はチャンクごとにまとめて行います。
+    同じファイル名の行が複数ある場合は後の行を採用します（フォルダ内で同名の画像が
+    複数ある場合も、パス順で後の画像が対象になります）。
+    `progress` には (読み込んだ行数, 進捗率またはNone) が渡されます。
+    戻り値は読み込み結果の集計です。
+    """
+    header = pd.read_csv(source, nrows=0)
+    if "filename" not in header.columns:
+        raise ValueError("CSVファイルに 'filename' カラムが見つかりません。")
+    has_frame_column = FRAME_COLUMN in header.columns
+    label_columns = [col for col in header.columns if col not in ("filename", FRAME_COLUMN)]
+    if hasattr(source, "seek"):
+        source.seek(0)
+    total_bytes = getattr(source, "size", None)
+
+    # ファイル名 -> フレーム位置の索引（動画のフレームは `ファイル名#フレーム番号`）
+    names = pd.Series(frames, dtype=object).map(os.path.basename)
+    name_index = pd.Series(np.arange(len(frames)), index=names.to_numpy())
+    name_index = name_index[~name_index.index.duplicated(keep="last")]
+    lookup = pd.Index(name_index.index)
+    lookup_positions = name_index.to_numpy()
+
+    seen = np.zeros(len(frames), dtype=bool)
+    summary = {"label_columns": label_columns, "rows": 0, "matched": 0, "unmatched": 0, "duplicates": 0, "unmatched_examples": []}
+    reader = pd.read_csv(source, chunksize=chunk_rows, dtype={"filename": str})
+    for chunk in reader:
+        keys = chunk["filename"]
+        if has_frame_column:
+            frame_numbers = pd.to_numeric(chunk[FRAME_COLUMN], errors="coerce").astype("Int64")
+            keys = keys.where(frame_numbers.isna(), keys + "#" + frame_numbers.astype(str))
+        indexer = lookup.get_indexer(keys)
+        matched = indexer >= 0
+        positions = lookup_positions[indexer[matched]]
+
+        unmatched_names = keys[~matched]
+        if len(summary["unmatched_examples"]) < 5:
+            summary["unmatched_examples"].extend(unmatched_names.head(5 - len(summary["unmatched_examples"])).tolist())
+
+        # 同じファイル名の行は後の行を採用（チャンク内・チャンク間の両方）
+        duplicated_in_chunk = pd.Series(positions).duplicated(keep="last").to_numpy()
+        summary["duplicates"] += int(np.count_nonzero(duplicated_in_chunk)) + int(np.count_nonzero(seen[positions[~duplicated_in_chunk]]))
+        positions = positions[~duplicated_in_chunk]
+        values = (chunk.loc[matched, label_columns].to_numpy()[~duplicated_in_chunk] == 1)
+        model.set_rows(positions, model.pack(label_columns, values))
+        seen[positions] = True
+
+        summary["rows"] += len(chunk)
+        summary["unmatched"] += int(np.count_nonzero(~matched))
+        if progress is not None:
+            fraction = min(source.tell() / total_bytes, 1.0) if total_bytes and hasattr(source, "tell") else None
+            progress(summary["rows"], fraction)
+
+    summary["matched"] = int(np.count_nonzero(seen))
+    return summary
@@ -0,0 +1,531 @@
+import uuid
+from bisect import bisect_left, bisect_right
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+# --- ラベル設定の解析 ---
+def parse_label_lines(config_lines):
+    """ラベル設定の各行を、チェックボックスのラベルとラジオボタンのグループに振り分けます。
+
+    `## グループ名` の行以降は、そのグループの単一選択肢として扱います。
+    """
+    checkbox_labels = []
+    radio_groups = {}
+    current_group_name = None
+
+    for line in config_lines:
+        line = line.strip()
+        if not line:
+            continue # 空行は無視
+
+        if line.startswith('##'):
+            current_group_name = line.lstrip('# ').strip()
+            if current_group_name:
+                radio_groups[current_group_name] = []
+        elif current_group_name is not None:
+            radio_groups[current_group_name].append(line)
+        else:
+            checkbox_labels.append(line)
+
+    return checkbox_labels, radio_groups
+
+
+# --- 1ラベル分の区間リスト ---
+class LabelRuns:
+    """1つのラベルが付与されているフレーム区間 [start, stop) を開始位置順に保持します。
+
+    区間は常に重なりも隣接もしない状態に結合しておくため、区間の数は
+    ラベルが付け外しされた箇所（変化点）の数に比例し、フレーム数には依存しません。
+    区間の検索は二分探索で行います。
+    """
+
+    __slots__ = ("starts", "stops")
+
+    def __init__(self, starts=(), stops=()):
+        self.starts = list(starts)
+        self.stops = list(stops)
+
+    @classmethod
+    def from_array(cls, values):
+        """フレーム順の0/1配列から区間リストを作成します。"""
+        padded = np.zeros(len(values) + 2, dtype=np.int8)
+        padded[1:-1] = np.asarray(values) != 0
+        edges = np.flatnonzero(np.diff(padded))
+        return cls(edges[0::2].tolist(), edges[1::2].tolist())
+
+    @classmethod
+    def from_positions(cls, positions):
+        """ラベルが付与されているフレーム位置の一覧から区間リストを作成します。"""
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        if positions.size == 0:
+            return cls()
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        return cls(positions[np.r_[0, breaks]].tolist(), (positions[np.r_[breaks - 1, positions.size - 1]] + 1).tolist())
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.stops)
+
+    def __eq__(self, other):
+        return isinstance(other, LabelRuns) and self.starts == other.starts and self.stops == other.stops
+
+    def count(self):
+        """ラベルが付与されているフレーム数を返します。"""
+        return sum(self.stops) - sum(self.starts)
+
+    def contains(self, position):
+        """指定したフレームが区間に含まれる場合にTrueを返します。"""
+        i = bisect_right(self.starts, position) - 1
+        return i >= 0 and position < self.stops[i]
+
+    def add(self, start, stop):
+        """区間 [start, stop) を追加し、重なる・隣接する区間と結合します。変化があればTrueを返します。"""
+        if start >= stop:
+            return False
+        # 追加する区間と重なるか接する区間は i..j-1
+        i = bisect_left(self.stops, start)
+        j = bisect_right(self.starts, stop)
+        if i < j:
+            new_start, new_stop = min(start, self.starts[i]), max(stop, self.stops[j - 1])
+            if j - i == 1 and (new_start, new_stop) == (self.starts[i], self.stops[i]):
+                return False
+        else:
+            new_start, new_stop = start, stop
+        self.starts[i:j] = [new_start]
+        self.stops[i:j] = [new_stop]
+        return True
+
+    def remove(self, start, stop):
+        """区間 [start, stop) を取り除きます。変化があればTrueを返します。"""
+        if start >= stop:
+            return False
+        # 取り除く区間と重なる区間は i..j-1（両端の区間ははみ出した部分を残す）
+        i = bisect_right(self.stops, start)
+        j = bisect_left(self.starts, stop)
+        if i >= j:
+            return False
+        starts, stops = [], []
+        if self.starts[i] < start:
+            starts.append(self.starts[i])
+            stops.append(start)
+        if self.stops[j - 1] > stop:
+            starts.append(stop)
+            stops.append(self.stops[j - 1])
+        self.starts[i:j] = starts
+        self.stops[i:j] = stops
+        return True
+
+    def to_array(self, length):
+        """フレーム順の0/1配列（長さ `length`）に変換します。"""
+        delta = np.zeros(length + 1, dtype=np.int32)
+        # 区間は隣接しないため、開始位置と終了位置が重なることはない
+        delta[self.starts] += 1
+        delta[self.stops] -= 1
+        return np.cumsum(delta[:-1], dtype=np.int32).astype(np.uint8)
+
+    def slice_array(self, start, stop):
+        """フレーム範囲 [start, stop) の部分だけを0/1配列に変換します（範囲と重なる区間だけを参照）。"""
+        length = max(0, stop - start)
+        i, j = bisect_right(self.stops, start), bisect_left(self.starts, stop)
+        if i >= j:
+            return np.zeros(length, dtype=np.uint8)
+        delta = np.zeros(length + 1, dtype=np.int32)
+        delta[np.maximum(np.asarray(self.starts[i:j]), start) - start] += 1
+        delta[np.minimum(np.asarray(self.stops[i:j]), stop) - start] -= 1
+        return np.cumsum(delta[:-1], dtype=np.int32).astype(np.uint8)
+
+
+def overlapping_runs(runs_list, min_count=2):
+    """複数の区間リストのうち、`min_count` 個以上が重なっているフレーム区間を `LabelRuns` で返します。
+
+    ラジオボタンのグループで、複数の選択肢が同時に付与されているフレームの検出に使います。
+    区間の端点を並べて重なりの数を累積するため、計算量は区間の数だけで決まります。
+    """
+    starts = [np.asarray(runs.starts, dtype=np.int64) for runs in runs_list]
+    stops = [np.asarray(runs.stops, dtype=np.int64) for runs in runs_list]
+    if not starts or not sum(len(s) for s in starts):
+        return LabelRuns()
+    positions = np.concatenate(starts + stops)
+    deltas = np.r_[np.ones(sum(map(len, starts)), dtype=np.int64), -np.ones(sum(map(len, stops)), dtype=np.int64)]
+    # 同じ位置では終了を先に数える（区間は [start, stop) のため、接するだけでは重ならない）
+    order = np.lexsort((deltas, positions))
+    positions, depth = positions[order], np.cumsum(deltas[order])
+    # i番目の端点から次の端点までの区間の重なりの数は depth[i]
+    inside = (depth[:-1] >= min_count) & (positions[1:] > positions[:-1])
+    result = LabelRuns()
+    for start, stop in zip(positions[:-1][inside].tolist(), positions[1:][inside].tolist()):
+        result.add(start, stop)
+    return result
+
+
+# --- タイムライン表示用の集計 ---
+class LabelCoverage:
+    """フレームを一定数ずつのブロックに分け、ラベルごとの付与フレーム数をブロック単位で集計します。
+
+    ラベルが変更されるたびに、変更された範囲だけを変更の前後で数えて差分を加えるため、
+    1フレームの変更はフレーム数に依存しない時間で反映され、タイムラインの描画にかかる時間も
+    ブロック数だけで決まります。`counts` はラベルIDごとの集計、`any` はいずれかのラベルが
+    付与されているフレーム数です。
+    """
+
+    def __init__(self, model, block_count):
+        self.requested_blocks = block_count
+        self.frame_count = len(model.frames)
+        self.block_size = max(1, -(-self.frame_count // max(1, block_count)))
+        self.block_count = -(-self.frame_count // self.block_size)
+        self.counts = [np.zeros(self.block_count, dtype=np.int64) for _ in model.runs]
+        self.any = np.zeros(self.block_count, dtype=np.int64)
+        empty = (0, {label_id: 0 for label_id in range(len(model.runs))}, 0)
+        self.apply(model, empty, self.window(model, range(len(model.runs)), 0, self.frame_count))
+
+    def block_starts(self):
+        """各ブロックの先頭のフレーム位置を返します。"""
+        return np.arange(self.block_count, dtype=np.int64) * self.block_size
+
+    def block_lengths(self):
+        """各ブロックのフレーム数を返します（最後のブロックは短い場合があります）。"""
+        return np.minimum(self.block_starts() + self.block_size, self.frame_count) - self.block_starts()
+
+    def window(self, model, label_ids, start, stop):
+        """フレーム範囲 [start, stop) の中だけを数えた、ブロックごとの付与フレーム数を返します。
+
+        変更の前後でそれぞれ呼び出し、`apply()` に渡して差分を反映します。
+        """
+        start, stop = max(0, start), min(stop, self.frame_count)
+        if start >= stop:
+            return None
+        first = start // self.block_size
+        if stop - start == 1:
+            # 1フレームの変更（ラベルボタン・固定ラベルの適用など）は配列を作らずに数える
+            return first, {label_id: int(model.runs[label_id].contains(start)) for label_id in label_ids}, \
+                int(any(runs.contains(start) for runs in model.runs))
+        # 範囲内のブロックの境界（範囲の先頭からの位置）
+        offsets = np.r_[0, np.arange((first + 1) * self.block_size, stop, self.block_size) - start]
+        counts = {
+            label_id: np.add.reduceat(model.runs[label_id].slice_array(start, stop), offsets, dtype=np.int64)
+            for label_id in label_ids
+        }
+        labeled = np.zeros(stop - start, dtype=np.uint8)
+        for runs in model.runs:
+            if len(runs):
+                labeled |= runs.slice_array(start, stop)
+        return first, counts, np.add.reduceat(labeled, offsets, dtype=np.int64)
+
+    def apply(self, model, before, after):
+        """`window()` で数えた変更前後の値の差分を集計に加えます。"""
+        while len(self.counts) < len(model.runs):
+            self.counts.append(np.zeros(self.block_count, dtype=np.int64))
+        if before is None or after is None:
+            return
+        first, old_counts, old_any = before
+        _, new_counts, new_any = after
+        last = first + (len(new_any) if isinstance(new_any, np.ndarray) else 1)
+        for label_id, values in new_counts.items():
+            self.counts[label_id][first:last] += values - old_counts[label_id]
+        self.any[first:last] += new_any - old_any
+
+
+def _changed_span(old, new):
+    """2つの区間リストの違いを含むフレーム範囲 (start, stop) を返します。同じ場合はNoneです。
+
+    先頭と末尾から一致する区間を除いた残りの範囲のため、区間の数に比例する時間で求まります。
+    """
+    old_pairs, new_pairs = list(old), list(new)
+    if old_pairs == new_pairs:
+        return None
+    common = min(len(old_pairs), len(new_pairs))
+    head = 0
+    while head < common and old_pairs[head] == new_pairs[head]:
+        head += 1
+    tail = 0
+    while tail < common - head and old_pairs[-1 - tail] == new_pairs[-1 - tail]:
+        tail += 1
+    differing = old_pairs[head:len(old_pairs) - tail] + new_pairs[head:len(new_pairs) - tail]
+    return min(start for start, _ in differing), max(stop for _, stop in differing)
+
+
+# --- ラベルごとの区間リストによるモデル ---
+class LabelIntervals(MutableMapping):
+    """ラベルごとの区間リスト（ランレングス表現）でラベルを保持するモデルです。
+
+    メモリ使用量と保存量はラベルの変化点の数に比例するため、同じラベルが長く続く
+    連番画像・動画ではフレーム数が増えても小さく保てます。範囲へのラベル付与・解除と
+    フレームのラベル取得は、ラベルごとに二分探索で行います。
+    ラベルの指定には1行分のビットマスク（`mask()`）を使い、ラジオボタンの排他処理は
+    「落とすラベル」と「立てるラベル」のマスクの組で表します。
+    従来の `labels_data`（パス -> ラベル名のリスト）と同じ辞書としても扱えます。
+    """
+
+    def __init__(self, frames, label_names=()):
+        self.frames = list(frames)
+        self.index = {frame: position for position, frame in enumerate(self.frames)}
+        # ラベルIDは追加のみ（設定から外れたラベルもデータは保持する）
+        self.label_names = []
+        self.label_ids = {}
+        self.runs = []
+        self.version = 0
+        # モデルごとに一意な値（`id()` は解放後に再利用されるため、作成済みデータのキャッシュのキーにはこちらを使う）
+        self.token = uuid.uuid4().hex
+        # 前回の保存以降の変更（ラベル名, 付与ならTrue, start, stop）の操作列
+        self.changes = []
+        # タイムライン表示用のブロック単位の集計（最初に参照された時に作成し、以降は変更のたびに更新）
+        self._coverage = None
+        for name in label_names:
+            self.label_id(name)
+
+    @classmethod
+    def from_dict(cls, frames, labels_data):
+        """パス -> ラベル名のリストの辞書からモデルを作成します（全区間を未保存の変更として扱います）。"""
+        model = cls(frames)
+        positions = {}
+        for frame, labels in labels_data.items():
+            position = model.index.get(frame)
+            if position is not None:
+                for name in labels:
+                    positions.setdefault(name, []).append(position)
+        for name, label_positions in positions.items():
+            model.runs[model.label_id(name)] = LabelRuns.from_positions(label_positions)
+            model.changes.extend((name, True, start, stop) for start, stop in model.runs[model.label_ids[name]])
+        return model
+
+    @classmethod
+    def from_runs(cls, frames, label_runs):
+        """ラベル名 -> 区間 [(start, stop), ...] の辞書からモデルを作成します。"""
+        model = cls(frames)
+        for name, runs in label_runs.items():
+            runs = list(runs)
+            model.runs[model.label_id(name)] = LabelRuns([start for start, _ in runs], [stop for _, stop in runs])
+        return model
+
+    # --- ラベルIDとマスク ---
+    def label_id(self, name):
+        """ラベル名に対応するIDを返します。未登録の場合は新しく割り当てます。"""
+        label_id = self.label_ids.get(name)
+        if label_id is None:
+            label_id = len(self.label_names)
+            self.label_names.append(name)
+            self.label_ids[name] = label_id
+            self.runs.append(LabelRuns())
+        return label_id
+
+    def mask(self, labels):
+        """ラベル名の集合を1行分のビットマスクに変換します。"""
+        ids = [self.label_id(name) for name in labels]
+        row = np.zeros(max(1, (len(self.label_names) + 7) // 8), dtype=np.uint8)
+        for label_id in ids:
+            row[label_id >> 3] |= 1 << (label_id & 7)
+        return row
+
+    def names(self, row):
+        """ビットマスクをラベル名のリストに変換します。"""
+        return [self.label_names[i] for i in self._ids(row)]
+
+    def _ids(self, row):
+        ids = np.flatnonzero(np.unpackbits(row, bitorder='little'))
+        return [int(i) for i in ids if i < len(self.label_names)]
+
+    # --- 参照 ---
+    def column(self, name):
+        """指定したラベルが付与されているかを、フレーム順の0/1配列で返します。"""
+        label_id = self.label_ids.get(name)
+        if label_id is None:
+            return np.zeros(len(self.frames), dtype=np.uint8)
+        return self.runs[label_id].to_array(len(self.frames))
+
+    def to_dense(self, labels):
+        """指定したラベル順の (フレーム数, ラベル数) の0/1行列を返します。"""
+        dense = np.zeros((len(self.frames), len(labels)), dtype=np.uint8)
+        for j, name in enumerate(labels):
+            dense[:, j] = self.column(name)
+        return dense
+
+    def labeled(self):
+        """いずれかのラベルが付与されているかを、フレーム順の真偽値配列で返します。"""
+        labeled = np.zeros(len(self.frames), dtype=bool)
+        for runs in self.runs:
+            if len(runs):
+                labeled |= runs.to_array(len(self.frames)).astype(bool)
+        return labeled
+
+    def segments(self, labels=None):
+        """(ラベル名, 開始位置, 終了位置+1) の一覧をラベル順・開始位置順で返します。"""
+        names = self.label_names if labels is None else labels
+        return [
+            (name, start, stop)
+            for name in names if name in self.label_ids
+            for start, stop in self.runs[self.label_ids[name]]
+        ]
+
+    def has(self, position, name):
+        """指定したフレームにラベルが付与されているかを返します。"""
+        label_id = self.label_ids.get(name)
+        return label_id is not None and self.runs[label_id].contains(position)
+
+    def labels_at(self, position):
+        """指定したフレームのラベル名のリストを返します。"""
+        return [name for name, runs in zip(self.label_names, self.runs) if runs.contains(position)]
+
+    def coverage(self, block_count):
+        """ラベルの付与状況をブロック単位で集計した `LabelCoverage` を返します。"""
+        if self._coverage is None or self._coverage.requested_blocks != block_count:
+            self._coverage = LabelCoverage(self, block_count)
+        else:
+            # 集計の作成後に追加されたラベルの行を用意する
+            self._coverage.apply(self, None, None)
+        return self._coverage
+
+    def _window(self, label_ids, start, stop):
+        return self._coverage.window(self, label_ids, start, stop) if self._coverage is not None else None
+
+    def _touch(self, before, label_ids, start, stop):
+        if before is not None:
+            self._coverage.apply(self, before, self._coverage.window(self, label_ids, start, stop))
+
+    # --- 更新 ---
+    @property
+    def dirty(self):
+        """未保存の変更がある場合にTrueを返します。"""
+        return bool(self.changes)
+
+    def update(self, position, add=None, clear=None):
+        """指定したフレームで `clear` のラベルを外してから `add` のラベルを付与します。"""
+        self.update_range(position, position + 1, add=add, clear=clear)
+
+    def update_range(self, start, stop, add=None, clear=None):
+        """フレーム範囲 [start, stop) で `clear` のラベルを外してから `add` のラベルを付与します。"""
+        touched = set(self._ids(clear) if clear is not None else []) | set(self._ids(add) if add is not None else [])
+        before = self._window(touched, start, stop)
+        changed = set()
+        if clear is not None:
+            for label_id in self._ids(clear):
+                if self.runs[label_id].remove(start, stop):
+                    self.changes.append((self.label_names[label_id], False, start, stop))
+                    changed.add(label_id)
+        if add is not None:
+            for label_id in self._ids(add):
+                if self.runs[label_id].add(start, stop):
+                    self.changes.append((self.label_names[label_id], True, start, stop))
+                    changed.add(label_id)
+        if changed:
+            self._touch(before, touched, start, stop)
+            self.version += 1
+
+    def toggle(self, position, mask):
+        """指定したフレームで `mask` のラベルの有無を反転します。"""
+        label_ids = self._ids(mask)
+        before = self._window(label_ids, position, position + 1)
+        for label_id in label_ids:
+            runs = self.runs[label_id]
+            # 保存先では反転ではなく付与・解除として記録する（同じ操作を重ねて適用しても結果が変わらない）
+            add = not runs.contains(position)
+            if add:
+                runs.add(position, position + 1)
+            else:
+                runs.remove(position, position + 1)
+            self.changes.append((self.label_names[label_id], add, position, position + 1))
+        self._touch(before, label_ids, position, position + 1)
+        self.version += 1
+
+    def set_row(self, position, mask):
+        """指定したフレームのラベルを `mask` で置き換えます。"""
+        keep = set(self._ids(mask))
+        clear = self.mask([name for i, name in enumerate(self.label_names) if i not in keep])
+        self.update(position, add=mask, clear=clear)
+
+    def set_rows(self, positions, rows):
+        """複数フレームのラベルをまとめて置き換えます（CSV読み込みなどの一括処理用）。
+
+        ラベルごとにフレーム順の0/1配列へ展開して書き換え、区間リストを作り直します。
+        """
+        if len(positions) == 0:
+            return
+        positions = np.asarray(positions)
+        label_ids = range(len(self.runs))
+        start, stop = int(positions.min()), int(positions.max()) + 1
+        before = self._window(label_ids, start, stop)
+        for label_id, runs in enumerate(self.runs):
+            byte = label_id >> 3
+            values = (rows[:, byte] >> (label_id & 7)) & 1 if byte < rows.shape[1] else 0
+            if not len(runs) and not np.any(values):
+                continue
+            column = runs.to_array(len(self.frames))
+            old_column = column.copy()
+            column[positions] = values
+            new_runs = LabelRuns.from_array(column)
+            if new_runs != runs:
+                self.runs[label_id] = new_runs
+                # 変更は「外した区間」と「付けた区間」の操作列として記録する
+                name = self.label_names[label_id]
+                self.changes.extend((name, False, start, stop) for start, stop in LabelRuns.from_array(old_column & ~column))
+                self.changes.extend((name, True, start, stop) for start, stop in LabelRuns.from_array(column & ~old_column))
+        self._touch(before, label_ids, start, stop)
+        self.version += 1
+
+    def replace_runs(self, label_runs):
+        """ラベル名 -> 区間 [(start, stop), ...] の辞書で区間を置き換えます（別のタブの保存内容の反映用）。
+
+        区間が変わったラベルについて、変わった範囲だけを集計し直します。置き換えは保存済みの内容の
+        反映のため、未保存の変更としては記録しません。辞書に無いラベルは区間を空にします。
+        """
+        changed = False
+        for name in set(self.label_names) | set(label_runs):
+            label_id = self.label_id(name)
+            runs = list(label_runs.get(name, ()))
+            new_runs = LabelRuns([start for start, _ in runs], [stop for _, stop in runs])
+            span = _changed_span(self.runs[label_id], new_runs)
+            if span is None:
+                continue
+            before = self._window([label_id], *span)
+            self.runs[label_id] = new_runs
+            self._touch(before, [label_id], *span)
+            changed = True
+        if changed:
+            self.version += 1
+
+    def pack(self, labels, values):
+        """(行数, ラベル数) の0/1配列を、行ごとのビットマスク配列に変換します。"""
+        ids = [self.label_id(name) for name in labels]
+        rows = np.zeros((values.shape[0], max(1, (len(self.label_names) + 7) // 8)), dtype=np.uint8)
+        for j, label_id in enumerate(ids):
+            rows[:, label_id >> 3] |= values[:, j].astype(np.uint8) << (label_id & 7)
+        return rows
+
+    def take_changes(self):
+        """前回の呼び出し以降の変更を (ラベル名, 付与ならTrue, start, stop) の操作列で返します。
+
+        操作列を保存済みの区間に順に適用すると、このモデルと同じ変更が反映されます
+        （他のセッションによる別の範囲への変更は残ります）。
+        """
+        changes, self.changes = self.changes, []
+        return changes
+
+    # --- 従来の labels_data と互換の辞書インターフェース ---
+    def __getitem__(self, frame):
+        labels = self.labels_at(self.index[frame])
+        if not labels:
+            raise KeyError(frame)
+        return labels
+
+    def __setitem__(self, frame, labels):
+        self.set_row(self.index[frame], self.mask(labels))
+
+    def __delitem__(self, frame):
+        position = self.index[frame]
+        if not self.labels_at(position):
+            raise KeyError(frame)
+        self.set_row(position, self.mask([]))
+
+    def __iter__(self):
+        for position in np.flatnonzero(self.labeled()):
+            yield self.frames[position]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.labeled()))
+
+    def __contains__(self, frame):
+        position = self.index.get(frame)
+        return position is not None and bool(self.labels_at(position))
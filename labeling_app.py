@@ -1,50 +1,314 @@
 import streamlit as st
-import cv2
+import altair as alt
 import os
+import numpy as np
 import pandas as pd
 import time
 from pathlib import Path
-import shutil
 import pickle
-import re
+import functools
+import logging
+import uuid
+
+from background_jobs import default_workers
+from frame_cache import FrameCache
+from label_io import EXPORT_FORMATS, SEGMENT_FORMAT, export_label_table, export_labels, export_segment_table, import_label_csv
+from label_model import LabelIntervals, parse_label_lines
+from metrics import Metrics, start_metrics_server
+from proxy_cache import ProxyCache
+from scene_detect import SceneDetector
+from scan_index import IMAGE_EXTENSIONS, ScanIndex, natural_sort_key
+from video_source import VIDEO_EXTENSIONS, VideoLibrary, frame_display_name
+from state_store import DEFAULT_ANNOTATOR, StateStore
 
 # --- 定数 ---
-# セッション状態を保存するファイル
-STATE_FILE = Path("./.session_state.pkl")
-# Dockerコンテナ内のデータマウントポイント
-DATA_ROOT_PATH = "/data"
+# セッション状態を保存するファイル（SQLite）
+STATE_DB_FILE = Path("./.session_state.db")
+# 旧形式の状態ファイル（起動時に自動で移行）
+LEGACY_STATE_FILE = Path("./.session_state.pkl")
+# フォルダのスキャン結果・動画の索引を保存するファイル（SQLite）
+SCAN_INDEX_FILE = Path("./.scan_index.db")
+# Dockerコンテナ内のデータマウントポイント（ベンチマーク等で変更する場合は環境変数で指定）
+DATA_ROOT_PATH = os.environ.get("DATA_ROOT_PATH", "/data")
+# フレームキャッシュの設定（環境変数で変更可能）
+FRAME_CACHE_MB = int(os.environ.get("FRAME_CACHE_MB", "512"))
+FRAME_DISPLAY_WIDTH = int(os.environ.get("FRAME_DISPLAY_WIDTH", "1280"))
+FRAME_PREFETCH_AHEAD = int(os.environ.get("FRAME_PREFETCH_AHEAD", "24"))
+FRAME_PREFETCH_BEHIND = int(os.environ.get("FRAME_PREFETCH_BEHIND", "4"))
+FRAME_PREFETCH_WORKERS = int(os.environ.get("FRAME_PREFETCH_WORKERS", "4"))
+# 表示用に縮小した画像（プロキシ）とサムネイルを保存するディレクトリ（空にすると無効）
+PROXY_CACHE_DIR = os.environ.get("PROXY_CACHE_DIR", "./.proxy_cache")
+# プロキシをバックグラウンドで作成するプロセス数（0にすると表示時にだけ作成）
+PROXY_WORKERS = int(os.environ.get("PROXY_WORKERS", str(default_workers())))
+THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", "160"))
+# 再生中に画像表示を更新する回数の上限（これを超える再生速度ではフレームを間引く）
+PLAYBACK_MAX_RENDER_FPS = float(os.environ.get("PLAYBACK_MAX_RENDER_FPS", "30"))
+# タイムラインのヒートマップの列数（ブロック数）と、並べるサムネイルの数
+TIMELINE_BLOCKS = int(os.environ.get("TIMELINE_BLOCKS", "200"))
+TIMELINE_THUMBNAILS = int(os.environ.get("TIMELINE_THUMBNAILS", "8"))
+# シーン検出の特徴量を計算するプロセス数（0で無効）と、切り替わりとみなす変化量・最短のシーンの長さの既定値
+SCENE_WORKERS = int(os.environ.get("SCENE_WORKERS", str(default_workers())))
+SCENE_THRESHOLD = float(os.environ.get("SCENE_THRESHOLD", "0.3"))
+SCENE_MIN_LENGTH = int(os.environ.get("SCENE_MIN_LENGTH", "10"))
+# 処理時間の計測の設定（METRICS_PORTを指定するとPrometheus形式の指標を公開）
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_LOG_LEVEL = os.environ.get("METRICS_LOG_LEVEL", "INFO")
+METRICS_SLOW_MS = float(os.environ.get("METRICS_SLOW_MS", "250"))
+
+# --- 処理時間の計測 ---
+@st.cache_resource
+def get_metrics():
+    """プロセス全体で共有する計測レジストリを返します（初回のみログ出力とHTTPサーバーを設定）。"""
+    metrics = Metrics(slow_ms=METRICS_SLOW_MS)
+    metrics_logger = logging.getLogger("metrics")
+    metrics_logger.setLevel(METRICS_LOG_LEVEL)
+    if not metrics_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics_logger.addHandler(handler)
+        metrics_logger.propagate = False
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics, METRICS_HOST, int(METRICS_PORT))
+        except OSError as e:
+            metrics_logger.warning(f"計測用HTTPサーバーを起動できませんでした: {e}")
+    return metrics
+
+def timed(phase_name):
+    """関数の処理時間をフェーズとして記録するデコレータです。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().phase(phase_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- フレームキャッシュ ---
+@st.cache_resource
+def get_frame_cache():
+    """プロセス全体で共有するフレームキャッシュを返します。"""
+    metrics = get_metrics()
+    video_library = get_video_library()
+    proxy_cache = get_proxy_cache()
+
+    def load_frame(key, display_width, jpeg_quality):
+        # 先読みスレッドからも呼ばれるため、計測レジストリは直接参照する
+        if proxy_cache is not None:
+            with metrics.phase("proxy_load"):
+                data = proxy_cache.load(key)
+            if data is not None:
+                return data
+        with metrics.phase("image_decode"):
+            return video_library.load_display_frame(key, display_width, jpeg_quality)
+
+    frame_cache = FrameCache(
+        max_bytes=FRAME_CACHE_MB * 1024 * 1024,
+        display_width=FRAME_DISPLAY_WIDTH,
+        prefetch_ahead=FRAME_PREFETCH_AHEAD,
+        prefetch_behind=FRAME_PREFETCH_BEHIND,
+        workers=FRAME_PREFETCH_WORKERS,
+        loader=load_frame,
+    )
+    metrics.add_collector(lambda: {
+        f"labeling_frame_cache_{key}": (frame_cache.stats()[key], f"Frame cache {key.replace('_', ' ')}.")
+        for key in ["hits", "misses", "prefetch_waits", "bytes", "entries"]
+    })
+    return frame_cache
+
+@st.cache_resource
+def get_proxy_cache():
+    """プロセス全体で共有する表示用画像のディスクキャッシュを返します（無効な場合はNone）。"""
+    if not PROXY_CACHE_DIR:
+        return None
+    proxy_cache = ProxyCache(
+        PROXY_CACHE_DIR, display_width=FRAME_DISPLAY_WIDTH, thumbnail_width=THUMBNAIL_WIDTH, workers=PROXY_WORKERS,
+    )
+    get_metrics().add_collector(lambda: {
+        f"labeling_proxy_{key}": (proxy_cache.progress()[key], f"Proxy generation {key} frames.")
+        for key in ["total", "done", "built", "failed"]
+    })
+    return proxy_cache
+
+def start_proxy_generation():
+    """開いているデータセットの表示用画像の作成をバックグラウンドで開始します。"""
+    proxy_cache = get_proxy_cache()
+    if proxy_cache is not None and st.session_state.get("image_files") and st.session_state.get("selected_path"):
+        proxy_cache.start(st.session_state.selected_path, st.session_state.image_files, st.session_state.current_frame_index)
+
+@st.cache_resource
+def get_scene_detector():
+    """プロセス全体で共有するシーン検出を返します。"""
+    return SceneDetector(SCAN_INDEX_FILE, workers=SCENE_WORKERS)
+
+def start_scene_detection():
+    """開いているデータセットのシーン検出（特徴量の計算）をバックグラウンドで開始します。"""
+    if st.session_state.get("image_files") and st.session_state.get("selected_path"):
+        get_scene_detector().start(st.session_state.selected_path, st.session_state.image_files)
+
+@st.cache_resource
+def get_video_library():
+    """プロセス全体で共有する動画の索引・リーダーを返します。"""
+    return VideoLibrary(SCAN_INDEX_FILE)
+
+# --- フォルダのスキャン ---
+@st.cache_resource
+def get_scan_index():
+    """プロセス全体で共有するスキャン索引を返します。"""
+    return ScanIndex(SCAN_INDEX_FILE)
+
+@st.cache_data(max_entries=4)
+def list_data_folders(root_mtime_ns):
+    """データフォルダ直下の (項目数, サブフォルダ一覧) を返します（更新時刻が変わった時だけ読み直す）。"""
+    all_items = sorted(os.listdir(DATA_ROOT_PATH), key=natural_sort_key)
+    return len(all_items), [d for d in all_items if os.path.isdir(os.path.join(DATA_ROOT_PATH, d)) and not d.startswith('.')]
 
 # --- 状態の保存・復元 ---
+# 設定やカーソル位置など、フレーム数に依存しない保存対象のキー
+META_KEYS = [
+    "current_frame_index", "labels_config", "fixed_labels", "play_speed", "selected_path",
+    "last_update_time", "actual_fps", "use_fix_mode", "scene_threshold", "scene_min_length"
+]
+# META_KEYSのうち、データセットではなく作業者ごとに保存するキー（その他はデータセットごとに保存）
+ANNOTATOR_META_KEYS = ["selected_path"]
+
+@st.cache_resource
+def get_state_store():
+    """プロセス全体で共有する状態ストアを返します。"""
+    return StateStore(STATE_DB_FILE)
+
+@timed("state_save")
 def save_state():
-    """現在のセッション状態をファイルに保存します。"""
-    # 保存するべきキーをリスト化
-    keys_to_save = [
-        "image_files", "current_frame_index", "labels_data",
-        "labels_config", "fixed_labels", "play_speed", "selected_path",
-        "last_update_time", "actual_fps", "use_fix_mode"
-    ]
-    state_to_save = {key: st.session_state.get(key) for key in keys_to_save}
+    """現在のセッション状態のうち、前回保存時から変わった部分だけを保存します。
+
+    状態は作業者ごと・データセット（フォルダ）ごとに保存します。ラベルは変更の操作列として
+    書き込むため、同じデータセットを別のタブ・プロセスで同時に編集しても変更は失われません。
+    """
+    store = get_state_store()
+    annotator = st.session_state.annotator
+    dataset = st.session_state.get("selected_path")
+
+    annotator_meta, dataset_meta = {}, {}
+    saved_meta = st.session_state.setdefault("saved_meta", {})
+    for key in META_KEYS:
+        if key not in ANNOTATOR_META_KEYS and not dataset:
+            continue
+        value = st.session_state.get(key)
+        if isinstance(value, set): value = sorted(value)
+        if saved_meta.get(key, ()) != value:
+            target = annotator_meta if key in ANNOTATOR_META_KEYS else dataset_meta
+            target[key] = saved_meta[key] = value
+    if annotator_meta:
+        store.put_meta(annotator, "", annotator_meta)
+    if dataset_meta:
+        store.put_meta(annotator, dataset, dataset_meta)
+
+    labels_data = st.session_state.get("labels_data")
+    if dataset and labels_data is not None and labels_data.dirty:
+        # 別のセッションがフレーム一覧を置き換えていた場合に位置を対応付け直せるよう、基準の一覧と世代を添える
+        store.put_label_changes(
+            dataset, annotator, labels_data.take_changes(), st.session_state.writer_id,
+            frames=labels_data.frames, generation=st.session_state.get("frame_generation"),
+        )
 
-    with open(STATE_FILE, "wb") as f:
-        pickle.dump(state_to_save, f)
+def forget_saved_state():
+    """保存済みとして記録している値を破棄し、次回の保存ですべて書き直させます。"""
+    if "saved_meta" in st.session_state: del st.session_state["saved_meta"]
 
+def migrate_legacy_state(store):
+    """旧形式の`.session_state.pkl`があれば、既定の作業者の状態として状態ストアへ取り込みます。"""
+    if not LEGACY_STATE_FILE.exists() or not store.is_empty():
+        return False
+    with open(LEGACY_STATE_FILE, "rb") as f:
+        legacy_state = pickle.load(f)
+    meta = {key: legacy_state.get(key) for key in META_KEYS}
+    if isinstance(meta["fixed_labels"], set): meta["fixed_labels"] = sorted(meta["fixed_labels"])
+    dataset = meta.pop("selected_path")
+    if dataset:
+        frames = legacy_state.get("image_files") or []
+        store.replace_frames(dataset, frames)
+        labels_data = LabelIntervals.from_dict(frames, legacy_state.get("labels_data") or {})
+        store.put_label_changes(dataset, DEFAULT_ANNOTATOR, labels_data.take_changes())
+        store.put_meta(DEFAULT_ANNOTATOR, "", {"selected_path": dataset})
+        store.put_meta(DEFAULT_ANNOTATOR, dataset, meta)
+    store.flush()
+    LEGACY_STATE_FILE.rename(LEGACY_STATE_FILE.with_name(LEGACY_STATE_FILE.name + ".migrated"))
+    return True
+
+@timed("state_load")
 def load_state():
-    """ファイルからセッション状態を復元します。"""
-    if STATE_FILE.exists():
-        try:
-            with open(STATE_FILE, "rb") as f:
-                loaded_state = pickle.load(f)
-                # 読み込んだ値でsession_stateを一括更新
-                st.session_state.update(loaded_state)
-            st.toast("前回の作業状態を復元しました。")
-        except Exception as e:
-            st.error(f"状態ファイルの読み込みに失敗しました: {e}")
-            STATE_FILE.unlink()
+    """状態ストアから、現在の作業者が最後に開いていたデータセットの状態を復元します。"""
+    store = get_state_store()
+    try:
+        if migrate_legacy_state(store):
+            st.toast("旧形式の状態ファイルを新しい形式に移行しました。")
+        dataset = store.load_meta(st.session_state.annotator, "").get("selected_path")
+        if not dataset:
+            return
+        load_dataset_state(dataset)
+    except Exception as e:
+        st.error(f"状態ファイルの読み込みに失敗しました: {e}")
+        return
+    st.toast("前回の作業状態を復元しました。")
+
+def load_dataset_state(dataset, frames=None):
+    """データセットのフレーム一覧と、現在の作業者のラベル・設定をセッション状態に読み込みます。"""
+    store = get_state_store()
+    annotator = st.session_state.annotator
+    # 世代番号はフレーム一覧より先に取得する（間に一覧が置き換えられても、保存時に対応付け直される）
+    generation = store.frame_generation(dataset)
+    stored_frames = store.load_frames(dataset)
+    if frames is None or frames != stored_frames:
+        frames = stored_frames
+    meta = store.load_meta(annotator, dataset)
+    # リビジョンを先に取得する（読み込み中に書き込まれた場合は次回の同期で読み込み直す）
+    revision = store.label_revision(dataset, annotator)
+    labels_data = LabelIntervals.from_runs(frames, store.load_label_runs(dataset, annotator))
+
+    saved_meta = {key: value for key, value in meta.items() if key in META_KEYS}
+    if meta.get("fixed_labels") is not None:
+        meta["fixed_labels"] = set(meta["fixed_labels"])
+    # 読み込んだ値でsession_stateを一括更新
+    st.session_state.update({key: value for key, value in meta.items() if key in META_KEYS and value is not None})
+    st.session_state.update(
+        selected_path=dataset, image_files=frames, frame_generation=generation, labels_data=labels_data, label_revision=revision,
+        assigned_range=store.assignments(dataset).get(annotator),
+    )
+    st.session_state.saved_meta = saved_meta
+
+def sync_labels():
+    """他のタブ・プロセスが同じ作業者のラベルやフレーム一覧を書き換えていれば読み込み直します。"""
+    dataset = st.session_state.get("selected_path")
+    if not dataset or not st.session_state.get("image_files"):
+        return
+    save_state()
+    store = get_state_store()
+    annotator = st.session_state.annotator
+    revision, changed = store.changed_by_others(
+        dataset, annotator, st.session_state.get("label_revision", 0), st.session_state.writer_id
+    )
+    generation = store.frame_generation(dataset)
+    if generation != st.session_state.get("frame_generation"):
+        # 別のセッションがフォルダを読み込み直してフレーム一覧が変わった場合は、一覧ごと読み込み直す
+        with get_metrics().phase("state_sync"):
+            st.session_state.frame_generation = generation
+            frames = store.load_frames(dataset)
+            # フレーム一覧が変わっていなければ同じリストを使い続ける（フレームキャッシュ等の参照を保つ）
+            if frames == st.session_state.image_files:
+                frames = st.session_state.image_files
+            st.session_state.image_files = frames
+            st.session_state.labels_data = LabelIntervals.from_runs(frames, store.load_label_runs(dataset, annotator))
+    elif changed:
+        # ラベルだけが変わった場合は、区間を置き換えて変わった範囲だけを反映する（フレーム数に依存しない）
+        with get_metrics().phase("state_sync"):
+            st.session_state.labels_data.replace_runs(store.load_label_runs(dataset, annotator))
+    st.session_state.label_revision = revision
+    st.session_state.assigned_range = store.assignments(dataset).get(annotator)
 
 def reset_state():
-    """セッション状態と保存ファイルをリセットします。"""
-    if STATE_FILE.exists():
-        STATE_FILE.unlink()
+    """現在の作業者のセッション状態と保存済みの状態（開いているデータセットの分）をリセットします。"""
+    get_state_store().clear(st.session_state.annotator, st.session_state.get("selected_path"))
     keys_to_clear = list(st.session_state.keys())
     for key in keys_to_clear:
         del st.session_state[key]
@@ -52,13 +316,24 @@ def reset_state():
     time.sleep(2)
     st.rerun()
 
+def switch_annotator():
+    """作業者名が変更された時の処理です。現在の状態を保存し、新しい作業者の状態を読み込み直します。"""
+    annotator = st.session_state.annotator_input.strip() or DEFAULT_ANNOTATOR
+    if annotator == st.session_state.annotator:
+        return
+    save_state()
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    # 再実行時の初期化で読み込まれる（URLに残るため、ページを再読み込みしても同じ作業者で開く）
+    st.query_params["annotator"] = annotator
+
 # --- 状態管理の初期化 ---
 def initialize_session_state():
     """セッション内で使用する変数を初期化します。"""
     defaults = {
         "image_files": [],
         "current_frame_index": 0,
-        "labels_data": {},
+        "labels_data": LabelIntervals([]),
         "is_playing": False,
         "fixed_labels": set(),
         "play_speed": 10.0,
@@ -69,6 +344,16 @@ def initialize_session_state():
         "checkbox_labels": [],
         "radio_groups": {},
         "use_fix_mode": False, # ★★★ 追加: ラベル固定モードの状態
+        "play_direction": 1,
+        # 作業者はURLの `?annotator=名前` で指定する（未指定の場合は既定の作業者）
+        "annotator": st.query_params.get("annotator") or DEFAULT_ANNOTATOR,
+        # 同じ作業者の別タブと区別するための、セッションごとの書き込み元ID
+        "writer_id": uuid.uuid4().hex,
+        "label_revision": 0,
+        "frame_generation": 0,
+        "assigned_range": None,
+        "scene_threshold": SCENE_THRESHOLD,
+        "scene_min_length": SCENE_MIN_LENGTH,
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -77,58 +362,36 @@ def initialize_session_state():
 # --- ラベル設定の解析機能 ---
 def parse_label_config():
     """ラベル設定を解析して、チェックボックスとラジオボタンのグループに振り分けます。"""
-    checkbox_labels = []
-    radio_groups = {}
-    current_group_name = None
-    
-    config_lines = st.session_state.get('labels_config', [])
-
-    for line in config_lines:
-        line = line.strip()
-        if not line:
-            continue # 空行は無視
-
-        if line.startswith('##'):
-            current_group_name = line.lstrip('# ').strip()
-            if current_group_name:
-                radio_groups[current_group_name] = []
-        elif current_group_name is not None:
-            radio_groups[current_group_name].append(line)
-        else:
-            checkbox_labels.append(line)
-
+    checkbox_labels, radio_groups = parse_label_lines(st.session_state.get('labels_config', []))
     st.session_state.checkbox_labels = checkbox_labels
     st.session_state.radio_groups = radio_groups
 
 # --- ラベル読み込み機能 ---
+@timed("csv_import")
 def load_labels_from_csv(uploaded_file):
     """アップロードされたCSVからラベル結果を読み込み、ラベル設定も自動更新します。"""
     try:
-        image_path_map = {Path(p).name: p for p in st.session_state.image_files}
-        df = pd.read_csv(uploaded_file)
+        progress_bar = st.progress(0.0, text="ラベルデータを読み込んでいます...")
+        def on_progress(rows, fraction):
+            progress_bar.progress(fraction if fraction is not None else 0.0, text=f"{rows:,}行を読み込みました...")
 
-        if 'filename' not in df.columns:
-            st.error("CSVファイルに 'filename' カラムが見つかりません。")
-            return
+        summary = import_label_csv(uploaded_file, st.session_state.image_files, st.session_state.labels_data, progress=on_progress)
+        progress_bar.empty()
 
-        label_columns = [col for col in df.columns if col != 'filename']
+        label_columns = summary["label_columns"]
         st.session_state.labels_config = label_columns # CSVのヘッダをそのままラベル設定とする
         st.success(f"ラベル設定をCSVから読み込んだ{len(label_columns)}個のラベルに更新しました。")
         parse_label_config() # 更新された設定を解析
 
-        loaded_count = 0
-        for _, row in df.iterrows():
-            filename = row['filename']
-            image_path = image_path_map.get(filename)
-            if image_path:
-                applied_labels = [label for label in label_columns if label in row and row[label] == 1]
-                st.session_state.labels_data[image_path] = applied_labels
-                loaded_count += 1
-        
-        if loaded_count > 0:
-            st.success(f"{loaded_count}件の画像に対するラベリングデータをCSVから読み込みました。")
+        if summary["matched"] > 0:
+            st.success(f"{summary['matched']}件の画像に対するラベリングデータをCSVから読み込みました。（全{summary['rows']}行）")
         else:
             st.warning("CSV内のファイル名と一致する画像が現在のフォルダに見つかりませんでした。")
+        if summary["unmatched"] > 0:
+            examples = ", ".join(summary["unmatched_examples"])
+            st.warning(f"{summary['unmatched']}行はフォルダ内の画像と一致しませんでした。（例: {examples}）")
+        if summary["duplicates"] > 0:
+            st.info(f"同じファイル名の行が{summary['duplicates']}件あったため、後の行を採用しました。")
         save_state()
 
     except Exception as e:
@@ -141,27 +404,69 @@ def on_csv_upload():
         with st.spinner("ラベルデータを読み込んでいます..."):
             load_labels_from_csv(uploaded_file)
 
+# --- ラベル出力機能 ---
+def make_export_callback(frames, model, labels, include_unlabeled, export_format, cache):
+    """出力データを作成する関数を返します。
+
+    結果はラベルの変更回数（model.version）をキーにキャッシュし、
+    ラベルが変わっていなければ再作成しません。返す関数に `create=False` を渡すと、
+    作成済みのデータだけを返します（未作成の場合はNone）。
+    """
+    metrics = get_metrics()
+
+    def build(create=True):
+        cache_key = (model.token, model.version, tuple(labels), include_unlabeled, export_format)
+        if cache_key not in cache:
+            if not create:
+                return None
+            with metrics.phase("export", rows=len(frames), format=export_format):
+                if export_format == SEGMENT_FORMAT:
+                    table = export_segment_table(frames, model, labels)
+                else:
+                    table = export_label_table(frames, model, labels, include_unlabeled)
+                cache.clear() # 最新の1件だけを保持
+                cache[cache_key] = export_labels(table, export_format)
+        return cache[cache_key]
+    return build
+
 # --- UIコンポーネント ---
+def metrics_panel():
+    """フェーズごとの処理時間（直近の値の集計）を表示します。"""
+    summaries = get_metrics().summaries()
+    if not summaries:
+        st.caption("まだ計測結果がありません。")
+        return
+    table = pd.DataFrame.from_dict(summaries, orient="index")
+    table.columns = ["回数", "最新 (ms)", "中央値 (ms)", "95% (ms)", "最大 (ms)"]
+    st.dataframe(table.round(1), use_container_width=True)
+    if METRICS_PORT:
+        st.caption(f"Prometheus形式: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+@timed("sidebar_render")
 def setup_sidebar():
     """サイドバーのUI要素を設定します。"""
     with st.sidebar:
         st.header("作業管理")
+        st.text_input("作業者名", value=st.session_state.annotator, key="annotator_input", on_change=switch_annotator,
+                      help="ラベルと作業状態は作業者ごとに保存されます。URLの `?annotator=名前` でも指定できます。")
         if st.button("現在の作業状態をリセット", type="secondary"):
             reset_state()
         st.divider()
 
         st.header("1. データ読み込み")
 
-        if not os.path.isdir(DATA_ROOT_PATH) or not os.listdir(DATA_ROOT_PATH):
+        try:
+            root_mtime_ns = os.stat(DATA_ROOT_PATH).st_mtime_ns
+        except OSError:
+            root_mtime_ns = None
+        if root_mtime_ns is None or not list_data_folders(root_mtime_ns)[0]:
             st.error("データフォルダが見つかりません。")
             st.warning("`make run DATA_DIR=/path/to/your/pictures` のように、画像フォルダのパスを正しく指定しましたか？")
             st.info("詳細はプロジェクトの `Makefile` を参照してください。")
             st.stop()
 
         try:
-            all_items = sorted(os.listdir(DATA_ROOT_PATH))
-            subdirectories = [d for d in all_items if os.path.isdir(os.path.join(DATA_ROOT_PATH, d)) and not d.startswith('.')]
-            subdirectories.insert(0, ".")
+            subdirectories = [".", *list_data_folders(root_mtime_ns)[1]]
         except Exception as e:
             st.error(f"データフォルダの読み取りに失敗しました: {e}")
             subdirectories = []
@@ -178,29 +483,30 @@ def setup_sidebar():
         selected_path = os.path.normpath(os.path.join(DATA_ROOT_PATH, selected_folder_name))
 
         if st.button("このフォルダでラベリング開始"):
-            st.session_state.selected_path = selected_path
-            with st.spinner("画像を読み込んでいます..."):
-                if STATE_FILE.exists(): STATE_FILE.unlink()
-                keys_to_clear = ["image_files", "current_frame_index", "labels_data"]
+            save_state() # 開いていたデータセットの未保存の変更を書き込む
+            with st.spinner("画像・動画を読み込んでいます..."):
+                forget_saved_state()
+                keys_to_clear = ["image_files", "current_frame_index", "labels_data", "label_revision", "frame_generation", "assigned_range", "export_cache"]
                 for key in keys_to_clear:
                     if key in st.session_state: del st.session_state[key]
                 initialize_session_state()
-                parse_label_config() # 初期化後にも解析を実行
-
-                image_paths = []
-                image_extensions_set = {".png", ".jpg", ".jpeg", ".bmp", ".tiff"}
-                search_path = st.session_state.selected_path
-                for root, dirs, files in os.walk(search_path):
-                    dirs[:] = [d for d in dirs if not d.startswith('.')]
-                    for file in files:
-                        if not file.startswith('.') and Path(file).suffix.lower() in image_extensions_set:
-                            image_paths.append(os.path.join(root, file))
-                st.session_state.image_files = sorted(image_paths)
+
+                # 変更のあったディレクトリだけを読み直し、自然順（frame_2 < frame_10）で並べる
+                with get_metrics().phase("scan", path=selected_path):
+                    source_files = get_scan_index().scan(selected_path, IMAGE_EXTENSIONS | VIDEO_EXTENSIONS)
+                    # 動画はフレーム単位（`パス#フレーム番号`）に展開する
+                    frames = get_video_library().expand(source_files)
+                # フレーム一覧はデータセットごとに共有し、この作業者の以前の作業内容があれば引き継ぐ
+                get_state_store().replace_frames(selected_path, frames)
+                load_dataset_state(selected_path, frames)
+                parse_label_config() # 読み込んだ設定を解析
 
                 if not st.session_state.image_files:
-                    st.error(f"フォルダ `{st.session_state.selected_path}` 内に画像ファイルが見つかりませんでした。")
+                    st.error(f"フォルダ `{st.session_state.selected_path}` 内に画像・動画ファイルが見つかりませんでした。")
                 else:
-                    st.success(f"{len(st.session_state.image_files)}枚の画像を読み込みました。")
+                    st.success(f"{len(st.session_state.image_files)}フレームを読み込みました。")
+                    start_proxy_generation()
+                    start_scene_detection()
                     save_state()
                     st.rerun()
 
@@ -236,22 +542,46 @@ def setup_sidebar():
             st.divider()
             st.header("4. 結果の出力")
             include_unlabeled = st.checkbox("ラベルが付与されていない画像も出力に含める", value=True, key="include_unlabeled_checkbox")
+            export_format = st.selectbox("出力形式", options=list(EXPORT_FORMATS), key="export_format")
             if st.session_state.get("image_files"):
                 all_labels = [l.strip() for l in st.session_state.labels_config if l.strip() and not l.strip().startswith('##')]
-                header = ['filename'] + all_labels
-                rows = []
-                for image_path in sorted(st.session_state.image_files):
-                    applied_labels = st.session_state.labels_data.get(image_path, [])
-                    applied_labels_set = set(applied_labels)
-                    if include_unlabeled or applied_labels:
-                        row_data = {'filename': Path(image_path).name}
-                        for label in all_labels:
-                            row_data[label] = 1 if label in applied_labels_set else 0
-                        rows.append(row_data)
-                if rows:
-                    df = pd.DataFrame(rows, columns=header)
-                    csv = df.to_csv(index=False).encode('utf-8')
-                    st.download_button("ラベリング結果をCSVでダウンロード", csv, "labels.csv", "text/csv", key="download_button_csv")
+                file_name, mime = EXPORT_FORMATS[export_format]
+                # 出力データは作成ボタンが押された時にだけ作成する（ラベルが変わるまで作成したデータを使い回す）
+                export_callback = make_export_callback(
+                    st.session_state.image_files, st.session_state.labels_data, all_labels, include_unlabeled, export_format,
+                    st.session_state.setdefault("export_cache", {})
+                )
+                st.button("出力データを作成", use_container_width=True, key="build_export_button", on_click=export_callback,
+                          help="作成後にラベルを変更した場合は、もう一度作成してください。")
+                export_data = export_callback(create=False)
+                if export_data is not None:
+                    st.download_button("ラベリング結果をダウンロード", export_data, file_name, mime, key="download_button_csv")
+
+            with st.expander("作業範囲の割り当て"):
+                assignment_panel()
+
+            if SCENE_WORKERS > 0:
+                with st.expander("シーン検出"):
+                    scene_settings_panel()
+
+            with st.expander("フレームキャッシュ"):
+                stats = get_frame_cache().stats()
+                st.caption(
+                    f"ヒット率: {stats['hit_rate']:.1%} (ヒット {stats['hits']} / 先読み待ち {stats['prefetch_waits']} / ミス {stats['misses']})"
+                )
+                st.caption(
+                    f"使用量: {stats['bytes'] / 1024 / 1024:.1f} / {stats['max_bytes'] / 1024 / 1024:.0f} MB ({stats['entries']}フレーム, 先読み中 {stats['inflight']})"
+                )
+                if get_proxy_cache() is not None:
+                    progress = get_proxy_cache().progress(st.session_state.selected_path)
+                    status = "作成中" if progress["running"] else "停止中"
+                    st.caption(
+                        f"表示用画像: {progress['done']:,} / {progress['total']:,}フレーム（{status}, 新規作成 {progress['built']:,} / 失敗 {progress['failed']:,}）"
+                    )
+
+        st.divider()
+        if st.checkbox("処理時間の計測結果を表示", key="show_metrics_panel"):
+            st.fragment(metrics_panel, run_every=2.0)()
 
 def main_view():
     """メインの表示エリア（画像、コントロール、ラベリングパネル）を作成します。"""
@@ -264,113 +594,300 @@ def main_view():
     current_index = st.session_state.current_frame_index
     if current_index >= total_frames:
         st.warning("インデックスが範囲外です。リセットします。"); st.session_state.current_frame_index = 0; current_index = 0; st.rerun()
-    current_image_path = st.session_state.image_files[current_index]
 
+    # フレーム移動や再生の切り替えでは、サイドバーを含むスクリプト全体ではなくこのエリアだけを再実行する
+    st.fragment(workspace)()
+
+@timed("workspace_render")
+def workspace():
+    """画像表示・ラベリングパネル・コントロールをまとめたエリアを作成します。"""
+    sync_labels()
+    low, high = frame_bounds()
+    if not low <= st.session_state.current_frame_index < high:
+        # 作業範囲が割り当てられている場合は、その範囲の先頭に移動する
+        st.session_state.current_frame_index = low
     col_main, col_labels = st.columns([3, 1])
     with col_main:
-        fps_display = f" (実測: {st.session_state.actual_fps:.1f} FPS)" if st.session_state.is_playing else ""
-        st.subheader(f"画像表示 ({current_index + 1} / {total_frames}){fps_display}")
-        st.image(current_image_path, use_container_width=True)
-        st.caption(Path(current_image_path).name)
+        # 再生中は画像表示エリアだけを一定間隔で再実行する
+        render_interval = playback_render_interval() if st.session_state.is_playing else None
+        st.fragment(image_viewer, run_every=render_interval)()
 
     with col_labels:
-        st.subheader("ラベリング")
-        # ★★★ 修正点: ラベル固定モードのトグルをパネル上部に移動 ★★★
-        st.toggle("ラベル固定モード", key="use_fix_mode", help="このスイッチがONの時にラベルを選択すると、そのラベルが固定されます。")
-        
-        current_labels = set(st.session_state.labels_data.get(current_image_path, []))
-        
-        # 1. 複数選択ボタンの表示
-        if st.session_state.checkbox_labels:
-            st.markdown("---")
-            st.caption("複数選択")
-            for label in st.session_state.checkbox_labels:
-                is_fixed = label in st.session_state.fixed_labels
-                is_active = label in current_labels
-                button_type = "primary" if is_active else "secondary"
-                button_label = f"📌 {label}" if is_fixed else label
-                if st.button(button_label, type=button_type, use_container_width=True, key=f"label_btn_{label}"):
-                    if st.session_state.use_fix_mode:
-                        if is_fixed: st.session_state.fixed_labels.remove(label)
-                        else: st.session_state.fixed_labels.add(label)
-                    else:
-                        if is_active: current_labels.remove(label)
-                        else: current_labels.add(label)
-                    st.session_state.labels_data[current_image_path] = list(current_labels)
-                    save_state()
-                    st.rerun()
-        
-        # 2. 単一選択ラジオボタンの表示
-        for group, options in st.session_state.radio_groups.items():
-            st.markdown("---")
-            st.caption(f"単一選択: {group}")
-            
-            current_selection_in_group = next((opt for opt in options if opt in current_labels), None)
-
-            # ★★★ 修正点: ラジオボタンのon_changeロジックを更新 ★★★
-            def on_radio_change(group_name, group_options):
-                selected_label = st.session_state[f"radio_{group_name}"]
-                img_path = st.session_state.image_files[st.session_state.current_frame_index]
-                
-                # 通常のラベル付け処理
-                temp_labels = set(st.session_state.labels_data.get(img_path, []))
-                temp_labels.difference_update(group_options)
-                if selected_label != "（未選択）":
-                    temp_labels.add(selected_label)
-                st.session_state.labels_data[img_path] = list(temp_labels)
-
-                # 固定モードが有効な場合、固定ラベルセットも更新
-                if st.session_state.use_fix_mode:
-                    st.session_state.fixed_labels.difference_update(group_options)
-                    if selected_label != "（未選択）":
-                        st.session_state.fixed_labels.add(selected_label)
-                
-                save_state()
-
-            radio_display_options = ["（未選択）"] + options
-            index = radio_display_options.index(current_selection_in_group) if current_selection_in_group else 0
-            
-            # ★★★ 修正点: format_funcでピンアイコンを表示 ★★★
-            def format_label_with_pin(option):
-                return f"📌 {option}" if option in st.session_state.fixed_labels else option
+        # ラベルの操作ではこのエリア全体を再実行し、タイムラインやシーンの操作にも変更を反映する
+        # （画像はフレームキャッシュから返すため、再実行のコストはフレーム数に依存しない）
+        label_panel()
 
-            st.radio(
-                f"Radio group for {group}", options=radio_display_options, index=index,
-                key=f"radio_{group}", on_change=on_radio_change, args=(group, options), 
-                label_visibility="collapsed", format_func=format_label_with_pin
-            )
+    with st.expander("タイムライン", expanded=True):
+        timeline()
 
     st.divider()
     st.subheader("コントロール")
-    col_progress, col_controls, col_speed = st.columns([3, 2, 1])
-    with col_progress:
-        st.progress((current_index + 1) / total_frames)
+    col_controls, col_speed = st.columns([2, 1])
     with col_controls:
         c1, c2, c3 = st.columns(3)
-        if c1.button("⏮️ 前へ", use_container_width=True): go_to_frame(current_index - 1)
+        c1.button("⏮️ 前へ", use_container_width=True, on_click=step_frame, args=(-1,))
         play_label = "⏸️ 一時停止" if st.session_state.is_playing else "▶️ 再生"
-        if c2.button(play_label, use_container_width=True):
-            if not st.session_state.is_playing: st.session_state.last_update_time = time.time()
-            st.session_state.is_playing = not st.session_state.is_playing
-            save_state(); st.rerun()
-        if c3.button("次へ ⏭️", use_container_width=True): go_to_frame(current_index + 1)
+        c2.button(play_label, use_container_width=True, on_click=toggle_playback)
+        c3.button("次へ ⏭️", use_container_width=True, on_click=step_frame, args=(1,))
+        scene_panel()
     with col_speed:
         def on_slider_change():
             st.session_state.play_speed = st.session_state.play_speed_slider
+            if st.session_state.is_playing: rebase_playback_clock()
             save_state()
         st.slider("再生速度 (fps)", 1.0, 120.0, st.session_state.play_speed, key='play_speed_slider', on_change=on_slider_change)
 
+    with st.expander("範囲ラベリング"):
+        range_panel()
+
+@timed("label_panel_render")
+def label_panel():
+    """ラベリングパネルを作成します。"""
+    st.subheader("ラベリング")
+    # ★★★ 修正点: ラベル固定モードのトグルをパネル上部に移動 ★★★
+    st.toggle("ラベル固定モード", key="use_fix_mode", help="このスイッチがONの時にラベルを選択すると、そのラベルが固定されます。")
+    
+    current_index = st.session_state.current_frame_index
+    current_labels = set(st.session_state.labels_data.labels_at(current_index))
+    
+    # 1. 複数選択ボタンの表示
+    if st.session_state.checkbox_labels:
+        st.markdown("---")
+        st.caption("複数選択")
+        for label in st.session_state.checkbox_labels:
+            is_fixed = label in st.session_state.fixed_labels
+            is_active = label in current_labels
+            button_type = "primary" if is_active else "secondary"
+            button_label = f"📌 {label}" if is_fixed else label
+            st.button(button_label, type=button_type, use_container_width=True, key=f"label_btn_{label}",
+                      on_click=on_label_button, args=(label,))
+    
+    # 2. 単一選択ラジオボタンの表示
+    for group, options in st.session_state.radio_groups.items():
+        st.markdown("---")
+        st.caption(f"単一選択: {group}")
+        
+        current_selection_in_group = next((opt for opt in options if opt in current_labels), None)
+
+        # ★★★ 修正点: ラジオボタンのon_changeロジックを更新 ★★★
+        def on_radio_change(group_name, group_options):
+            selected_label = st.session_state[f"radio_{group_name}"]
+            model = st.session_state.labels_data
+            
+            # 通常のラベル付け処理（グループ内のビットを落としてから選択肢を立てる）
+            selected_mask = model.mask([selected_label]) if selected_label != "（未選択）" else None
+            model.update(st.session_state.current_frame_index, add=selected_mask, clear=model.mask(group_options))
+
+            # 固定モードが有効な場合、固定ラベルセットも更新
+            if st.session_state.use_fix_mode:
+                st.session_state.fixed_labels.difference_update(group_options)
+                if selected_label != "（未選択）":
+                    st.session_state.fixed_labels.add(selected_label)
+            
+            save_state()
+
+        radio_display_options = ["（未選択）"] + options
+        index = radio_display_options.index(current_selection_in_group) if current_selection_in_group else 0
+        
+        # ★★★ 修正点: format_funcでピンアイコンを表示 ★★★
+        def format_label_with_pin(option):
+            return f"📌 {option}" if option in st.session_state.fixed_labels else option
+
+        st.radio(
+            f"Radio group for {group}", options=radio_display_options, index=index,
+            key=f"radio_{group}", on_change=on_radio_change, args=(group, options), 
+            label_visibility="collapsed", format_func=format_label_with_pin
+        )
+
+def on_label_button(label):
+    """複数選択ボタンが押された時の処理です（固定モードでは固定ラベルを切り替える）。"""
+    if st.session_state.use_fix_mode:
+        if label in st.session_state.fixed_labels: st.session_state.fixed_labels.remove(label)
+        else: st.session_state.fixed_labels.add(label)
+    else:
+        model = st.session_state.labels_data
+        model.toggle(st.session_state.current_frame_index, model.mask([label]))
+    save_state()
+
+@timed("image_viewer_render")
+def image_viewer():
+    """画像表示エリアを作成します。再生中はフラグメントとして一定間隔で再実行されます。"""
+    if st.session_state.is_playing and advance_playback():
+        # 最後のフレームに到達したら再生を終了し、ボタン表示を更新するため全体を再実行
+        stop_playback()
+        save_state()
+        st.rerun()
+
+    total_frames = len(st.session_state.image_files)
+    current_index = st.session_state.current_frame_index
+    current_image_path = st.session_state.image_files[current_index]
+
+    fps_display = f" (実測: {st.session_state.actual_fps:.1f} FPS)" if st.session_state.is_playing else ""
+    st.subheader(f"画像表示 ({current_index + 1} / {total_frames}){fps_display}")
+    frame_cache = get_frame_cache()
+    with get_metrics().phase("image_fetch"):
+        frame_data = frame_cache.get(current_image_path)
+    st.image(frame_data, use_container_width=True)
+    st.caption(frame_display_name(current_image_path))
+    if st.session_state.get("assigned_range"):
+        low, high = frame_bounds()
+        st.caption(f"担当範囲: {low + 1}〜{high}フレーム")
+    st.progress((current_index + 1) / total_frames)
+
+    # 再生方向の先のフレームをバックグラウンドで先読み（再生中は表示されるフレームだけ）
+    stride = 1
+    if st.session_state.is_playing:
+        stride = max(1, round(st.session_state.play_speed * playback_render_interval()))
+    frame_cache.prefetch_around(st.session_state.image_files, current_index, st.session_state.play_direction, stride)
+
+# --- タイムライン ---
+# タイムラインに表示するシーンの切り替わり位置の上限
+TIMELINE_MAX_SCENE_MARKS = 500
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_thumbnail(key):
+    """フレームのサムネイル（JPEG）を返します。"""
+    proxy_cache = get_proxy_cache()
+    data = proxy_cache.thumbnail(key) if proxy_cache is not None else None
+    if data is None:
+        data = get_video_library().load_display_frame(key, THUMBNAIL_WIDTH)
+    return data
+
+@timed("timeline_render")
+def timeline():
+    """ラベルごとの付与状況のヒートマップとサムネイルを表示します。クリックした位置へ移動できます。
+
+    ヒートマップはラベルの変更のたびに更新されるブロック単位の集計から作成するため、
+    描画にかかる時間はフレーム数に依存しません。
+    """
+    frames = st.session_state.image_files
+    model = st.session_state.labels_data
+    label_names = st.session_state.checkbox_labels + [
+        option for options in st.session_state.radio_groups.values() for option in options
+    ]
+    label_ids = [model.label_id(name) for name in label_names]
+    coverage = model.coverage(TIMELINE_BLOCKS)
+    starts, lengths = coverage.block_starts(), coverage.block_lengths()
+    rows = [coverage.counts[label_id] for label_id in label_ids] + [lengths - coverage.any]
+    row_names = label_names + ["（ラベルなし）"]
+    table = pd.DataFrame({
+        "label": np.repeat(row_names, coverage.block_count),
+        "start": np.tile(starts, len(row_names)),
+        "end": np.tile(starts + lengths, len(row_names)),
+        "first": np.tile(starts + 1, len(row_names)),
+        "coverage": np.concatenate(rows) / np.tile(lengths, len(row_names)),
+    })
+
+    seek = alt.selection_point(name="seek", fields=["start"], on="click")
+    heatmap = alt.Chart(table).mark_rect().encode(
+        x=alt.X("start:Q", scale=alt.Scale(domain=[0, len(frames)], nice=False), axis=alt.Axis(title=None, format="d")),
+        x2="end:Q",
+        y=alt.Y("label:N", sort=row_names, title=None),
+        color=alt.Color("coverage:Q", scale=alt.Scale(domain=[0, 1], scheme="blues"), legend=None),
+        tooltip=[
+            alt.Tooltip("label:N", title="ラベル"), alt.Tooltip("first:Q", title="開始フレーム"),
+            alt.Tooltip("end:Q", title="終了フレーム"), alt.Tooltip("coverage:Q", title="付与率", format=".0%"),
+        ],
+    ).add_params(seek)
+    cursor = alt.Chart(pd.DataFrame({"position": [st.session_state.current_frame_index + 0.5]})).mark_rule(color="red").encode(x="position:Q")
+    chart = heatmap + cursor
+    analysis = current_scene_analysis()
+    if analysis is not None:
+        # シーンの切り替わり位置（多すぎる場合は描画が重くなるため表示しない）
+        boundaries = scene_boundaries(analysis)
+        if 0 < len(boundaries) <= TIMELINE_MAX_SCENE_MARKS:
+            chart += alt.Chart(pd.DataFrame({"position": boundaries})).mark_rule(color="orange", opacity=0.7).encode(x="position:Q")
+    st.altair_chart(
+        chart, use_container_width=True, key="timeline_chart", on_select=on_timeline_select, selection_mode="seek",
+    )
+
+    # 全体から等間隔に選んだフレームのサムネイル
+    if TIMELINE_THUMBNAILS > 0 and st.toggle("サムネイルを表示", value=True, key="timeline_show_thumbnails"):
+        positions = sorted(set(np.linspace(0, len(frames) - 1, min(TIMELINE_THUMBNAILS, len(frames))).round().astype(int).tolist()))
+        for column, position in zip(st.columns(len(positions)), positions):
+            with column:
+                try:
+                    st.image(load_thumbnail(frames[position]), use_container_width=True)
+                except Exception:
+                    st.caption("（読み込めません）")
+                st.button(f"{position + 1}", key=f"timeline_thumbnail_{position}", use_container_width=True,
+                          on_click=go_to_frame, args=(position,))
+
+def on_timeline_select():
+    """タイムラインのブロックがクリックされた時に、そのブロックの先頭のフレームへ移動します。"""
+    selected = st.session_state.timeline_chart.selection.get("seek") or []
+    if selected:
+        go_to_frame(int(selected[0]["start"]))
+
+# --- 再生 ---
+def playback_render_interval():
+    """再生中に画像表示を更新する間隔（秒）を返します。"""
+    return 1.0 / min(st.session_state.play_speed, PLAYBACK_MAX_RENDER_FPS)
+
+def rebase_playback_clock():
+    """再生位置の計算の基準を現在のフレーム・時刻に置き直します。"""
+    st.session_state.play_anchor_index = st.session_state.current_frame_index
+    st.session_state.play_anchor_time = time.perf_counter()
+    st.session_state.play_rendered_frames = 0
+
+def start_playback():
+    """再生を開始します。"""
+    st.session_state.is_playing = True
+    st.session_state.play_direction = 1
+    st.session_state.play_range_start = st.session_state.current_frame_index
+    st.session_state.last_update_time = time.time()
+    rebase_playback_clock()
+
+def advance_playback():
+    """経過時間から表示すべきフレームを求めて移動します。最後のフレームに達したらTrueを返します。
+
+    描画が間に合わなかった分のフレームは表示せずに飛ばすため、再生速度がずれていきません。
+    """
+    elapsed = time.perf_counter() - st.session_state.play_anchor_time
+    last_index = frame_bounds()[1] - 1
+    target = st.session_state.play_anchor_index + int(elapsed * st.session_state.play_speed)
+    st.session_state.current_frame_index = min(target, last_index)
+
+    st.session_state.play_rendered_frames += 1
+    if elapsed > 0:
+        st.session_state.actual_fps = st.session_state.play_rendered_frames / elapsed
+    st.session_state.last_update_time = time.time()
+    return target >= last_index
+
+def stop_playback():
+    """再生を停止し、再生した範囲に固定ラベルをまとめて適用します。"""
+    if not st.session_state.is_playing:
+        return
+    st.session_state.is_playing = False
+    start = st.session_state.get("play_range_start", st.session_state.current_frame_index)
+    end = st.session_state.current_frame_index
+    if st.session_state.fixed_labels and end > start:
+        model = st.session_state.labels_data
+        add_mask, clear_mask = fixed_label_masks(model)
+        model.update_range(start + 1, end + 1, add=add_mask, clear=clear_mask)
+
+def toggle_playback():
+    """再生・一時停止を切り替えます。"""
+    if st.session_state.is_playing: stop_playback()
+    else: start_playback()
+    save_state()
+
+def step_frame(delta):
+    """現在のフレームから前後に移動します。"""
+    go_to_frame(st.session_state.current_frame_index + delta)
+
 def go_to_frame(index):
-    """指定されたインデックスのフレームに移動します。"""
+    """指定されたインデックスのフレームに移動します（ボタンのコールバックとして呼び出します）。"""
     total_frames = len(st.session_state.image_files)
     if total_frames == 0: return
-    new_index = max(0, min(index, total_frames - 1))
+    stop_playback()
+    low, high = frame_bounds()
+    new_index = max(low, min(index, high - 1))
     if st.session_state.current_frame_index != new_index:
+        st.session_state.play_direction = 1 if new_index > st.session_state.current_frame_index else -1
         st.session_state.current_frame_index = new_index
         apply_fixed_labels()
-    st.session_state.is_playing = False
     save_state()
-    st.rerun()
 
 # ★★★ 修正点: apply_fixed_labelsのロジックを更新 ★★★
 def apply_fixed_labels():
@@ -378,40 +895,236 @@ def apply_fixed_labels():
     if not st.session_state.fixed_labels:
         return
 
-    img_path = st.session_state.image_files[st.session_state.current_frame_index]
-    current_labels = set(st.session_state.labels_data.get(img_path, []))
+    model = st.session_state.labels_data
+    add_mask, clear_mask = fixed_label_masks(model)
+    model.update(st.session_state.current_frame_index, add=add_mask, clear=clear_mask)
+
+def fixed_label_masks(model):
+    """固定ラベルを適用するための (立てるビット, 落とすビット) のマスクを返します。"""
+    return exclusive_label_masks(model, st.session_state.fixed_labels)
 
-    # 1. チェックボックスタイプの固定ラベルを適用
-    fixed_checkboxes = st.session_state.fixed_labels.intersection(st.session_state.checkbox_labels)
-    current_labels.update(fixed_checkboxes)
+def exclusive_label_masks(model, labels):
+    """ラベルを付与するための (立てるビット, 落とすビット) のマスクを返します。
 
-    # 2. ラジオボタンタイプの固定ラベルを適用
+    ラジオボタンの選択肢は、同じグループの他の選択肢を落としてから1つだけ立てます。
+    """
+    labels = set(labels)
+    # 1. チェックボックスタイプのラベル
+    add_labels = labels.intersection(st.session_state.checkbox_labels)
+    clear_labels = set()
+
+    # 2. ラジオボタンタイプのラベル
     for group, options in st.session_state.radio_groups.items():
-        # このグループに属する固定ラベルがあるか確認
-        fixed_selection_in_group = st.session_state.fixed_labels.intersection(options)
+        # このグループに属するラベルがあるか確認
+        selection_in_group = labels.intersection(options)
         
-        if fixed_selection_in_group:
-            # 既存の同グループのラベルを削除
-            current_labels.difference_update(options)
-            # 固定ラベルを1つ追加（セットなのでpopでOK）
-            current_labels.add(fixed_selection_in_group.pop())
+        if selection_in_group:
+            # 既存の同グループのラベルを削除し、ラベルを1つ追加（セットなのでpopでOK）
+            clear_labels.update(options)
+            add_labels.add(selection_in_group.pop())
 
-    st.session_state.labels_data[img_path] = list(current_labels)
+    return model.mask(add_labels), model.mask(clear_labels)
 
+# --- 範囲ラベリング ---
+def range_panel():
+    """開始・終了フレームを指定して、範囲内のラベルをまとめて付与・解除するパネルを作成します。"""
+    low, high = frame_bounds()
+    # フォルダを読み込み直した場合などに範囲外にならないよう、ウィジェットの作成前に補正する
+    for key in ["range_start", "range_end"]:
+        value = st.session_state.get(key, st.session_state.current_frame_index + 1)
+        st.session_state[key] = min(max(low + 1, int(value)), high)
+    label_options = st.session_state.checkbox_labels + [
+        option for options in st.session_state.radio_groups.values() for option in options
+    ]
+    st.session_state.range_labels = [label for label in st.session_state.get("range_labels", []) if label in label_options]
 
-def auto_play():
-    """再生状態の時に自動でフレームを進めます。"""
-    if st.session_state.is_playing:
-        if st.session_state.current_frame_index < len(st.session_state.image_files) - 1:
-            time.sleep(1.0 / st.session_state.play_speed)
-            st.session_state.current_frame_index += 1
-            apply_fixed_labels()
-            save_state()
-            st.rerun()
-        else:
-            st.session_state.is_playing = False
-            save_state()
-            st.rerun()
+    col_start, col_end = st.columns(2)
+    with col_start:
+        st.number_input("開始フレーム", min_value=low + 1, max_value=high, step=1, key="range_start")
+        st.button("現在のフレームを開始に設定", use_container_width=True, on_click=set_range_bound, args=("range_start",))
+    with col_end:
+        st.number_input("終了フレーム", min_value=low + 1, max_value=high, step=1, key="range_end")
+        st.button("現在のフレームを終了に設定", use_container_width=True, on_click=set_range_bound, args=("range_end",))
+
+    st.multiselect("対象のラベル", options=label_options, key="range_labels",
+                   help="ラジオボタンの選択肢を付与すると、範囲内の同じグループの他の選択肢は解除されます。")
+    start, end = sorted((st.session_state.range_start, st.session_state.range_end))
+    st.caption(f"{start}〜{end}フレーム（{end - start + 1}フレーム）")
+    c1, c2 = st.columns(2)
+    disabled = not st.session_state.range_labels
+    c1.button("範囲にラベルを付与", type="primary", use_container_width=True, disabled=disabled, on_click=label_range, args=(True,))
+    c2.button("範囲のラベルを解除", use_container_width=True, disabled=disabled, on_click=label_range, args=(False,))
+
+def set_range_bound(key):
+    """現在のフレームを範囲の開始または終了に設定します。"""
+    st.session_state[key] = st.session_state.current_frame_index + 1
+
+def label_range(add):
+    """指定した範囲のフレームに、選択したラベルを付与（add=True）または解除します。"""
+    labels = st.session_state.range_labels
+    if not labels:
+        return
+    start, end = sorted((st.session_state.range_start, st.session_state.range_end))
+    model = st.session_state.labels_data
+    if add:
+        add_mask, clear_mask = exclusive_label_masks(model, labels)
+        model.update_range(start - 1, end, add=add_mask, clear=clear_mask)
+    else:
+        model.update_range(start - 1, end, clear=model.mask(labels))
+    save_state()
+
+# --- シーン検出 ---
+def current_scene_analysis():
+    """開いているデータセットのシーン検出の解析結果を返します（無効・未開始の場合はNone）。"""
+    if SCENE_WORKERS <= 0 or not st.session_state.get("selected_path"):
+        return None
+    analysis = get_scene_detector().analysis(st.session_state.selected_path)
+    if analysis is None or len(analysis.frames) != len(st.session_state.image_files):
+        return None
+    return analysis
+
+def scene_boundaries(analysis):
+    """現在の設定で求めたシーンの切り替わり位置（新しいシーンの先頭のフレーム位置）を返します。"""
+    return analysis.boundaries(st.session_state.scene_threshold, st.session_state.scene_min_length)
+
+def current_scene_range(analysis):
+    """現在のフレームを含むシーンの範囲 [start, stop) を作業範囲に収めて、範囲が確定しているかとともに返します。
+
+    特徴量が未計算のフレームを含むシーンは、計算済みの部分だけを返し、確定していない（False）とします。
+    """
+    low, high = frame_bounds()
+    start, stop, complete = analysis.segment(
+        st.session_state.current_frame_index, st.session_state.scene_threshold, st.session_state.scene_min_length
+    )
+    return max(start, low), min(stop, high), complete
+
+def scene_panel():
+    """前後のシーンへの移動と、現在のラベルをシーン全体に付与するボタンを作成します。"""
+    analysis = current_scene_analysis()
+    if analysis is None:
+        return
+    boundaries = scene_boundaries(analysis)
+    current_index = st.session_state.current_frame_index
+    start, stop, complete = current_scene_range(analysis)
+    low, high = frame_bounds()
+    # 特徴量が未計算のフレームを含むシーンは範囲が確定していないため、次のシーンへの移動と一括適用はできない
+    c1, c2, c3 = st.columns(3)
+    c1.button("⏪ 前のシーン", use_container_width=True, disabled=current_index <= low, on_click=jump_scene, args=(-1,))
+    c2.button("次のシーン ⏩", use_container_width=True, disabled=not complete or stop >= high, on_click=jump_scene, args=(1,))
+    c3.button("現在のラベルをシーン全体に適用", use_container_width=True, on_click=apply_labels_to_scene, disabled=not complete,
+              help="現在のフレームのラベルを同じシーンの全フレームに付与します（ラベルが無いフレームでは何もしません）。ラジオボタンの選択肢は、同じグループの他の選択肢を解除してから付与します。")
+    scene_number = int(np.searchsorted(boundaries, current_index, side="right")) + 1
+    progress = get_scene_detector().progress(st.session_state.selected_path)
+    status = f"（解析中 {progress['done']:,} / {progress['total']:,}フレーム）" if progress["running"] else ""
+    if not complete:
+        status = f"（未解析のフレームを含むため範囲は未確定）{status}"
+    st.caption(f"シーン {scene_number} / {len(boundaries) + 1}: {start + 1}〜{stop}フレーム（{stop - start}フレーム）{status}")
+
+def jump_scene(direction):
+    """前（direction=-1）または次（direction=1）のシーンの先頭のフレームに移動します。
+
+    前へ移動する場合、現在のシーンの途中にいればそのシーンの先頭に移動します。
+    """
+    analysis = current_scene_analysis()
+    if analysis is None:
+        return
+    boundaries = scene_boundaries(analysis)
+    current_index = st.session_state.current_frame_index
+    if direction > 0:
+        # 範囲が確定していなければ、次の切り替わりがまだ見つかっていない可能性がある
+        if not current_scene_range(analysis)[2]:
+            return
+        i = int(np.searchsorted(boundaries, current_index, side="right"))
+        target = int(boundaries[i]) if i < len(boundaries) else frame_bounds()[1] - 1
+    else:
+        i = int(np.searchsorted(boundaries, current_index, side="left"))
+        target = int(boundaries[i - 1]) if i > 0 else 0
+    go_to_frame(target)
+
+def apply_labels_to_scene():
+    """現在のフレームのラベルを、同じシーンの全フレーム（作業範囲内）に付与します。"""
+    analysis = current_scene_analysis()
+    if analysis is None:
+        return
+    stop_playback()
+    model = st.session_state.labels_data
+    labels = model.labels_at(st.session_state.current_frame_index)
+    if not labels:
+        return
+    start, stop, complete = current_scene_range(analysis)
+    if not complete:
+        return
+    add_mask, clear_mask = exclusive_label_masks(model, labels)
+    model.update_range(start, stop, add=add_mask, clear=clear_mask)
+    save_state()
+
+def scene_settings_panel():
+    """シーン検出の設定と、特徴量の計算の進み具合を表示します。"""
+    def on_scene_settings_change():
+        st.session_state.scene_threshold = st.session_state.scene_threshold_slider
+        st.session_state.scene_min_length = int(st.session_state.scene_min_length_input)
+        save_state()
+    st.slider("切り替わりとみなす変化量", 0.05, 1.0, float(st.session_state.scene_threshold), step=0.05,
+              key="scene_threshold_slider", on_change=on_scene_settings_change,
+              help="隣り合うフレームの色の構成・配置の変化がこの値を超えた位置をシーンの切り替わりとします。小さくすると細かく分かれます。")
+    st.number_input("最短のシーンの長さ（フレーム）", min_value=1, value=int(st.session_state.scene_min_length), step=1,
+                    key="scene_min_length_input", on_change=on_scene_settings_change,
+                    help="これより近い位置にある切り替わりの候補は、変化量が最大のものだけを残します。")
+    progress = get_scene_detector().progress(st.session_state.selected_path)
+    status = "解析中" if progress["running"] else "停止中"
+    st.caption(
+        f"特徴量: {progress['done']:,} / {progress['total']:,}フレーム（{status}, 新規計算 {progress['computed']:,} / 失敗 {progress['failed']:,}）"
+    )
+    analysis = current_scene_analysis()
+    if analysis is not None:
+        st.caption(f"シーン数: {len(scene_boundaries(analysis)) + 1:,}")
+
+# --- 作業範囲の割り当て ---
+def frame_bounds():
+    """現在の作業者が移動・ラベリングできるフレームの範囲 [start, stop) を返します（割り当てが無ければ全体）。"""
+    total_frames = len(st.session_state.image_files)
+    assigned = st.session_state.get("assigned_range")
+    if assigned:
+        start, stop = max(0, assigned[0]), min(assigned[1], total_frames)
+        if start < stop:
+            return start, stop
+    return 0, total_frames
+
+def assignment_panel():
+    """データセットのフレーム範囲を作業者ごとに割り当てるパネルを作成します。"""
+    total_frames = len(st.session_state.image_files)
+    assignments = get_state_store().assignments(st.session_state.selected_path)
+    if assignments:
+        st.dataframe(pd.DataFrame(
+            [{"作業者": annotator, "開始": start + 1, "終了": stop} for annotator, (start, stop) in assignments.items()]
+        ), hide_index=True, use_container_width=True)
+    else:
+        st.caption("まだ割り当てはありません。")
+
+    st.session_state.setdefault("assign_annotator", st.session_state.annotator)
+    for key, default in [("assign_start", 1), ("assign_end", total_frames)]:
+        st.session_state[key] = min(max(1, int(st.session_state.get(key, default))), total_frames)
+    st.text_input("作業者", key="assign_annotator")
+    col_start, col_end = st.columns(2)
+    col_start.number_input("開始", min_value=1, max_value=total_frames, step=1, key="assign_start")
+    col_end.number_input("終了", min_value=1, max_value=total_frames, step=1, key="assign_end")
+    c1, c2 = st.columns(2)
+    c1.button("割り当てる", use_container_width=True, on_click=assign_range, args=(True,))
+    c2.button("割り当てを解除", use_container_width=True, on_click=assign_range, args=(False,))
+
+def assign_range(assign):
+    """入力された作業者にフレーム範囲を割り当てます（assign=Falseの場合は割り当てを解除）。"""
+    annotator = st.session_state.assign_annotator.strip()
+    if not annotator:
+        return
+    store = get_state_store()
+    dataset = st.session_state.selected_path
+    if assign:
+        start, end = sorted((st.session_state.assign_start, st.session_state.assign_end))
+        store.assign(dataset, annotator, start - 1, end)
+    else:
+        store.unassign(dataset, annotator)
+    st.session_state.assigned_range = store.assignments(dataset).get(st.session_state.annotator)
 
 if __name__ == "__main__":
     st.set_page_config(layout="wide", page_title="動画ラベリングツール")
@@ -421,16 +1134,10 @@ if __name__ == "__main__":
         initialize_session_state()
         load_state()
         parse_label_config() # 初期ロード時に解析
+        start_proxy_generation() # 前回の作成が途中で終わっていれば続きから作成
+        start_scene_detection()
         st.session_state.app_initialized = True
 
-    setup_sidebar()
-    main_view()
-
-    # FPS計算と自動再生はメインビューの後に配置
-    current_time = time.time()
-    if 'last_update_time' in st.session_state:
-        delta = current_time - st.session_state.last_update_time
-        if delta > 0: st.session_state.actual_fps = 1.0 / delta
-    st.session_state.last_update_time = current_time
-    
-    auto_play()
+    with get_metrics().phase("script_run"):
+        setup_sidebar()
+        main_view()
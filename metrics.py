@@ -0,0 +1,149 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Prometheusのヒストグラムのバケット境界（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# --- 処理時間の集計 ---
+class PhaseStats:
+    """1つの処理（フェーズ）の処理時間を集計します。
+
+    直近の値はデバッグ表示用に一定数だけ保持し、Prometheus用には累積のバケット数を持ちます。
+    """
+
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+
+    def summary(self):
+        """直近の値の件数・最新値・中央値・95パーセンタイル・最大値（ミリ秒）を返します。"""
+        recent = np.asarray(self.recent) * 1000
+        if recent.size == 0:
+            return {"count": self.count, "last_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        return {
+            "count": self.count,
+            "last_ms": float(recent[-1]),
+            "p50_ms": float(np.percentile(recent, 50)),
+            "p95_ms": float(np.percentile(recent, 95)),
+            "max_ms": float(recent.max()),
+        }
+
+
+class Metrics:
+    """フェーズごとの処理時間と、キャッシュ状態などの値（ゲージ）を保持するレジストリです。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=500, slow_ms=250.0):
+        self.buckets = tuple(buckets)
+        self.window = window
+        self.slow_ms = slow_ms
+        self._phases = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds, **fields):
+        """処理時間を記録し、構造化ログ（JSON）を出力します。"""
+        with self._lock:
+            stats = self._phases.get(phase)
+            if stats is None:
+                stats = self._phases[phase] = PhaseStats(self.buckets, self.window)
+            stats.observe(seconds)
+
+        duration_ms = seconds * 1000
+        level = logging.INFO if duration_ms >= self.slow_ms else logging.DEBUG
+        if logger.isEnabledFor(level):
+            record = {"event": "phase", "phase": phase, "duration_ms": round(duration_ms, 3), **fields}
+            logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+    @contextmanager
+    def phase(self, phase, **fields):
+        """`with metrics.phase("scan"):` の形で囲んだ処理の時間を記録します。"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start, **fields)
+
+    def add_collector(self, collector):
+        """出力時に {名前: (値, 説明)} を返す関数を登録します（キャッシュの統計など）。"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def gauges(self):
+        """登録した関数から集めたゲージの現在値を {名前: (値, 説明)} で返します。"""
+        with self._lock:
+            collectors = list(self._collectors)
+        gauges = {}
+        for collector in collectors:
+            gauges.update({name: (float(value), help_text) for name, (value, help_text) in collector().items()})
+        return gauges
+
+    def summaries(self):
+        """フェーズ名 -> 直近の集計値 の辞書を返します。"""
+        with self._lock:
+            return {phase: stats.summary() for phase, stats in sorted(self._phases.items())}
+
+    def render_prometheus(self):
+        """Prometheusのテキスト形式で全指標を返します。"""
+        lines = [
+            "# HELP labeling_phase_duration_seconds Duration of each processing phase of the labeling app.",
+            "# TYPE labeling_phase_duration_seconds histogram",
+        ]
+        with self._lock:
+            for phase, stats in sorted(self._phases.items()):
+                label = phase.replace("\\", "\\\\").replace('"', '\\"')
+                for bound, count in zip(stats.buckets, stats.bucket_counts):
+                    lines.append(f'labeling_phase_duration_seconds_bucket{{phase="{label}",le="{bound}"}} {count}')
+                lines.append(f'labeling_phase_duration_seconds_bucket{{phase="{label}",le="+Inf"}} {stats.count}')
+                lines.append(f'labeling_phase_duration_seconds_sum{{phase="{label}"}} {stats.total}')
+                lines.append(f'labeling_phase_duration_seconds_count{{phase="{label}"}} {stats.count}')
+        for name, (value, help_text) in sorted(self.gauges().items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# --- Prometheus用のHTTPエンドポイント ---
+def start_metrics_server(metrics, host, port):
+    """`/metrics` でPrometheus形式の指標を返すHTTPサーバーをバックグラウンドで起動します。"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # アクセスログは出力しない
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+
+from background_jobs import BackgroundJobs, default_workers
+from frame_cache import encode_display_frame
+from video_source import split_frame_key
+
+# 作成したファイルの拡張子
+PROXY_SUFFIX = ".jpg"
+
+
+# --- 表示用画像の作成（ワーカープロセスでも実行） ---
+def _write_atomic(path, data):
+    """一時ファイルに書き込んでから置き換えます（途中で中断されても壊れたファイルを残さない）。"""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.parent.mkdir(parents=True, exist_ok=True)
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def build_proxies(jobs, jpeg_quality=90):
+    """画像を読み込み、指定した幅に縮小したJPEGをそれぞれ書き込みます。
+
+    `jobs` は [(元画像のパス, [(書き込み先, 幅), ...]), ...] です。1回のデコードで表示用画像と
+    サムネイルをまとめて作成します。作成できた元画像の数と、作成できなかった元画像の数を返します。
+    """
+    built = failed = 0
+    for source, targets in jobs:
+        image = cv2.imread(source, cv2.IMREAD_COLOR)
+        if image is None:
+            failed += 1
+            continue
+        for target, width in targets:
+            # 幅の大きい順に縮小を重ねる（サムネイルは表示用画像から縮小するため速い）
+            height, current_width = image.shape[:2]
+            if width and current_width > width:
+                image = cv2.resize(image, (width, max(1, round(height * width / current_width))), interpolation=cv2.INTER_AREA)
+            data = encode_display_frame(image, width, jpeg_quality)
+            if data is None:
+                break
+            _write_atomic(Path(target), data)
+        else:
+            built += 1
+            continue
+        failed += 1
+    return built, failed
+
+
+# --- 表示用画像のディスクキャッシュ ---
+class ProxyCache:
+    """元画像を表示サイズに縮小したJPEG（プロキシ）とサムネイルを保存するディスクキャッシュです。
+
+    ファイル名は元画像のパス・更新時刻・サイズと縮小の設定から求めたハッシュのため、
+    元画像が更新されると自動的に作り直され、アプリを再起動しても作成済みの画像を使い続けます。
+    フォルダの読み込み後は `start()` でプロセスプールによる作成をバックグラウンドで開始します。
+    作成はデータセットごとのジョブとして実行し、別のデータセットの作成を開始しても実行中の作成は続けます
+    （ワーカープロセスは共有し、進み具合は直近 `max_datasets` 件のデータセットの分を保持します）。
+    作成済みの画像は飛ばすため、中断しても次回は続きから作成します。
+    動画のフレームは対象外です（動画は表示サイズでデコードしたフレームをメモリ上にキャッシュします）。
+    """
+
+    def __init__(self, cache_dir, display_width=1280, thumbnail_width=160, jpeg_quality=90, workers=None, chunk_size=8,
+                 max_datasets=4):
+        self.cache_dir = Path(cache_dir)
+        self.display_width = display_width
+        self.thumbnail_width = thumbnail_width
+        self.jpeg_quality = jpeg_quality
+        self.workers = default_workers() if workers is None else workers
+        self.chunk_size = chunk_size
+        self.max_datasets = max_datasets
+
+        self._lock = threading.Lock()
+        self._jobs = BackgroundJobs(self.workers, name="proxy-generator")
+        # データセット -> (フレーム一覧, 進み具合)
+        self._datasets = OrderedDict()
+
+    # --- ファイルの対応付け ---
+    def _file(self, path, stat, width):
+        key = f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{width}\0{self.jpeg_quality}"
+        digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+        return self.cache_dir / digest[:2] / (digest + PROXY_SUFFIX)
+
+    def _targets(self, key):
+        """フレームのキーから (元画像のパス, [(表示用画像, 幅), (サムネイル, 幅)]) を返します。対象外ならNoneです。"""
+        path, frame_number = split_frame_key(key)
+        if frame_number is not None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, [(self._file(path, stat, self.display_width), self.display_width),
+                      (self._file(path, stat, self.thumbnail_width), self.thumbnail_width)]
+
+    def _read(self, key, which):
+        job = self._targets(key)
+        if job is None:
+            return None
+        target = job[1][which][0]
+        try:
+            return target.read_bytes()
+        except FileNotFoundError:
+            pass
+        # まだ作成されていなければこの場で作成する（サムネイルも同時に作成）
+        built, _ = build_proxies([job], self.jpeg_quality)
+        if not built:
+            return None
+        try:
+            return target.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def load(self, key):
+        """表示用画像のJPEGを返します。対象外のフレームや読み込めない画像の場合はNoneを返します。"""
+        return self._read(key, 0)
+
+    def thumbnail(self, key):
+        """サムネイルのJPEGを返します。対象外のフレームや読み込めない画像の場合はNoneを返します。"""
+        return self._read(key, 1)
+
+    # --- バックグラウンドでの作成 ---
+    def start(self, dataset, frames, start_index=0):
+        """データセットの表示用画像・サムネイルの作成をバックグラウンドで開始します。
+
+        現在位置（`start_index`）から順に作成し、最後まで進んだら先頭に戻ります。
+        同じフレーム一覧で作成中・作成済みの場合は何もしません。
+        """
+        if self.workers <= 0:
+            return
+        with self._lock:
+            entry = self._datasets.get(dataset)
+            if entry is not None and (entry[0] is frames or entry[0] == frames):
+                self._datasets.move_to_end(dataset)
+                if self._jobs.running(dataset) or entry[1]["done"] == entry[1]["total"]:
+                    return
+            frames = list(frames)
+            progress = {"total": len(frames), "done": 0, "built": 0, "failed": 0}
+            self._datasets[dataset] = (frames, progress)
+            self._datasets.move_to_end(dataset)
+            while len(self._datasets) > self.max_datasets:
+                evicted, _ = self._datasets.popitem(last=False)
+                self._jobs.cancel(evicted)
+        order = frames[start_index:] + frames[:start_index]
+        self._jobs.start(dataset, lambda cancel: self._tasks(order, progress, cancel), self._collected, self._failed)
+
+    def cancel(self, dataset=None):
+        """データセットの作成を中断します（省略した場合はすべての作成を中断します）。
+
+        作成済みの画像は残ります。ワーカーで処理中の分は完了を待たずに戻ります。
+        """
+        if dataset is None:
+            self._jobs.cancel_all()
+        else:
+            self._jobs.cancel(dataset)
+
+    def _count(self, progress, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                progress[key] += value
+
+    def _tasks(self, order, progress, cancel):
+        for offset in range(0, len(order), self.chunk_size):
+            if cancel.is_set():
+                return
+            chunk = order[offset:offset + self.chunk_size]
+            jobs = [job for job in map(self._targets, chunk)
+                    if job is not None and not all(target.exists() for target, _ in job[1])]
+            skipped = len(chunk) - len(jobs)
+            if skipped:
+                self._count(progress, done=skipped)
+            if jobs:
+                yield build_proxies, (jobs, self.jpeg_quality), (progress, len(jobs))
+
+    def _collected(self, context, result):
+        progress, size = context
+        built, failed = result
+        self._count(progress, done=size, built=built, failed=failed)
+
+    def _failed(self, context):
+        progress, size = context
+        self._count(progress, done=size, failed=size)
+
+    def progress(self, dataset=None):
+        """作成の進み具合（対象フレーム数・処理済み・作成数・失敗数・作成中か）を返します。
+
+        データセットを省略した場合は、保持しているすべてのデータセットの合計を返します。
+        """
+        with self._lock:
+            datasets = [dataset] if dataset is not None else list(self._datasets)
+            entries = [(key, self._datasets[key][1]) for key in datasets if key in self._datasets]
+            progress = {"total": 0, "done": 0, "built": 0, "failed": 0}
+            for _, entry_progress in entries:
+                for key in progress:
+                    progress[key] += entry_progress[key]
+        return {**progress, "running": any(self._jobs.running(key) for key, _ in entries)}
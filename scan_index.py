@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# フレームとして読み込む画像の拡張子
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tiff"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    entries TEXT NOT NULL
+);
+"""
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_sort_key(name):
+    """数字部分を数値として比較するソートキーを返します（frame_2 < frame_10）。"""
+    parts = _DIGITS.split(name)
+    # 分割結果は常に「文字列, 数字, 文字列, ...」の順になるため型の比較は衝突しない
+    return [int(part) if i % 2 else part.lower() for i, part in enumerate(parts)]
+
+
+# --- フォルダのスキャン索引 ---
+class ScanIndex:
+    """フォルダ構成をディレクトリ単位でキャッシュするスキャン索引です。
+
+    各ディレクトリの更新時刻（mtime）が前回と同じ場合は一覧を取得し直さず、
+    変更されたディレクトリだけを `os.scandir` で並列に読み直します。
+    ディレクトリごとのエントリは自然順でソート済みの状態で保存するため、
+    全体の並び順は深さ優先で連結するだけで得られます。
+    """
+
+    def __init__(self, path, workers=16):
+        self.path = Path(path)
+        self.workers = workers
+        self._lock = threading.Lock()
+        # 直近のスキャン結果（変更が無ければ並べ直さずに返す）
+        self._results = {}
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def _load_cached(self, root):
+        escaped = root.rstrip(os.sep).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, mtime_ns, entries FROM scan_dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (root, escaped + os.sep + "%"),
+            ).fetchall()
+        return {path: (mtime_ns, entries) for path, mtime_ns, entries in rows}
+
+    @staticmethod
+    def _list_dir(path, cached):
+        """1ディレクトリ分のエントリを返します。変更が無ければキャッシュを使います。"""
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if cached is not None and cached[0] == mtime_ns:
+                return mtime_ns, json.loads(cached[1]), False
+
+            entries = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        continue
+                    entries.append((entry.name, is_dir))
+        except OSError:
+            # os.walkと同様に、読み取れないディレクトリは無視する
+            return None, [], False
+        entries.sort(key=lambda e: natural_sort_key(e[0]))
+        return mtime_ns, entries, True
+
+    def scan(self, root, extensions):
+        """`root` 以下の指定拡張子のファイルを自然順で返します。"""
+        root = os.path.normpath(root)
+        cached = self._load_cached(root)
+        tree = {}
+        changed = {}
+
+        frontier = [root]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan") as pool:
+            while frontier:
+                results = pool.map(lambda p: (p, self._list_dir(p, cached.get(p))), frontier)
+                frontier = []
+                for path, (mtime_ns, entries, is_changed) in results:
+                    tree[path] = entries
+                    if is_changed:
+                        changed[path] = (mtime_ns, entries)
+                    frontier.extend(os.path.join(path, name) for name, is_dir in entries if is_dir)
+
+        removed = [path for path in cached if path not in tree]
+        self._save(changed, removed)
+
+        extensions = frozenset(ext.lower() for ext in extensions)
+        result_key = (root, extensions)
+        if changed or removed or result_key not in self._results:
+            self._results[result_key] = self._assemble(root, tree, extensions)
+        return list(self._results[result_key])
+
+    @staticmethod
+    def _assemble(root, tree, extensions):
+        files = []
+        stack = [(root, iter(tree[root]))]
+        while stack:
+            path, entries = stack[-1]
+            for name, is_dir in entries:
+                child = os.path.join(path, name)
+                if is_dir:
+                    if child in tree:
+                        stack.append((child, iter(tree[child])))
+                        break
+                elif os.path.splitext(name)[1].lower() in extensions:
+                    files.append(child)
+            else:
+                stack.pop()
+        return files
+
+    def _save(self, changed, removed):
+        if not changed and not removed:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scan_dirs (path, mtime_ns, entries) VALUES (?, ?, ?)",
+                [(path, mtime_ns, json.dumps(entries, ensure_ascii=False)) for path, (mtime_ns, entries) in changed.items()],
+            )
+            self._conn.executemany("DELETE FROM scan_dirs WHERE path = ?", [(path,) for path in removed])
+            self._conn.execute("COMMIT")
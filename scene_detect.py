@@ -0,0 +1,371 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from background_jobs import BackgroundJobs, default_workers
+from video_source import split_frame_key
+
+# 以前の形式（サムネイルから計算した特徴量が混ざる）のテーブルは破棄する
+SCHEMA = """
+DROP TABLE IF EXISTS frame_features;
+CREATE TABLE IF NOT EXISTS scene_features (
+    path TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    features BLOB NOT NULL,
+    PRIMARY KEY (path, start)
+);
+"""
+
+# 特徴量: HSVヒストグラム（色相8 x 彩度4 x 明度2）と、8x8に縮小したグレースケール画像
+HIST_BINS = (8, 4, 2)
+HIST_SIZE = int(np.prod(HIST_BINS))
+THUMB_SIZE = 8
+FEATURE_SIZE = HIST_SIZE + THUMB_SIZE * THUMB_SIZE
+# 動画はこのフレーム数ごとに区切って特徴量を計算・保存する（区切りはフレーム番号で固定）
+VIDEO_CHUNK = 256
+
+
+# --- 特徴量の計算（ワーカープロセスでも実行） ---
+def frame_features(image):
+    """BGR画像から1フレーム分の特徴量（uint8, FEATURE_SIZEバイト）を計算します。"""
+    small = cv2.resize(image, (64, 64), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1, 2], None, list(HIST_BINS), [0, 180, 0, 256, 0, 256]).ravel()
+    hist = np.round(hist * (255.0 / max(hist.sum(), 1.0)))
+    gray = cv2.resize(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    return np.concatenate([hist.astype(np.uint8), gray.ravel()])
+
+
+def compute_features(jobs):
+    """ファイルを読み込み、フレームごとの特徴量を連結したバイト列をジョブごとに返します。
+
+    `jobs` は [(読み込むファイル, 動画の先頭フレーム番号, フレーム数), ...] です（画像は先頭フレーム番号がNone）。
+    動画は先頭フレームへシークしてから順に読み進めます。読み込めなかったフレームの特徴量は0で埋めます
+    （ヒストグラムの合計が0になるため、読み込めたフレームと区別できる）。
+    """
+    results = []
+    for source, start, count in jobs:
+        features = np.zeros((count, FEATURE_SIZE), dtype=np.uint8)
+        if start is None:
+            # 縮小して読み込めば、JPEGではデコード自体が速くなる
+            image = cv2.imread(source, cv2.IMREAD_REDUCED_COLOR_4)
+            if image is not None:
+                features[0] = frame_features(image)
+        else:
+            cap = cv2.VideoCapture(source)
+            try:
+                if start:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+                for i in range(count):
+                    ok, image = cap.read()
+                    if not ok:
+                        break
+                    features[i] = frame_features(image)
+            finally:
+                cap.release()
+        results.append(features.tobytes())
+    return results
+
+
+# --- フレーム間の距離とシーンの境界 ---
+def feature_distances(a, b):
+    """特徴量の組ごとの距離（0〜1）を返します。
+
+    ヒストグラムの差（色の構成の変化）と縮小画像の差（配置の変化）の平均です。
+    """
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16))
+    hist = diff[:, :HIST_SIZE].sum(axis=1) / (2 * 255.0)
+    thumb = diff[:, HIST_SIZE:].mean(axis=1) / 255.0
+    return ((hist + thumb) / 2).astype(np.float32)
+
+
+def find_boundaries(distances, threshold, min_length=1):
+    """フレーム間の距離からシーンの境界（新しいシーンの先頭のフレーム位置）を返します。
+
+    `distances[i]` はフレーム `i` と `i + 1` の距離です（未計算は負の値）。距離が `threshold` を
+    超え、前後 `min_length - 1` フレーム以内で最大となる位置を境界とします（フェードなどで
+    続けて候補になった位置は1つにまとめる）。
+    """
+    candidates = np.flatnonzero(distances > threshold)
+    radius = max(0, int(min_length) - 1)
+    if candidates.size and radius:
+        offsets = np.arange(-radius, radius + 1)
+        neighbors = distances[np.clip(candidates[:, None] + offsets, 0, len(distances) - 1)]
+        values = distances[candidates]
+        # 同じ値が並んだ場合は先頭の位置だけを残す
+        keep = (values > neighbors[:, :radius].max(axis=1)) & (values >= neighbors[:, radius:].max(axis=1))
+        candidates = candidates[keep]
+    return candidates + 1
+
+
+# --- 1データセット分の解析結果 ---
+class SceneAnalysis:
+    """1つのデータセットのフレームごとの特徴量と、隣り合うフレームの距離を保持します。
+
+    特徴量が届くたびに、そのフレームの前後の距離だけを計算し直します。
+    境界は距離の配列から求め、同じ条件での結果は特徴量が追加されるまで使い回します。
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.features = np.zeros((len(frames), FEATURE_SIZE), dtype=np.uint8)
+        # 0: 未計算, 1: 計算済み, 2: 読み込めなかったフレーム
+        self.status = np.zeros(len(frames), dtype=np.int8)
+        self.distances = np.full(max(0, len(frames) - 1), -1.0, dtype=np.float32)
+        self.version = 0
+        self.progress = {"total": len(frames), "done": 0, "computed": 0, "failed": 0}
+        self._lock = threading.Lock()
+        self._boundaries = None
+
+    def fill(self, positions, features):
+        """フレーム位置ごとの特徴量を設定し、前後のフレームとの距離を更新します。"""
+        positions = np.asarray(positions, dtype=np.int64)
+        with self._lock:
+            self.features[positions] = features
+            self.status[positions] = np.where(features[:, :HIST_SIZE].any(axis=1), 1, 2)
+            pairs = np.unique(np.r_[positions - 1, positions])
+            pairs = pairs[(pairs >= 0) & (pairs < len(self.distances))]
+            valid = (self.status[pairs] == 1) & (self.status[pairs + 1] == 1)
+            self.distances[pairs] = np.where(
+                valid, feature_distances(self.features[pairs], self.features[pairs + 1]), -1.0
+            )
+            self.version += 1
+
+    def boundaries(self, threshold, min_length=1):
+        """シーンの境界（新しいシーンの先頭のフレーム位置）を昇順の配列で返します。"""
+        with self._lock:
+            key = (self.version, threshold, min_length)
+            if self._boundaries is None or self._boundaries[0] != key:
+                self._boundaries = (key, find_boundaries(self.distances, threshold, min_length))
+            return self._boundaries[1]
+
+    def segment(self, position, threshold, min_length=1):
+        """指定したフレームを含むシーンの範囲 [start, stop) と、範囲が確定しているかを返します。
+
+        特徴量が未計算のフレームより先は同じシーンが続くか分からないため、範囲は指定したフレームを含む
+        計算済みのフレームの並びに収め、確定していない（False）として返します。
+        """
+        boundaries = self.boundaries(threshold, min_length)
+        i = int(np.searchsorted(boundaries, position, side="right"))
+        start = int(boundaries[i - 1]) if i > 0 else 0
+        stop = int(boundaries[i]) if i < len(boundaries) else len(self.frames)
+        with self._lock:
+            pending = np.flatnonzero(self.status[start:stop] == 0) + start
+        if not pending.size:
+            return start, stop, True
+        if self.status[position] == 0:
+            return position, position + 1, False
+        before, after = pending[pending < position], pending[pending > position]
+        if before.size:
+            start = int(before[-1]) + 1
+        if after.size:
+            stop = int(after[0])
+        return start, stop, False
+
+
+# --- シーン検出 ---
+class SceneDetector:
+    """フレームの特徴量をバックグラウンドで計算し、シーンの切り替わり位置を求めます。
+
+    特徴量は元ファイルのパス・更新時刻・サイズとともにSQLiteに保存するため、
+    アプリを再起動しても計算済みの分は読み込むだけで済みます。計算はプロセスプールで行い、
+    動画は `VIDEO_CHUNK` フレームごとに先頭からまとめて読み進めます。
+    特徴量は常に元ファイルから計算します（表示用のサムネイルと混ぜると、同じ内容のフレーム間でも
+    距離が開いてシーンの切り替わりと誤検出するため）。
+    解析はデータセットごとのジョブとして実行し、ワーカープロセスは共有します。別のデータセットの
+    解析を開始しても実行中の解析は続けます。解析結果はデータセットごとに直近 `max_analyses` 件を保持します。
+    """
+
+    def __init__(self, path, workers=None, chunk_size=64, max_analyses=4):
+        self.path = Path(path)
+        self.workers = default_workers() if workers is None else workers
+        self.chunk_size = chunk_size
+        self.max_analyses = max_analyses
+
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._analyses = OrderedDict()
+        self._jobs = BackgroundJobs(self.workers, name="scene-detector")
+
+    def analysis(self, dataset):
+        """データセットの解析結果（`SceneAnalysis`）を返します。解析を開始していなければNoneを返します。"""
+        with self._lock:
+            return self._analyses.get(dataset)
+
+    # --- バックグラウンドでの解析 ---
+    def start(self, dataset, frames):
+        """データセットの特徴量の計算をバックグラウンドで開始します。
+
+        同じフレーム一覧で解析中・解析済みの場合は何もしません。途中で中断された解析は続きから
+        計算します（計算済みの特徴量は保存済みのため、読み込むだけで済みます）。
+        """
+        if self.workers <= 0:
+            return
+        with self._lock:
+            analysis = self._analyses.get(dataset)
+            if analysis is not None and (analysis.frames is frames or analysis.frames == frames):
+                if self._jobs.running(dataset) or analysis.progress["done"] == analysis.progress["total"]:
+                    self._analyses.move_to_end(dataset)
+                    return
+                # 保存済みの特徴量を読み込み直すため、進み具合は数え直す
+                analysis.progress.update(done=0, computed=0, failed=0)
+            else:
+                analysis = SceneAnalysis(list(frames))
+            self._analyses[dataset] = analysis
+            self._analyses.move_to_end(dataset)
+            while len(self._analyses) > self.max_analyses:
+                evicted, _ = self._analyses.popitem(last=False)
+                self._jobs.cancel(evicted)
+        self._jobs.start(dataset, lambda cancel: self._tasks(analysis, cancel), self._collected, self._failed)
+
+    def cancel(self, dataset=None):
+        """データセットの解析を中断します（省略した場合はすべての解析を中断します）。
+
+        ワーカーで処理中の分は完了を待たずに戻ります。
+        """
+        if dataset is None:
+            self._jobs.cancel_all()
+        else:
+            self._jobs.cancel(dataset)
+
+    def progress(self, dataset):
+        """解析の進み具合（対象フレーム数・処理済み・計算数・失敗数・解析中か）を返します。"""
+        with self._lock:
+            analysis = self._analyses.get(dataset)
+            progress = dict(analysis.progress) if analysis is not None else {"total": 0, "done": 0, "computed": 0, "failed": 0}
+        return {**progress, "running": self._jobs.running(dataset)}
+
+    def _units(self, analysis):
+        """フレーム一覧を計算の単位 [(パス, 先頭フレーム番号, フレーム数, フレーム位置, 単位内の位置), ...] に分けます。
+
+        画像は1枚ずつ（先頭フレーム番号はNone、位置は整数）、動画は `VIDEO_CHUNK` フレームごとの区切りを
+        1つの単位（位置はリスト）とします。
+        """
+        units = []
+        video = None
+        for position, key in enumerate(analysis.frames):
+            path, frame_number = split_frame_key(key)
+            if frame_number is None:
+                units.append((path, None, 1, position, 0))
+                continue
+            chunk = frame_number - frame_number % VIDEO_CHUNK
+            if video is None or video[0] != path or video[1] != chunk:
+                video = (path, chunk, [], [])
+                units.append(video)
+            video[2].append(position)
+            video[3].append(frame_number - chunk)
+        return [
+            unit if unit[1] is None else (unit[0], unit[1], max(unit[3]) + 1, unit[2], unit[3])
+            for unit in units
+        ]
+
+    def _batches(self, units):
+        """計算する単位を、合計のフレーム数が `chunk_size` 前後になるように分けます。"""
+        batch, frames = [], 0
+        for unit in units:
+            batch.append(unit)
+            frames += unit[2]
+            if frames >= self.chunk_size:
+                yield batch
+                batch, frames = [], 0
+        if batch:
+            yield batch
+
+    def _tasks(self, analysis, cancel):
+        units = self._units(analysis)
+        signatures = {}
+        for path in {unit[0] for unit in units}:
+            try:
+                stat = os.stat(path)
+                signatures[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+
+        # 保存済みの特徴量を読み込み、無かった単位だけを計算する
+        missing = []
+        for offset in range(0, len(units), 500):
+            if cancel.is_set():
+                return
+            batch = units[offset:offset + 500]
+            paths = sorted({unit[0] for unit in batch})
+            with self._db_lock:
+                rows = self._conn.execute(
+                    f"SELECT path, start, mtime_ns, size, features FROM scene_features WHERE path IN ({','.join('?' * len(paths))})",
+                    paths,
+                ).fetchall()
+            cached = {(path, start): ((mtime_ns, size), blob) for path, start, mtime_ns, size, blob in rows}
+            results = []
+            for unit in batch:
+                path, start, count = unit[:3]
+                entry = cached.get((path, start or 0))
+                if path not in signatures:
+                    results.append((unit, bytes(count * FEATURE_SIZE)))
+                elif entry is not None and entry[0] == signatures[path] and len(entry[1]) >= count * FEATURE_SIZE:
+                    results.append((unit, entry[1]))
+                else:
+                    missing.append(unit)
+            self._store(analysis, results, computed=False)
+
+        for batch in self._batches(missing):
+            jobs = [(path, start, count) for path, start, count, _, _ in batch]
+            yield compute_features, (jobs,), (analysis, batch, signatures)
+
+    def _collected(self, context, features):
+        analysis, batch, signatures = context
+        results = list(zip(batch, features))
+        self._store(analysis, results)
+        # 自動コミットの接続のため、1行ずつのコミットにならないよう1つのトランザクションにまとめる
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO scene_features (path, start, mtime_ns, size, features) VALUES (?, ?, ?, ?, ?)",
+                    [(unit[0], unit[1] or 0, *signatures[unit[0]], blob) for unit, blob in results],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
+    def _failed(self, context):
+        # ワーカーが異常終了した場合は失敗として数えるが、保存はしない（次回の解析で計算し直す）
+        analysis, batch, _ = context
+        self._store(analysis, [(unit, bytes(unit[2] * FEATURE_SIZE)) for unit in batch])
+
+    def _store(self, analysis, results, computed=True):
+        """単位ごとの特徴量 [(単位, バイト列), ...] を、フレーム一覧に含まれるフレームの位置にまとめて設定します。"""
+        if not results:
+            return
+        positions, features = [], []
+        for (_, start, _, unit_positions, offsets), blob in results:
+            rows = np.frombuffer(blob, dtype=np.uint8).reshape(-1, FEATURE_SIZE)
+            if start is None:
+                positions.append(unit_positions)
+                features.append(rows[0])
+            else:
+                positions.extend(unit_positions)
+                features.extend(rows[offsets])
+        features = np.array(features, dtype=np.uint8)
+        analysis.fill(positions, features)
+        with self._lock:
+            analysis.progress["done"] += len(positions)
+            analysis.progress["failed"] += int(np.count_nonzero(~features[:, :HIST_SIZE].any(axis=1)))
+            if computed:
+                analysis.progress["computed"] += len(positions)
+
+    def close(self):
+        """解析を中断し、データベースを閉じます。"""
+        self.cancel()
+        with self._db_lock:
+            self._conn.close()
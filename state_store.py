@@ -0,0 +1,517 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from label_model import LabelRuns
+
+logger = logging.getLogger(__name__)
+
+# 作業者名が指定されていない場合の作業者（旧形式の状態もこの作業者に移行します）
+DEFAULT_ANNOTATOR = "default"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotator_meta (
+    annotator TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (annotator, dataset, key)
+);
+CREATE TABLE IF NOT EXISTS dataset_frames (
+    dataset TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (dataset, position)
+);
+CREATE TABLE IF NOT EXISTS dataset_generations (
+    dataset TEXT NOT NULL PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS annotation_runs (
+    dataset TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    label TEXT NOT NULL,
+    runs BLOB NOT NULL,
+    PRIMARY KEY (dataset, annotator, label)
+);
+CREATE TABLE IF NOT EXISTS annotation_revisions (
+    dataset TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    PRIMARY KEY (dataset, annotator)
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    dataset TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    PRIMARY KEY (dataset, annotator)
+);
+"""
+
+# 作業者・データセットの区別が無かった頃のテーブル（起動時に移行して削除します）
+SINGLE_USER_TABLES = ("meta", "frames", "labels", "label_runs")
+
+
+def _encode_runs(runs):
+    # 区間は (start, stop) を交互に並べたint64のバイト列として保存
+    return np.asarray(list(runs), dtype=np.int64).tobytes()
+
+
+def _decode_runs(blob):
+    pairs = np.frombuffer(blob, dtype=np.int64).reshape(-1, 2)
+    return LabelRuns(pairs[:, 0].tolist(), pairs[:, 1].tolist())
+
+
+def _remap_changes(changes, mapping):
+    """古いフレーム一覧の位置で表した操作列を、`mapping`（古い位置 -> 新しい位置、無ければ-1）で新しい位置に移します。
+
+    一覧から無くなったフレームへの操作は除きます。並びが変わって範囲が分かれた場合は、複数の操作に分けます。
+    """
+    remapped = []
+    for label, add, start, stop in changes:
+        moved = mapping[start:stop]
+        remapped.extend((label, add, new_start, new_stop)
+                        for new_start, new_stop in LabelRuns.from_positions(moved[moved >= 0]))
+    return remapped
+
+
+# --- 作業者・データセットごとの状態ストア ---
+class StateStore:
+    """作業状態を作業者・データセットごとにSQLite（WALモード）へ保存するストアです。
+
+    - 設定やカーソル位置は (作業者, データセット) ごとに保存します。
+    - フレーム一覧はデータセットごとに共有します。一覧が置き換えられるたびに世代番号を進め、
+      古い一覧の位置で表された書き込みは、保存時にフレームのパスで対応付けて新しい位置に移します。
+    - ラベルは (データセット, 作業者) ごとのラベル区間として保存します。書き込みは
+      変更の操作列（付与・解除した範囲）として受け取り、トランザクション内で保存済みの
+      区間に適用するため、同じ作業者の別タブや別プロセスからの同時の書き込みも失われません。
+
+    書き込みは一定時間ごとにまとめて1トランザクションで反映されます。
+    保存コストは変更量に比例し、データセットの大きさには依存しません。
+    """
+
+    def __init__(self, path, flush_interval=0.25, compact_interval=60.0, history_size=256):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        # 他のプロセスが書き込み中の場合は待つ（timeout秒）
+        self._conn = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending_meta = {}
+        self._pending_changes = defaultdict(list)
+        # (データセット, 作業者) -> このプロセスで書き込んだ (リビジョン, 書き込み元) の履歴
+        self._history = defaultdict(lambda: deque(maxlen=history_size))
+
+        self._migrate_single_user_tables()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="state-store-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @contextmanager
+    def _transaction(self):
+        """書き込みロックを取得し、他のプロセスの書き込みとも直列化されたトランザクションを開始します。"""
+        with self._write_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._rollback()
+                raise
+
+    def _rollback(self):
+        # BEGINやCOMMITに失敗した場合はトランザクションが開始されていない（終了している）ことがある
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+
+    # --- 書き込み（非同期） ---
+    def put_meta(self, annotator, dataset, items):
+        """設定やカーソル位置などの値を保存キューに追加します（dataset=""は作業者全体の値）。"""
+        with self._pending_lock:
+            self._pending_meta.update({(annotator, dataset, key): value for key, value in items.items()})
+
+    def put_label_changes(self, dataset, annotator, changes, writer=None, frames=None, generation=None):
+        """ラベルの変更の操作列 [(ラベル名, 付与ならTrue, start, stop), ...] を保存キューに追加します。
+
+        `writer` には書き込み元（ブラウザのセッションなど）を識別する値を渡します。
+        `frames` には操作列の位置の基準となるフレーム一覧を、`generation` にはその一覧を読み込む前に
+        `frame_generation()` で取得した世代番号を渡します。保存までに別のセッションがフレーム一覧を
+        置き換えていた場合は、操作列をフレームのパスで対応付けて新しい位置に移してから適用します。
+        """
+        if not changes:
+            return
+        with self._pending_lock:
+            self._pending_changes[(dataset, annotator)].append((writer, list(changes), frames, generation))
+
+    # --- 書き込み（同期） ---
+    def flush(self):
+        """保存キューの内容を即座に書き込みます。
+
+        バックグラウンドの書き込み中に呼ばれた場合は、その完了も待ってから戻ります。
+        書き込みに失敗した場合（他のプロセスの書き込みが長引いた場合やディスクの空き不足など）は、
+        取り出した内容を保存キューに戻し、次回の書き込みで再び試みます。
+        """
+        with self._write_lock:
+            with self._pending_lock:
+                meta, changes = self._pending_meta, self._pending_changes
+                self._pending_meta, self._pending_changes = {}, defaultdict(list)
+            if not meta and not changes:
+                return
+            written = []
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                if meta:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO annotator_meta (annotator, dataset, key, value) VALUES (?, ?, ?, ?)",
+                        [(*key, json.dumps(value, ensure_ascii=False)) for key, value in meta.items()],
+                    )
+                for (dataset, annotator), batches in changes.items():
+                    written.extend(((dataset, annotator), revision, writer)
+                                   for revision, writer in self._merge_changes(dataset, annotator, batches))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._rollback()
+                self._requeue(meta, changes)
+                logger.exception("状態の保存に失敗しました（次回の書き込みで再び試みます）")
+                return
+            for key, revision, writer in written:
+                self._history[key].append((revision, writer))
+
+    def _requeue(self, meta, changes):
+        """書き込めなかった内容を、その後に追加された内容より前になるよう保存キューに戻します。"""
+        with self._pending_lock:
+            self._pending_meta = {**meta, **self._pending_meta}
+            for key, batches in self._pending_changes.items():
+                changes[key].extend(batches)
+            self._pending_changes = changes
+
+    def _merge_changes(self, dataset, annotator, batches):
+        """保存済みの区間を読み込み、操作列を順に適用して書き戻します（トランザクション内で呼び出します）。"""
+        runs = {}
+        revisions = []
+        generation = self._frame_generation(dataset)
+        current_positions, mappings = None, {}
+        for writer, changes, frames, batch_generation in batches:
+            if frames is not None and batch_generation != generation:
+                # 操作列の作成後にフレーム一覧が置き換えられていれば、フレームのパスで新しい位置に移す
+                if current_positions is None:
+                    current_positions = {path: position for position, path in enumerate(self._frames(dataset))}
+                mapping = mappings.get(id(frames))
+                if mapping is None:
+                    mapping = mappings[id(frames)] = np.array(
+                        [current_positions.get(path, -1) for path in frames], dtype=np.int64
+                    )
+                changes = _remap_changes(changes, mapping)
+            for label, add, start, stop in changes:
+                label_runs = runs.get(label)
+                if label_runs is None:
+                    row = self._conn.execute(
+                        "SELECT runs FROM annotation_runs WHERE dataset = ? AND annotator = ? AND label = ?",
+                        (dataset, annotator, label),
+                    ).fetchone()
+                    label_runs = runs[label] = _decode_runs(row[0]) if row else LabelRuns()
+                if add:
+                    label_runs.add(start, stop)
+                else:
+                    label_runs.remove(start, stop)
+            revisions.append((self._bump_revision(dataset, annotator), writer))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO annotation_runs (dataset, annotator, label, runs) VALUES (?, ?, ?, ?)",
+            [(dataset, annotator, label, _encode_runs(label_runs)) for label, label_runs in runs.items()],
+        )
+        return revisions
+
+    def _bump_revision(self, dataset, annotator):
+        self._conn.execute(
+            "INSERT INTO annotation_revisions (dataset, annotator, revision) VALUES (?, ?, 1) "
+            "ON CONFLICT (dataset, annotator) DO UPDATE SET revision = revision + 1",
+            (dataset, annotator),
+        )
+        return self._conn.execute(
+            "SELECT revision FROM annotation_revisions WHERE dataset = ? AND annotator = ?", (dataset, annotator)
+        ).fetchone()[0]
+
+    def _frame_generation(self, dataset):
+        row = self._conn.execute("SELECT generation FROM dataset_generations WHERE dataset = ?", (dataset,)).fetchone()
+        return row[0] if row else 0
+
+    def _frames(self, dataset):
+        return [path for (path,) in self._conn.execute(
+            "SELECT path FROM dataset_frames WHERE dataset = ? ORDER BY position", (dataset,)
+        )]
+
+    def replace_frames(self, dataset, frames):
+        """データセットのフレーム一覧を置き換えます（フォルダ読み込み時）。変更があればTrueを返します。
+
+        フレームが追加・削除されて並びが変わった場合は、全作業者のラベル区間を
+        フレームのパスで対応付けて新しい位置に移し替えます（削除されたフレームのラベルは破棄）。
+        """
+        frames = list(frames)
+        self.flush()
+        with self._transaction() as conn:
+            old_frames = self._frames(dataset)
+            if old_frames == frames:
+                return False
+            conn.execute(
+                "INSERT INTO dataset_generations (dataset, generation) VALUES (?, 1) "
+                "ON CONFLICT (dataset) DO UPDATE SET generation = generation + 1",
+                (dataset,),
+            )
+            conn.execute("DELETE FROM dataset_frames WHERE dataset = ?", (dataset,))
+            conn.executemany(
+                "INSERT INTO dataset_frames (dataset, position, path) VALUES (?, ?, ?)",
+                [(dataset, position, path) for position, path in enumerate(frames)],
+            )
+
+            new_positions = {path: position for position, path in enumerate(frames)}
+            mapping = np.array([new_positions.get(path, -1) for path in old_frames], dtype=np.int64)
+            rows = conn.execute(
+                "SELECT annotator, label, runs FROM annotation_runs WHERE dataset = ?", (dataset,)
+            ).fetchall()
+            remapped = []
+            for annotator, label, blob in rows:
+                positions = np.flatnonzero(_decode_runs(blob).to_array(len(old_frames)))
+                moved = mapping[positions]
+                remapped.append((_encode_runs(LabelRuns.from_positions(moved[moved >= 0])), dataset, annotator, label))
+            conn.executemany(
+                "UPDATE annotation_runs SET runs = ? WHERE dataset = ? AND annotator = ? AND label = ?", remapped
+            )
+            # 開いているセッションが読み込み直すよう、全作業者のリビジョンを進める
+            for annotator in {annotator for annotator, _, _ in rows}:
+                self._bump_revision(dataset, annotator)
+        return True
+
+    def clear(self, annotator, dataset=None):
+        """作業者の保存済みの状態を削除します。datasetを指定した場合はそのデータセットの分だけを削除します。
+
+        フレーム一覧や他の作業者の状態・作業範囲の割り当ては残します。
+        """
+        with self._pending_lock:
+            self._pending_meta = {
+                key: value for key, value in self._pending_meta.items()
+                if key[0] != annotator or (dataset is not None and key[1] not in (dataset, ""))
+            }
+            for key in [key for key in self._pending_changes if key[1] == annotator and dataset in (None, key[0])]:
+                del self._pending_changes[key]
+        with self._transaction() as conn:
+            if dataset is None:
+                conn.execute("DELETE FROM annotator_meta WHERE annotator = ?", (annotator,))
+                datasets = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT dataset FROM annotation_runs WHERE annotator = ?", (annotator,)
+                ).fetchall()]
+            else:
+                conn.execute("DELETE FROM annotator_meta WHERE annotator = ? AND dataset IN (?, '')", (annotator, dataset))
+                datasets = [dataset]
+            for target in datasets:
+                conn.execute("DELETE FROM annotation_runs WHERE dataset = ? AND annotator = ?", (target, annotator))
+                self._bump_revision(target, annotator)
+
+    def assign(self, dataset, annotator, start, stop):
+        """作業者にフレーム範囲 [start, stop) を割り当てます。"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO assignments (dataset, annotator, start, stop) VALUES (?, ?, ?, ?)",
+                (dataset, annotator, int(start), int(stop)),
+            )
+
+    def unassign(self, dataset, annotator):
+        """作業者へのフレーム範囲の割り当てを解除します。"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM assignments WHERE dataset = ? AND annotator = ?", (dataset, annotator))
+
+    def compact(self):
+        """空のラベル区間の行を削除し、WALファイルをチェックポイントして縮小します。"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM annotation_runs WHERE length(runs) = 0")
+        with self._write_lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # --- 読み込み ---
+    def is_empty(self):
+        """保存済みの状態が無い場合にTrueを返します。"""
+        self.flush()
+        with self._write_lock:
+            row = self._conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM annotator_meta) OR EXISTS(SELECT 1 FROM dataset_frames)"
+            ).fetchone()
+        return not row[0]
+
+    def load_meta(self, annotator, dataset):
+        """作業者の保存済みの値を辞書で返します（dataset=""は作業者全体の値）。"""
+        self.flush()
+        with self._write_lock:
+            return {key: json.loads(value) for key, value in self._conn.execute(
+                "SELECT key, value FROM annotator_meta WHERE annotator = ? AND dataset = ?", (annotator, dataset)
+            )}
+
+    def load_frames(self, dataset):
+        """データセットのフレーム一覧を返します。"""
+        with self._write_lock:
+            return self._frames(dataset)
+
+    def frame_generation(self, dataset):
+        """データセットのフレーム一覧が置き換えられるたびに増える世代番号を返します。
+
+        フレーム一覧より先に取得してください（間に置き換えられても、古い世代として扱われるだけで済みます）。
+        """
+        with self._write_lock:
+            return self._frame_generation(dataset)
+
+    def iter_frames(self, dataset, chunk_rows=100_000):
+        """データセットのフレーム一覧を、先頭から `chunk_rows` 件ずつのリストで返します。
+
+        大きなデータセットでも一覧全体を読み込まずに順に処理できます。
+        """
+        position = 0
+        while True:
+            with self._write_lock:
+                chunk = [path for (path,) in self._conn.execute(
+                    "SELECT path FROM dataset_frames WHERE dataset = ? AND position >= ? ORDER BY position LIMIT ?",
+                    (dataset, position, chunk_rows),
+                )]
+            if not chunk:
+                return
+            yield chunk
+            position += len(chunk)
+
+    def frame_count(self, dataset):
+        """データセットのフレーム数を返します。"""
+        with self._write_lock:
+            return self._conn.execute("SELECT COUNT(*) FROM dataset_frames WHERE dataset = ?", (dataset,)).fetchone()[0]
+
+    def datasets(self):
+        """フレーム一覧が保存されているデータセットの一覧を返します。"""
+        with self._write_lock:
+            return [dataset for (dataset,) in self._conn.execute("SELECT DISTINCT dataset FROM dataset_frames ORDER BY dataset")]
+
+    def load_label_runs(self, dataset, annotator):
+        """作業者のラベル区間を {ラベル名: [(start, stop), ...]} で返します。"""
+        self.flush()
+        with self._write_lock:
+            return {label: list(_decode_runs(blob)) for label, blob in self._conn.execute(
+                "SELECT label, runs FROM annotation_runs WHERE dataset = ? AND annotator = ?", (dataset, annotator)
+            )}
+
+    def label_revision(self, dataset, annotator):
+        """作業者のラベルが書き込まれるたびに増えるリビジョン番号を返します。"""
+        with self._write_lock:
+            row = self._conn.execute(
+                "SELECT revision FROM annotation_revisions WHERE dataset = ? AND annotator = ?", (dataset, annotator)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def changed_by_others(self, dataset, annotator, revision, writer):
+        """`revision` 以降に `writer` 以外による書き込みがあったかを (現在のリビジョン, 有無) で返します。
+
+        このプロセスで書き込んだリビジョンは書き込み元を記録しているため、自分の書き込みだけであれば
+        読み込み直す必要はありません。他のプロセスによる書き込みは常に他者の変更として扱います。
+        """
+        self.flush()
+        current = self.label_revision(dataset, annotator)
+        if current == revision:
+            return current, False
+        with self._write_lock:
+            own = {rev for rev, rev_writer in self._history[(dataset, annotator)] if rev_writer == writer}
+        return current, any(rev not in own for rev in range(revision + 1, current + 1))
+
+    def assignments(self, dataset):
+        """データセットの作業範囲の割り当てを {作業者: (start, stop)} で返します。"""
+        with self._write_lock:
+            return {annotator: (start, stop) for annotator, start, stop in self._conn.execute(
+                "SELECT annotator, start, stop FROM assignments WHERE dataset = ? ORDER BY start", (dataset,)
+            )}
+
+    def annotators(self, dataset):
+        """データセットにラベルや設定を保存している作業者の一覧を返します。"""
+        with self._write_lock:
+            return sorted(annotator for (annotator,) in self._conn.execute(
+                "SELECT annotator FROM annotation_runs WHERE dataset = ? "
+                "UNION SELECT annotator FROM annotator_meta WHERE dataset = ?", (dataset, dataset)
+            ))
+
+    # --- 旧形式からの移行 ---
+    def _migrate_single_user_tables(self):
+        """作業者の区別が無かった頃のテーブルがあれば、既定の作業者の状態として移行します。"""
+        with self._transaction() as conn:
+            tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            old_tables = [name for name in SINGLE_USER_TABLES if name in tables]
+            if not old_tables:
+                return
+            meta = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")} if "meta" in tables else {}
+            frames = [path for (path,) in conn.execute("SELECT path FROM frames ORDER BY position")] if "frames" in tables else []
+            dataset = meta.pop("selected_path", None) or ""
+
+            runs = {}
+            if "label_runs" in tables:
+                runs = {label: _decode_runs(blob) for label, blob in conn.execute("SELECT label, runs FROM label_runs")}
+            if not runs and "labels" in tables:
+                index = {path: position for position, path in enumerate(frames)}
+                positions = defaultdict(list)
+                for frame, labels in conn.execute("SELECT frame, labels FROM labels"):
+                    if frame in index:
+                        for label in json.loads(labels):
+                            positions[label].append(index[frame])
+                runs = {label: LabelRuns.from_positions(label_positions) for label, label_positions in positions.items()}
+
+            if dataset:
+                conn.execute(
+                    "INSERT OR REPLACE INTO annotator_meta (annotator, dataset, key, value) VALUES (?, '', 'selected_path', ?)",
+                    (DEFAULT_ANNOTATOR, json.dumps(dataset)),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO dataset_frames (dataset, position, path) VALUES (?, ?, ?)",
+                    [(dataset, position, path) for position, path in enumerate(frames)],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO annotation_runs (dataset, annotator, label, runs) VALUES (?, ?, ?, ?)",
+                    [(dataset, DEFAULT_ANNOTATOR, label, _encode_runs(label_runs)) for label, label_runs in runs.items()],
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO annotator_meta (annotator, dataset, key, value) VALUES (?, ?, ?, ?)",
+                [(DEFAULT_ANNOTATOR, dataset, key, json.dumps(value, ensure_ascii=False)) for key, value in meta.items()],
+            )
+            for name in old_tables:
+                conn.execute(f"DROP TABLE {name}")
+        logger.info("作業者の区別が無い形式の状態を、作業者 '%s' の状態として移行しました", DEFAULT_ANNOTATOR)
+
+    # --- バックグラウンド処理 ---
+    def _run(self):
+        last_compact = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            # 失敗しても書き込みを止めない（保存キューの内容は次回の書き込みで再び試みる）
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("状態の保存に失敗しました")
+            if time.monotonic() - last_compact >= self.compact_interval:
+                try:
+                    self.compact()
+                except sqlite3.Error:
+                    logger.exception("状態ファイルの圧縮に失敗しました")
+                last_compact = time.monotonic()
+
+    def close(self):
+        """未保存の変更を書き込み、バックグラウンド処理を停止します。"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,266 @@
+import bisect
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from frame_cache import encode_display_frame, load_display_frame
+
+VIDEO_EXTENSIONS = {".mp4", ".mkv", ".avi"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_index (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    fps REAL NOT NULL,
+    frame_count INTEGER NOT NULL,
+    keyframes BLOB,
+    pts BLOB NOT NULL
+);
+"""
+
+
+# --- フレームの指定方法 ---
+def is_video_file(path):
+    """動画ファイルの場合にTrueを返します。"""
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def video_frame_key(path, frame_number):
+    """動画内の1フレームを表すキー（`パス#フレーム番号`）を返します。"""
+    return f"{path}#{frame_number}"
+
+
+def split_frame_key(key):
+    """フレームのキーを (ファイルのパス, フレーム番号) に分解します。画像の場合フレーム番号はNoneです。"""
+    path, sep, number = key.rpartition("#")
+    if sep and number.isdigit() and is_video_file(path):
+        return path, int(number)
+    return key, None
+
+
+def frame_display_name(key):
+    """画面表示用のフレーム名を返します（動画の場合はフレーム番号付き）。"""
+    path, frame_number = split_frame_key(key)
+    if frame_number is None:
+        return Path(path).name
+    return f"{Path(path).name} (フレーム {frame_number})"
+
+
+# --- キーフレーム・PTSの索引 ---
+class VideoIndex:
+    """1本の動画のフレーム数・FPS・キーフレーム位置・PTSを保持します。"""
+
+    def __init__(self, fps, frame_count, keyframes, pts):
+        self.fps = fps
+        self.frame_count = frame_count
+        # キーフレーム位置が取得できない場合はNone（OpenCVのシークに任せる）
+        self.keyframes = keyframes
+        # 表示順のPTS（パケットはデコード順に読むため並べ替える）。シーク先の確認に使う
+        self.pts = np.sort(np.asarray(pts, dtype=np.float64))
+        # PTSが欠けている・重複している動画では確認できないため、シークはOpenCVに任せる
+        self.has_pts = len(self.pts) == frame_count and bool(np.all(np.diff(self.pts) > 0))
+
+    @classmethod
+    def build(cls, path):
+        """デコードせずにパケットだけを読み進めて索引を作成します。"""
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise IOError(f"動画ファイルを開けませんでした: {path}")
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+            raw_mode = cap.set(cv2.CAP_PROP_FORMAT, -1)
+            keyframes = [] if raw_mode else None
+            pts = []
+            frame_number = 0
+            while cap.grab():
+                if raw_mode and cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                    keyframes.append(frame_number)
+                pts.append(cap.get(cv2.CAP_PROP_PTS))
+                frame_number += 1
+        finally:
+            cap.release()
+        if keyframes is not None and (not keyframes or keyframes[0] != 0):
+            keyframes.insert(0, 0)
+        return cls(fps, frame_number, keyframes, pts)
+
+    def keyframe_before(self, frame_number):
+        """指定したフレーム以前で最も近いキーフレームの番号を返します。"""
+        if self.keyframes is None:
+            return frame_number
+        return self.keyframes[bisect.bisect_right(self.keyframes, frame_number) - 1]
+
+    def frame_at(self, pts):
+        """PTSに対応するフレーム番号を返します。索引に無いPTSの場合はNoneを返します。"""
+        i = int(np.searchsorted(self.pts, pts))
+        return i if i < len(self.pts) and self.pts[i] == pts else None
+
+
+# --- 動画の読み込み ---
+class VideoReader:
+    """1本の動画を開いたままにして、連続したフレームを順にデコードするリーダーです。
+
+    直前に読んだ位置より少し先のフレームはシークせずに読み進め、途中のフレームは
+    先読みバッファに残します（フレームキャッシュの先読みが順不同で届いても無駄にならない）。
+    離れた位置へは索引のキーフレームへシークし、着いた位置を索引のPTSで確かめてから読み進めます。
+    """
+
+    def __init__(self, path, index, decode_ahead=32):
+        self.path = path
+        self.index = index
+        self.decode_ahead = decode_ahead
+        self.lock = threading.Lock()
+        self._cap = cv2.VideoCapture(path)
+        self._next_frame = 0
+        self._buffer = OrderedDict()
+
+    def _seek(self, frame_number):
+        keyframe = self.index.keyframe_before(frame_number)
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+        self._next_frame = keyframe
+        if not self.index.has_pts or not self._cap.grab():
+            return
+
+        # フレーム番号でのシークは可変フレームレートの動画などでずれるため、実際の位置をPTSで確かめる
+        landed = self.index.frame_at(self._cap.get(cv2.CAP_PROP_PTS))
+        if landed is None or landed > frame_number:
+            # 位置が分からない・行き過ぎた場合は先頭から読み進める
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self._next_frame = 0
+            return
+        ok, frame = self._cap.retrieve()
+        if ok:
+            self._buffer[landed] = frame
+        self._next_frame = landed + 1
+
+    def read(self, frame_number):
+        """指定したフレームをBGR画像として返します。読めない場合はNoneを返します。"""
+        with self.lock:
+            frame = self._buffer.pop(frame_number, None)
+            if frame is not None:
+                return frame
+
+            distance = frame_number - self._next_frame
+            if distance < 0 or (distance > self.decode_ahead
+                                and self.index.keyframe_before(frame_number) > self._next_frame):
+                self._seek(frame_number)
+                frame = self._buffer.pop(frame_number, None)
+                if frame is not None:
+                    return frame
+
+            while self._next_frame < frame_number:
+                if frame_number - self._next_frame <= self.decode_ahead:
+                    ok, skipped = self._cap.read()
+                    if ok:
+                        self._buffer[self._next_frame] = skipped
+                        while len(self._buffer) > self.decode_ahead:
+                            self._buffer.popitem(last=False)
+                else:
+                    ok = self._cap.grab()
+                if not ok:
+                    return None
+                self._next_frame += 1
+
+            ok, frame = self._cap.read()
+            self._next_frame += 1
+            return frame if ok else None
+
+    def close(self):
+        with self.lock:
+            self._cap.release()
+            self._buffer.clear()
+
+
+class VideoLibrary:
+    """動画の索引（SQLiteに永続化）と、開いているリーダーを管理します。"""
+
+    def __init__(self, path, max_open_readers=8):
+        self.path = Path(path)
+        self.max_open_readers = max_open_readers
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._indexes = {}
+        self._readers = OrderedDict()
+
+    def get_index(self, path):
+        """動画の索引を返します。ファイルが更新されていない限り保存済みの索引を使います。"""
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._indexes.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            row = self._conn.execute(
+                "SELECT fps, frame_count, keyframes, pts FROM video_index WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (path, *signature),
+            ).fetchone()
+
+        if row is not None:
+            fps, frame_count, keyframes, pts = row
+            index = VideoIndex(
+                fps, frame_count,
+                np.frombuffer(keyframes, dtype=np.int64).tolist() if keyframes is not None else None,
+                np.frombuffer(pts, dtype=np.float64),
+            )
+        else:
+            index = VideoIndex.build(path)
+            keyframes = np.asarray(index.keyframes, dtype=np.int64).tobytes() if index.keyframes is not None else None
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO video_index (path, mtime_ns, size, fps, frame_count, keyframes, pts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, *signature, index.fps, index.frame_count, keyframes, np.asarray(index.pts, dtype=np.float64).tobytes()),
+                )
+
+        with self._lock:
+            self._indexes[path] = (signature, index)
+        return index
+
+    def expand(self, files):
+        """ファイル一覧のうち動画をフレーム単位のキーに展開します。"""
+        frames = []
+        for path in files:
+            if not is_video_file(path):
+                frames.append(path)
+                continue
+            try:
+                frame_count = self.get_index(path).frame_count
+            except (IOError, OSError):
+                continue
+            frames.extend(video_frame_key(path, n) for n in range(frame_count))
+        return frames
+
+    def _reader(self, path):
+        with self._lock:
+            reader = self._readers.get(path)
+            if reader is not None:
+                self._readers.move_to_end(path)
+                return reader
+        reader = VideoReader(path, self.get_index(path))
+        with self._lock:
+            self._readers[path] = reader
+            while len(self._readers) > self.max_open_readers:
+                _, evicted = self._readers.popitem(last=False)
+                evicted.close()
+        return reader
+
+    def read_frame(self, path, frame_number):
+        """動画の指定フレームをBGR画像として返します。"""
+        return self._reader(path).read(frame_number)
+
+    def load_display_frame(self, key, display_width, jpeg_quality=90):
+        """フレームのキーから表示用のJPEGを作成します（フレームキャッシュの読み込み関数）。"""
+        path, frame_number = split_frame_key(key)
+        if frame_number is None:
+            return load_display_frame(path, display_width, jpeg_quality)
+        image = self.read_frame(path, frame_number)
+        data = encode_display_frame(image, display_width, jpeg_quality) if image is not None else None
+        if data is None:
+            raise IOError(f"動画のフレームを読み込めませんでした: {key}")
+        return data